@@ -1,45 +1,287 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, g
 from flask_cors import CORS
+import functools
 import os
-import soundfile as sf
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
 import whisper
 from neuttsair.neutts import NeuTTSAir
+from neuttsair.cancellation import Cancelled, CancellationToken
+from neuttsair.audio import REFERENCE_SAMPLE_RATE, compact_reference, reference_array_path
+from neuttsair.profiling import InferenceProfiler, profile_context
+from neuttsair.resources import ResourceConfig
 import uuid
 from datetime import datetime
-from pydub import AudioSegment
 import json
 import hashlib
 import numpy as np
 import random
 import string
 from database import VoiceDatabase
+from model_pool import ModelPool
+from model_server import ModelClient, authkey_from_env
+from scheduler import AdmissionRejected, FairScheduler
+from singleflight import SingleFlight
+from synthesis import (
+    convert_wav_to_mp3, estimate_audio_seconds, pcm16_bytes, synthesize_to_wav, wav_stream_header
+)
+from metrics import (
+    ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS, MODEL_POOL_LOADED, MODEL_POOL_RESIDENT_MB,
+    SINGLEFLIGHT_SHARED, SYNTHESIS_CANCELLED, PrometheusHook, init_app, logger, setup_logging,
+)
 
 app = Flask(__name__)
 CORS(app)
 
+# Request ids, Prometheus metrics and /metrics
+setup_logging()
+init_app(app)
+
+# One CPU budget and device for every model in the process, via NEUTTS_DEVICE / NEUTTS_*THREADS / NEUTTS_CPU_AFFINITY
+resources = ResourceConfig.from_env()
+resources.apply()
+logger.info(f"Resources: {resources}")
+
 # Initialize database
 db = VoiceDatabase()
 
-# Initialize Whisper for transcription
-whisper_model = whisper.load_model("base")
+# Whisper and TTS are loaded and warmed up by a background thread at startup (see warm_up_models);
+# requests that arrive before then wait for the load instead of starting their own
+whisper_model = None
+_whisper_lock = threading.Lock()
+readiness = {'status': 'starting', 'error': None}
 
-# Initialize TTS (will be loaded when needed)
-tts = None
+# On-demand profiling: per request via X-Profile header / "profile" flag, per process via NEUTTS_PROFILE_* env
+profiler = InferenceProfiler.from_env()
 
-# Store voice data (in production, use a database)
-voice_store = {}
-api_keys = {}
+@app.before_request
+def set_profile_context():
+    data = request.get_json(silent=True) if request.is_json else None
+    force = request.headers.get('X-Profile', '').lower() in ('1', 'true', 'yes') or bool(
+        isinstance(data, dict) and data.get('profile')
+    )
+    profile_context.set({'force': force, 'label': g.request_id})
 
-def get_tts():
-    global tts
-    if tts is None:
-        tts = NeuTTSAir(
-            backbone_repo="neuphonic/neutts-air-q4-gguf",
-            backbone_device="cuda",
-            codec_repo="neuphonic/neucodec",
-            codec_device="cuda"
-        )
-    return tts
+# Uploaded references are trimmed to their best span of at most this many seconds
+REFERENCE_MAX_SECONDS = float(os.environ.get('REFERENCE_MAX_SECONDS', 12.0))
+
+# Voices and keys from /create_voice_api live in the database so every worker process sees them;
+# keys issued before that were kept in voice_store.json
+try:
+    db.import_voice_store_json('voice_store.json')
+except (OSError, ValueError, KeyError) as e:
+    logger.warning(f"Could not import voice_store.json: {str(e)}")
+
+# Admission control in front of inference: per-key budgets in estimated audio seconds,
+# fair queueing across keys and a bounded queue that rejects with 429 + Retry-After.
+# By default as many requests run at once as there are GGUF backbone replicas
+scheduler = FairScheduler(
+    concurrency=int(os.environ.get('ADMISSION_CONCURRENCY', resources.llama_replicas)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 32)),
+    rate=float(os.environ.get('KEY_RATE_AUDIO_SECONDS', 1.0)),
+    burst=float(os.environ.get('KEY_BURST_AUDIO_SECONDS', 300.0)),
+    queue_timeout_s=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 60.0)),
+)
+ADMISSION_QUEUE_DEPTH.set_function(lambda: scheduler.queue_depth)
+
+def admission_key():
+    """Budget by API key when a known one is presented, otherwise by client address"""
+    auth = request.headers.get('Authorization', '')
+    api_key = auth[len('Bearer '):].strip() if auth.startswith('Bearer ') else None
+    if api_key and db.get_api_key_voice_id(api_key):
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+def admission_weight(key, tier):
+    """Fair-queueing weight of a request: its tier's weight times its API key's own weight"""
+    weight = TIER_WEIGHTS.get(tier or DEFAULT_TIER, 1.0)
+    if key.startswith('key:'):
+        weight *= db.get_api_key_weight(key[len('key:'):]) or 1.0
+    return weight
+
+@contextmanager
+def admission_slot(key, text, weight=1.0):
+    """Hold an inference slot sized by text, charged to key"""
+    with scheduler.slot(key, estimate_audio_seconds(text), weight) as wait_s:
+        ADMISSION_WAIT_SECONDS.observe(wait_s)
+        yield
+
+def admission_controlled(text_field):
+    """Run the view inside an inference slot sized by the request's text"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            key = admission_key()
+            with admission_slot(key, data.get(text_field) or '', admission_weight(key, request_tier(data))):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    ADMISSION_REJECTED.labels(reason=e.reason).inc()
+    logger.warning(f"Admission rejected: reason={e.reason} retry_after={e.retry_after_s}s")
+    response = jsonify({'error': str(e), 'reason': e.reason, 'retry_after': e.retry_after_s})
+    response.headers['Retry-After'] = str(e.retry_after_s)
+    return response, 429
+
+# Synthesis stops once a request's deadline passes (REQUEST_TIMEOUT_S, or a lower "timeout" in
+# its body) or its client disconnects, instead of generating audio nobody will receive
+REQUEST_TIMEOUT_S = float(os.environ.get('REQUEST_TIMEOUT_S', 600))
+DISCONNECT_POLL_S = 0.5
+
+def request_cancellation():
+    """Cancellation token for the current request, carrying its deadline"""
+    data = request.get_json(silent=True) or {}
+    try:
+        timeout_s = min(float(data.get('timeout', REQUEST_TIMEOUT_S)), REQUEST_TIMEOUT_S)
+    except (TypeError, ValueError):
+        timeout_s = REQUEST_TIMEOUT_S
+    return CancellationToken(timeout_s)
+
+@contextmanager
+def cancel_on_disconnect(cancel):
+    """Cancel the token if the client hangs up while the block runs"""
+    # Werkzeug's server and Gunicorn's sync workers expose the client socket
+    sock = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    if sock is None:
+        yield
+        return
+    done = threading.Event()
+    
+    def watch():
+        while not done.wait(DISCONNECT_POLL_S):
+            try:
+                # The body has been read, so an empty peek means the client closed its end
+                if sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b'':
+                    cancel.cancel('disconnected')
+                    return
+            except BlockingIOError:
+                continue
+            except ValueError:
+                # TLS sockets can't be peeked
+                return
+            except OSError:
+                cancel.cancel('disconnected')
+                return
+    
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        yield
+    finally:
+        done.set()
+
+@app.errorhandler(Cancelled)
+def synthesis_cancelled(e):
+    SYNTHESIS_CANCELLED.labels(reason=e.reason).inc()
+    logger.info(f"Synthesis cancelled: reason={e.reason}")
+    # 499 is nginx's "client closed request"; nobody reads it, but it keeps access logs accurate
+    return jsonify({'error': str(e), 'reason': e.reason}), 504 if e.reason == 'deadline' else 499
+
+# Identical synthesis requests (same voice and text) that arrive while one is running share its
+# result instead of generating again; only the request that runs takes an admission slot
+flights = SingleFlight()
+
+def synthesis_key(kind, tier, voice, ref_text, input_text):
+    """Requests with the same key produce interchangeable audio"""
+    return (kind, MODEL_TIERS[tier], voice['audio_path'], ref_text, input_text)
+
+# Quality tiers API callers choose between with "tier", each a [backbone_repo, codec_repo] pair;
+# MODEL_TIERS (JSON) adds or overrides tiers. Tiers naming the same pair share one loaded model
+MODEL_TIERS = {
+    'standard': ['neuphonic/neutts-air-q4-gguf', 'neuphonic/neucodec'],
+    'bulk': ['neuphonic/neutts-air-q4-gguf', 'neuphonic/neucodec'],
+    'premium': ['neuphonic/neutts-air', 'neuphonic/neucodec'],
+}
+MODEL_TIERS.update(json.loads(os.environ.get('MODEL_TIERS', '{}')))
+MODEL_TIERS = {tier: tuple(repos) for tier, repos in MODEL_TIERS.items()}
+DEFAULT_TIER = os.environ.get('DEFAULT_TIER', 'standard')
+
+# Each tier's share of inference slots when keys contend for them; TIER_WEIGHTS (JSON) overrides.
+# Unlisted tiers weigh 1, and an API key's own weight (api_keys.weight) multiplies its tier's
+TIER_WEIGHTS = {'standard': 1.0, 'bulk': 0.25, 'premium': 2.0}
+TIER_WEIGHTS.update(json.loads(os.environ.get('TIER_WEIGHTS', '{}')))
+
+def load_tts(backbone_repo, codec_repo, device):
+    return NeuTTSAir(
+        backbone_repo=backbone_repo,
+        backbone_device=device,
+        codec_repo=codec_repo,
+        codec_device=device,
+        hooks=[PrometheusHook()],
+        profiler=profiler,
+        resources=resources,
+    )
+
+# TTS models load on first use; the least recently used idle ones are unloaded to stay within
+# MODEL_POOL_MEMORY_MB (default 75% of RAM), or after MODEL_IDLE_TTL seconds unused
+model_pool = ModelPool(
+    load_tts,
+    memory_budget_mb=float(os.environ['MODEL_POOL_MEMORY_MB']) if os.environ.get('MODEL_POOL_MEMORY_MB') else None,
+    idle_ttl_s=float(os.environ['MODEL_IDLE_TTL']) if os.environ.get('MODEL_IDLE_TTL') else None,
+)
+MODEL_POOL_LOADED.set_function(lambda: len(model_pool.loaded_keys))
+MODEL_POOL_RESIDENT_MB.set_function(lambda: model_pool.resident_mb)
+
+def request_tier(data):
+    """The tier a request body asks for, or None if it names an unknown one"""
+    tier = data.get('tier') or DEFAULT_TIER
+    return tier if tier in MODEL_TIERS else None
+
+def unknown_tier_response(data):
+    return jsonify({'error': f"Unknown tier {data.get('tier')!r}", 'tiers': sorted(MODEL_TIERS)}), 400
+
+# With MODEL_SERVER_SOCKET set, the models live in one model_server.py process shared by every
+# HTTP worker, and use_tts / get_whisper return clients for it instead of loading them here.
+# Both sides must share the secret in MODEL_SERVER_AUTHKEY
+MODEL_SERVER_SOCKET = os.environ.get('MODEL_SERVER_SOCKET')
+_model_clients = {}
+_model_clients_lock = threading.Lock()
+
+def connect_model_server(model=None):
+    """Connect to the model server, waiting for it while it starts up"""
+    authkey = authkey_from_env()
+    deadline = time.monotonic() + float(os.environ.get('MODEL_SERVER_CONNECT_TIMEOUT', 600))
+    while True:
+        try:
+            return ModelClient(MODEL_SERVER_SOCKET, authkey=authkey, model=model)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+def get_whisper():
+    global whisper_model
+    if whisper_model is None:
+        with _whisper_lock:
+            if whisper_model is None and MODEL_SERVER_SOCKET:
+                whisper_model = connect_model_server()
+            elif whisper_model is None:
+                whisper_model = whisper.load_model("base", device=resources.device)
+    return whisper_model
+
+@contextmanager
+def use_tts(tier=None):
+    """Yield the TTS model for a tier; the pool keeps it loaded until the block exits"""
+    key = MODEL_TIERS[tier or DEFAULT_TIER] + (resources.device,)
+    if MODEL_SERVER_SOCKET:
+        with _model_clients_lock:
+            if key not in _model_clients:
+                _model_clients[key] = connect_model_server(model=key)
+        yield _model_clients[key]
+        return
+    with model_pool.acquire(key) as tts_instance:
+        yield tts_instance
+
+def record_prompt_tokens(voice, tts_instance, ref_codes, ref_text):
+    """Store the prompt size of a voice the first time it is encoded"""
+    # Voices registered only through /create_voice_api have no voices row to record it on
+    if 'id' in voice and voice.get('prompt_tokens') is None:
+        db.set_prompt_tokens(voice['id'], tts_instance.count_prompt_tokens(ref_codes, ref_text))
 
 @app.route('/upload_reference', methods=['POST'])
 def upload_reference():
@@ -59,29 +301,32 @@ def upload_reference():
     audio_file.save(temp_path)
     
     try:
-        if temp_path.lower().endswith('.wav'):
-            if os.path.exists(audio_path):
-                os.remove(audio_path)
-            os.rename(temp_path, audio_path)
-        else:
-            audio = AudioSegment.from_file(temp_path)
-            audio = audio.set_channels(1)
-            audio = audio.set_frame_rate(24000)
-            audio.export(audio_path, format="wav")
-            os.remove(temp_path)
-        
-        result = whisper_model.transcribe(audio_path)
-        transcript = result["text"].strip()
+        # Trim silence and keep the best transcribed span; the stored 16 kHz array is what
+        # encode_reference reads, and Whisper takes it directly without decoding the file again
+        ref_wav, transcript = compact_reference(
+            temp_path,
+            audio_path,
+            transcribe=lambda wav: get_whisper().transcribe(wav)["segments"],
+            max_duration_s=REFERENCE_MAX_SECONDS,
+        )
+        os.remove(temp_path)
         
         with open(text_path, 'w') as f:
             f.write(transcript)
         
-        voice_id = db.add_voice(voice_name, audio_path, text_path, is_predefined=False)
+        # Every request for this voice pays for these tokens in prefill
+        with use_tts() as tts_instance:
+            ref_codes = tts_instance.encode_reference(ref_wav)
+            prompt_tokens = tts_instance.count_prompt_tokens(ref_codes, transcript)
+        
+        voice_id = db.add_voice(voice_name, audio_path, text_path, is_predefined=False, prompt_tokens=prompt_tokens)
         
         return jsonify({
             'audio_path': audio_path,
             'text_path': text_path,
             'transcript': transcript,
+            'duration': len(ref_wav) / REFERENCE_SAMPLE_RATE,
+            'prompt_tokens': prompt_tokens,
             'voice_id': voice_id,
             'voice_name': voice_name
         })
@@ -91,133 +336,57 @@ def upload_reference():
             os.remove(temp_path)
         return jsonify({'error': f'Audio processing failed: {str(e)}'}), 500
 
-def chunk_text_by_duration(text, target_duration_seconds=15):
-    """Split text into chunks targeting specific duration (default 15 seconds)
-    
-    This function estimates speech duration and creates chunks that will generate
-    approximately the target duration when converted to speech. It tries to
-    respect sentence boundaries when possible for more natural speech.
-    """
-    import re
-    
-    # Estimate speaking rate: ~2.2 words per second (conservative for TTS)
-    estimated_words_per_second = 2.2
-    target_words_per_chunk = int(target_duration_seconds * estimated_words_per_second)
-    
-    # Split into sentences first
-    sentences = re.split(r'[.!?]+', text)
-    sentences = [s.strip() for s in sentences if s.strip()]
-    
-    chunks = []
-    current_chunk = ""
-    current_word_count = 0
-    
-    for sentence in sentences:
-        sentence_words = len(sentence.split())
-        
-        # If adding this sentence would exceed target, start new chunk
-        if current_word_count + sentence_words > target_words_per_chunk and current_chunk:
-            chunks.append(current_chunk.strip())
-            current_chunk = sentence
-            current_word_count = sentence_words
-        else:
-            # Add sentence to current chunk
-            if current_chunk:
-                current_chunk += ". " + sentence
-            else:
-                current_chunk = sentence
-            current_word_count += sentence_words
-    
-    # Add remaining chunk
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
-    
-    # If no sentence boundaries found or chunks are too large, fall back to word-based splitting
-    if not chunks or any(len(chunk.split()) > target_words_per_chunk * 1.5 for chunk in chunks):
-        words = text.split()
-        chunks = []
-        for i in range(0, len(words), target_words_per_chunk):
-            chunk = ' '.join(words[i:i + target_words_per_chunk])
-            chunks.append(chunk)
-    
-    return chunks
-
 @app.route('/generate_speech', methods=['POST'])
+@admission_controlled('input_text')
 def generate_speech():
     data = request.json
     input_text = data.get('input_text')
     ref_audio_path = data.get('ref_audio_path')
     ref_text_path = data.get('ref_text_path')
+    tier = request_tier(data)
     
     if not all([input_text, ref_audio_path, ref_text_path]):
         return jsonify({'error': 'Missing required parameters'}), 400
+    if tier is None:
+        return unknown_tier_response(data)
     
     try:
         # Read reference text
         with open(ref_text_path, 'r') as f:
             ref_text = f.read().strip()
         
-        # Get TTS instance
-        tts_instance = get_tts()
+        # Get TTS instance for the requested tier
+        with use_tts(tier) as tts_instance:
+            # Encode reference once
+            ref_codes = tts_instance.encode_reference(ref_audio_path)
         
-        # Encode reference once
-        ref_codes = tts_instance.encode_reference(ref_audio_path)
+            # Save as WAV first, then convert to MP3
+            wav_path = "temp_output.wav"
+            output_path = "output.mp3"
         
-        # Check if text needs chunking (split for 15-second segments)
-        word_count = len(input_text.split())
-        estimated_duration = word_count / 2.2  # Conservative estimate
-        
-        if estimated_duration > 15:  # If estimated duration > 15 seconds
-            chunks = chunk_text_by_duration(input_text, target_duration_seconds=15)
-            print(f"Word count: {word_count}, Estimated duration: {estimated_duration:.1f}s, Split into {len(chunks)} chunks")
-            audio_segments = []
-            
-            for i, chunk in enumerate(chunks):
-                print(f"Processing chunk {i+1}: {chunk[:50]}...")
-                wav_chunk = tts_instance.infer(chunk, ref_codes, ref_text)
-                print(f"Chunk {i+1} audio length: {len(wav_chunk)/24000:.2f} seconds")
-                audio_segments.append(wav_chunk)
-                
-                import gc
-                gc.collect()
-                
-                if i < len(chunks) - 1:
-                    silence = np.zeros(int(0.3 * 24000))
-                    audio_segments.append(silence)
-            
-            wav = np.concatenate(audio_segments)
-            print(f"Final audio length: {len(wav)/24000:.2f} seconds")
-        else:
-            wav = tts_instance.infer(input_text, ref_codes, ref_text)
-            print(f"Generated audio length: {len(wav)/24000:.2f} seconds")
-        
-        # Save as WAV first, then convert to MP3
-        wav_path = "temp_output.wav"
-        output_path = "output.mp3"
-        
-        print(f"Saving audio file: {len(wav)} samples, {len(wav)/24000:.2f} seconds")
-        sf.write(wav_path, wav, 24000)
+            cancel = request_cancellation()
+            with cancel_on_disconnect(cancel):
+                synthesize_to_wav(tts_instance, input_text, ref_codes, ref_text, wav_path, cancel=cancel)
         
         # Convert to MP3
-        audio = AudioSegment.from_wav(wav_path)
-        audio.export(output_path, format="mp3", bitrate="192k")
+        convert_wav_to_mp3(wav_path, output_path)
         
         # Clean up temp WAV file
         os.remove(wav_path)
         
         # Verify the saved file
         file_size = os.path.getsize(output_path)
-        print(f"Saved MP3 file size: {file_size} bytes")
-        print("Generation completed successfully!")
+        logger.info(f"Saved MP3 file size: {file_size} bytes")
+        logger.info("Generation completed successfully!")
         
         response = jsonify({'output_path': output_path})
         response.headers['Cache-Control'] = 'no-cache'
         return response
     
+    except Cancelled:
+        raise
     except Exception as e:
-        import traceback
-        print(f"Error in generate_speech: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception(f"Error in generate_speech: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/download/<filename>')
@@ -229,7 +398,7 @@ def generate_unique_voice_id():
     while True:
         # Generate 12-character alphanumeric ID (letters + numbers, including capitals)
         voice_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-        if voice_id not in voice_store:
+        if not db.get_api_voice(voice_id) and not db.get_voice_by_voice_id(voice_id):
             return voice_id
 
 @app.route('/create_voice_api', methods=['POST'])
@@ -261,14 +430,8 @@ def create_voice_api():
         api_key = f"sk_{random_suffix}"
         
         # Store voice data
-        voice_store[voice_id] = {
-            'audio_path': audio_path,
-            'text_path': text_path,
-            'api_key_name': api_key_name,
-            'created_at': datetime.now().isoformat()
-        }
-        
-        api_keys[api_key] = voice_id
+        db.add_api_voice(voice_id, audio_path, text_path, api_key_name)
+        db.add_api_key(api_key, voice_id)
         
         return jsonify({
             'voice_id': voice_id,
@@ -705,6 +868,15 @@ def api_page():
     "voice_id": "{voice_id}",
     "text": "Your text here"
   }}'</pre>
+
+            <h2>Streaming</h2>
+            <pre>curl -N -X POST http://localhost:5000/api/tts/stream \\\n  -H "Authorization: Bearer {api_key}" \\\n  -H "Content-Type: application/json" \\\n  -d '{{
+    "voice_id": "{voice_id}",
+    "text": "Your text here"
+  }}' --output speech.wav</pre>
+
+            <h2>Quality Tiers</h2>
+            <p>Add <code>"tier"</code> to either request to pick a model: {", ".join(sorted(MODEL_TIERS))}. Without it, <code>{DEFAULT_TIER}</code> is used.</p>
         </div>
         
         <script>
@@ -724,10 +896,9 @@ def api_page():
 @app.route('/get_voices', methods=['GET'])
 def get_voices():
     try:
+        # audio_exists is resolved by the catalog when the voice table changes
         voices = db.get_all_voices()
-        for voice in voices:
-            voice['audio_exists'] = os.path.exists(voice['audio_path'])
-        
+
         predefined = [v for v in voices if v['is_predefined']]
         custom = [v for v in voices if not v['is_predefined']]
         
@@ -752,6 +923,8 @@ def delete_voice(voice_id):
             os.remove(voice['audio_path'])
         if os.path.exists(voice['text_path']):
             os.remove(voice['text_path'])
+        if reference_array_path(voice['audio_path']).exists():
+            os.remove(reference_array_path(voice['audio_path']))
         
         db.delete_voice(voice_id)
         return jsonify({'success': True})
@@ -759,13 +932,17 @@ def delete_voice(voice_id):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/generate_speech_with_voice', methods=['POST'])
+@admission_controlled('input_text')
 def generate_speech_with_voice():
     data = request.json
     voice_name = data.get('voice_name')
     input_text = data.get('input_text')
+    tier = request_tier(data)
     
     if not all([voice_name, input_text]):
         return jsonify({'error': 'Missing voice_name or input_text'}), 400
+    if tier is None:
+        return unknown_tier_response(data)
     
     try:
         # Get voice from database
@@ -781,44 +958,22 @@ def generate_speech_with_voice():
         with open(voice['text_path'], 'r') as f:
             ref_text = f.read().strip()
         
-        # Get TTS instance
-        tts_instance = get_tts()
-        
-        # Encode reference once
-        ref_codes = tts_instance.encode_reference(voice['audio_path'])
-        
-        # Check if text needs chunking (split for 15-second segments)
-        word_count = len(input_text.split())
-        estimated_duration = word_count / 2.2  # Conservative estimate
-        
-        if estimated_duration > 15:  # If estimated duration > 15 seconds
-            chunks = chunk_text_by_duration(input_text, target_duration_seconds=15)
-            audio_segments = []
-            
-            for i, chunk in enumerate(chunks):
-                wav_chunk = tts_instance.infer(chunk, ref_codes, ref_text)
-                audio_segments.append(wav_chunk)
-                
-                import gc
-                gc.collect()
-                
-                if i < len(chunks) - 1:
-                    silence = np.zeros(int(0.3 * 24000))
-                    audio_segments.append(silence)
-            
-            wav = np.concatenate(audio_segments)
-        else:
-            wav = tts_instance.infer(input_text, ref_codes, ref_text)
+        # Get TTS instance for the requested tier
+        with use_tts(tier) as tts_instance:
+            # Encode reference once
+            ref_codes = tts_instance.encode_reference(voice['audio_path'])
+            record_prompt_tokens(voice, tts_instance, ref_codes, ref_text)
         
-        # Save output
-        output_path = "output.mp3"
-        wav_path = "temp_output.wav"
+            # Save output
+            output_path = "output.mp3"
+            wav_path = "temp_output.wav"
         
-        sf.write(wav_path, wav, 24000)
+            cancel = request_cancellation()
+            with cancel_on_disconnect(cancel):
+                synthesize_to_wav(tts_instance, input_text, ref_codes, ref_text, wav_path, cancel=cancel)
         
         # Convert to MP3
-        audio = AudioSegment.from_wav(wav_path)
-        audio.export(output_path, format="mp3", bitrate="192k")
+        convert_wav_to_mp3(wav_path, output_path)
         
         os.remove(wav_path)
         
@@ -826,10 +981,10 @@ def generate_speech_with_voice():
         response.headers['Cache-Control'] = 'no-cache'
         return response
     
+    except Cancelled:
+        raise
     except Exception as e:
-        import traceback
-        print(f"Error in generate_speech_with_voice: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception(f"Error in generate_speech_with_voice: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/tts', methods=['POST'])
@@ -838,12 +993,15 @@ def api_tts():
     voice_id = data.get('voice_id')
     input_text = data.get('text')
     output_dir = data.get('output_dir', 'api_outputs')
+    tier = request_tier(data)
     
     if not voice_id or not input_text:
         return jsonify({'error': 'Missing voice_id or text parameter'}), 400
+    if tier is None:
+        return unknown_tier_response(data)
     
     try:
-        voice = db.get_voice_by_voice_id(voice_id)
+        voice = db.get_voice_by_voice_id(voice_id) or db.get_api_voice(voice_id)
         if not voice:
             return jsonify({'error': 'Voice not found'}), 404
         
@@ -855,60 +1013,184 @@ def api_tts():
         with open(voice['text_path'], 'r') as f:
             ref_text = f.read().strip()
         
-        tts_instance = get_tts()
-        ref_codes = tts_instance.encode_reference(voice['audio_path'])
-        
-        word_count = len(input_text.split())
-        estimated_duration = word_count / 2.2
-        
-        if estimated_duration > 15:
-            chunks = chunk_text_by_duration(input_text, target_duration_seconds=15)
-            audio_segments = []
-            
-            for i, chunk in enumerate(chunks):
-                wav_chunk = tts_instance.infer(chunk, ref_codes, ref_text)
-                audio_segments.append(wav_chunk)
+        # The shared work is cancelled only once every request waiting for it has been
+        def synthesize(flight_cancel):
+            key = admission_key()
+            with admission_slot(key, input_text, admission_weight(key, tier)), use_tts(tier) as tts_instance:
+                ref_codes = tts_instance.encode_reference(voice['audio_path'])
+                record_prompt_tokens(voice, tts_instance, ref_codes, ref_text)
                 
-                import gc
-                gc.collect()
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                output_filename = f"tts_output_{timestamp}.wav"
+                output_path = os.path.join(output_dir, output_filename)
                 
-                if i < len(chunks) - 1:
-                    silence = np.zeros(int(0.3 * 24000))
-                    audio_segments.append(silence)
-            
-            wav = np.concatenate(audio_segments)
-        else:
-            wav = tts_instance.infer(input_text, ref_codes, ref_text)
+                synthesize_to_wav(tts_instance, input_text, ref_codes, ref_text, output_path, cancel=flight_cancel)
+                return output_path
         
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_filename = f"tts_output_{timestamp}.wav"
-        output_path = os.path.join(output_dir, output_filename)
-        
-        sf.write(output_path, wav, 24000)
+        cancel = request_cancellation()
+        with cancel_on_disconnect(cancel):
+            output_path, shared = flights.do(
+                synthesis_key('wav', tier, voice, ref_text, input_text), synthesize, cancel=cancel
+            )
+        if shared:
+            SINGLEFLIGHT_SHARED.labels(kind='wav').inc()
+            logger.info(f"Joined an identical in-flight request for voice {voice_id}")
+            if os.path.abspath(os.path.dirname(output_path)) != os.path.abspath(output_dir):
+                shared_path = output_path
+                output_path = os.path.join(output_dir, os.path.basename(shared_path))
+                shutil.copyfile(shared_path, output_path)
         
         return jsonify({
             'success': True,
             'audio_path': output_path,
             'audio_url': f'http://localhost:5000/download/{output_path}',
             'voice_id': voice_id,
+            'tier': tier,
             'output_directory': output_dir
         })
     
+    except (AdmissionRejected, Cancelled):
+        raise
     except Exception as e:
-        import traceback
-        print(f"Error in api_tts: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception(f"Error in api_tts: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-if __name__ == '__main__':
-    # Load existing voice data if available
-    if os.path.exists('voice_store.json'):
-        try:
-            with open('voice_store.json', 'r') as f:
-                stored_data = json.load(f)
-                voice_store.update(stored_data.get('voices', {}))
-                api_keys.update(stored_data.get('api_keys', {}))
-        except:
-            pass
+@app.route('/api/tts/stream', methods=['POST'])
+def api_tts_stream():
+    """Stream 16-bit WAV as it is generated; identical concurrent requests share one generation"""
+    data = request.json
+    voice_id = data.get('voice_id')
+    input_text = data.get('text')
+    tier = request_tier(data)
     
+    if not voice_id or not input_text:
+        return jsonify({'error': 'Missing voice_id or text parameter'}), 400
+    if tier is None:
+        return unknown_tier_response(data)
+    
+    try:
+        voice = db.get_voice_by_voice_id(voice_id) or db.get_api_voice(voice_id)
+        if not voice:
+            return jsonify({'error': 'Voice not found'}), 404
+        
+        if not os.path.exists(voice['audio_path']):
+            return jsonify({'error': 'Voice audio file not found'}), 404
+        
+        with open(voice['text_path'], 'r') as f:
+            ref_text = f.read().strip()
+        
+        # Generation runs on the stream's own thread, outside this request
+        key = admission_key()
+        weight = admission_weight(key, tier)
+        
+        def generate(flight_cancel):
+            with admission_slot(key, input_text, weight), use_tts(tier) as tts_instance:
+                ref_codes = tts_instance.encode_reference(voice['audio_path'])
+                record_prompt_tokens(voice, tts_instance, ref_codes, ref_text)
+                yield from tts_instance.infer_stream(input_text, ref_codes, ref_text, cancel=flight_cancel)
+        
+        # A request joining mid-stream is replayed the chunks sent so far, then follows live.
+        # Its token is cancelled when it stops reading, i.e. when the client disconnects
+        cancel = request_cancellation()
+        chunks, shared = flights.stream(
+            synthesis_key('stream', tier, voice, ref_text, input_text), generate, cancel=cancel
+        )
+        if shared:
+            SINGLEFLIGHT_SHARED.labels(kind='stream').inc()
+            logger.info(f"Joined an identical in-flight stream for voice {voice_id}")
+        
+        # Wait for the first chunk here, so admission and model errors still get a status code
+        with cancel_on_disconnect(cancel):
+            first_chunk = next(chunks, None)
+        
+        def body():
+            cancelled = 'disconnected'
+            try:
+                # Generation has the model loaded by now, so this does not load it again
+                with use_tts(tier) as tts_instance:
+                    sample_rate = tts_instance.sample_rate
+                yield wav_stream_header(sample_rate)
+                if first_chunk is not None:
+                    yield pcm16_bytes(first_chunk)
+                for chunk in chunks:
+                    yield pcm16_bytes(chunk)
+                cancelled = None
+            except Cancelled as e:
+                # The headers are out, so the stream just ends early
+                cancelled = e.reason
+            except Exception:
+                cancelled = None
+                raise
+            finally:
+                # Leaving the stream; generation stops once every listener has
+                chunks.close()
+                if cancelled:
+                    SYNTHESIS_CANCELLED.labels(reason=cancelled).inc()
+        
+        return Response(body(), mimetype='audio/wav', headers={'Cache-Control': 'no-cache'})
+    
+    except (AdmissionRejected, Cancelled):
+        raise
+    except Exception as e:
+        logger.exception(f"Error in api_tts_stream: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+WARMUP_TEXT = "Hello, this is a short warmup sentence."
+
+def warm_up_models():
+    """Load Whisper and the default tier's model and run each predefined voice through it once
+
+    Other tiers load on their first request.
+    """
+    start = time.perf_counter()
+    try:
+        readiness['status'] = 'loading'
+        whisper_instance = get_whisper()
+        with use_tts() as tts_instance:
+            readiness['status'] = 'warming'
+            whisper_instance.transcribe(np.zeros(REFERENCE_SAMPLE_RATE, dtype=np.float32))
+        
+            if os.environ.get('WARMUP_INFERENCE', '1') != '0':
+                streamed = False
+                for voice in db.get_all_voices():
+                    if not voice['is_predefined'] or not voice['audio_exists']:
+                        continue
+                    with open(voice['text_path'], 'r') as f:
+                        ref_text = f.read().strip()
+                
+                    # Builds the reference's cached 16 kHz array and records its prompt size
+                    ref_codes = tts_instance.encode_reference(voice['audio_path'])
+                    record_prompt_tokens(voice, tts_instance, ref_codes, ref_text)
+                    tts_instance.infer(WARMUP_TEXT, ref_codes, ref_text)
+                
+                    if not streamed:
+                        try:
+                            for _ in tts_instance.infer_stream(WARMUP_TEXT, ref_codes, ref_text):
+                                pass
+                        except NotImplementedError:
+                            pass
+                        streamed = True
+        
+        readiness['status'] = 'ready'
+        logger.info(f"Models loaded and warm in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        readiness.update(status='failed', error=str(e))
+        logger.exception(f"Model warmup failed: {str(e)}")
+
+@app.route('/healthz')
+def healthz():
+    # Only a failed load is unrecoverable; loading and warming are healthy
+    if readiness['status'] == 'failed':
+        return jsonify(readiness), 500
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    return jsonify(readiness), 200 if readiness['status'] == 'ready' else 503
+
+# Skip the Werkzeug reloader's watcher process, which never serves requests
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    threading.Thread(target=warm_up_models, name='model-warmup', daemon=True).start()
+
+if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
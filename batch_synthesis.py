@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import queue
+import time
+from collections import defaultdict
+from multiprocessing import get_context
+from database import VoiceDatabase
+from neuttsair.neutts import NeuTTSAir
+from neuttsair.resources import ResourceConfig
+from synthesis import convert_wav_to_mp3, synthesize_to_wav
+
+# Per-worker state, set up once by _init_worker
+_tts = None
+_ref_codes = {}
+
+def item_key(item):
+    """Identify a manifest item by its content, so edited items are re-synthesized"""
+    payload = json.dumps([item['voice'], item['text'], item['output']])
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+def resolve_voice(db, voice):
+    """Map a voice name, voice_id or reference .wav path to (audio_path, ref_text)"""
+    record = db.get_voice_by_name(voice) or db.get_voice_by_voice_id(voice)
+    if record:
+        audio_path, text_path = record['audio_path'], record['text_path']
+    else:
+        audio_path, text_path = voice, os.path.splitext(voice)[0] + '.txt'
+
+    if not os.path.exists(audio_path) or not os.path.exists(text_path):
+        raise FileNotFoundError(f"Voice '{voice}' not found in the database or as a .wav/.txt pair")
+    with open(text_path, 'r') as f:
+        return audio_path, f.read().strip()
+
+def load_manifest(manifest_path):
+    items = []
+    with open(manifest_path, 'r') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            missing = {'voice', 'text', 'output'} - item.keys()
+            if missing:
+                raise ValueError(f"{manifest_path}:{line_no} is missing {sorted(missing)}")
+            items.append(item)
+    return items
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path, 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return {entry['key']: entry['output'] for entry in entries}
+
+def write_atomic(tts_instance, text, ref_codes, ref_text, output_path):
+    """Synthesize to a temporary file beside output_path and rename it into place"""
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    base, ext = os.path.splitext(output_path)
+    tmp_wav = f"{base}.tmp.wav"
+
+    duration = synthesize_to_wav(tts_instance, text, ref_codes, ref_text, tmp_wav)
+    if ext.lower() == '.mp3':
+        tmp_mp3 = f"{base}.tmp.mp3"
+        convert_wav_to_mp3(tmp_wav, tmp_mp3)
+        os.remove(tmp_wav)
+        os.replace(tmp_mp3, output_path)
+    else:
+        os.replace(tmp_wav, output_path)
+    return duration
+
+def _init_worker(backbone_repo, backbone_device, codec_repo, codec_device, worker_resources):
+    global _tts
+    # Each worker takes the next free slice of the CPU budget
+    try:
+        resources = worker_resources.get_nowait()
+    except queue.Empty:
+        # A replacement for a crashed worker; its slice is still taken
+        resources = ResourceConfig(num_threads=1)
+    resources.apply()
+    _tts = NeuTTSAir(
+        backbone_repo=backbone_repo,
+        backbone_device=backbone_device,
+        codec_repo=codec_repo,
+        codec_device=codec_device,
+        resources=resources,
+    )
+
+def _synthesize_group(task):
+    """Synthesize a batch of items sharing one voice, encoding its reference once per worker"""
+    audio_path, ref_text, items = task
+    try:
+        if audio_path not in _ref_codes:
+            _ref_codes[audio_path] = _tts.encode_reference(audio_path)
+    except Exception as e:
+        # A bad reference fails its own items, not the run
+        return [{'key': key, 'output': item['output'], 'error': f"Reference {audio_path}: {str(e)}"}
+                for key, item in items]
+    ref_codes = _ref_codes[audio_path]
+
+    results = []
+    for key, item in items:
+        start = time.perf_counter()
+        try:
+            duration = write_atomic(_tts, item['text'], ref_codes, ref_text, item['output'])
+            results.append({'key': key, 'output': item['output'], 'audio_s': duration,
+                            'synth_s': time.perf_counter() - start})
+        except Exception as e:
+            results.append({'key': key, 'output': item['output'], 'error': str(e)})
+    return results
+
+def main(manifest_path, backbone_repo, backbone_device, codec_repo, codec_device,
+         num_workers=1, group_size=8, checkpoint_path=None):
+    checkpoint_path = checkpoint_path or f"{manifest_path}.progress"
+    items = load_manifest(manifest_path)
+    done = load_checkpoint(checkpoint_path)
+
+    # Group pending items by voice so each worker encodes a reference once per group
+    db = VoiceDatabase()
+    groups = defaultdict(list)
+    n_skipped = 0
+    for item in items:
+        key = item_key(item)
+        if done.get(key) == item['output'] and os.path.exists(item['output']):
+            n_skipped += 1
+            continue
+        groups[item['voice']].append((key, item))
+
+    tasks = []
+    unresolved = []
+    for voice, voice_items in groups.items():
+        try:
+            audio_path, ref_text = resolve_voice(db, voice)
+        except FileNotFoundError as e:
+            unresolved += [{'key': key, 'output': item['output'], 'error': str(e)} for key, item in voice_items]
+            continue
+        for start in range(0, len(voice_items), group_size):
+            tasks.append((audio_path, ref_text, voice_items[start:start + group_size]))
+
+    n_pending = sum(len(voice_items) for voice_items in groups.values())
+    print(f"{len(items)} items: {n_skipped} already done, {n_pending} to synthesize in {len(tasks)} groups")
+
+    n_done, n_failed, audio_s = 0, 0, 0.0
+    for result in unresolved:
+        n_failed += 1
+        print(f"Failed {result['output']}: {result['error']}")
+    start = time.perf_counter()
+    ctx = get_context('spawn')
+    worker_resources = ctx.Queue()
+    for part in ResourceConfig.from_env().split(num_workers):
+        worker_resources.put(part)
+
+    with ctx.Pool(num_workers, initializer=_init_worker,
+                  initargs=(backbone_repo, backbone_device, codec_repo, codec_device, worker_resources)) as pool, \
+         open(checkpoint_path, 'a') as checkpoint:
+        for results in pool.imap_unordered(_synthesize_group, tasks):
+            for result in results:
+                if 'error' in result:
+                    n_failed += 1
+                    print(f"Failed {result['output']}: {result['error']}")
+                    continue
+                # Checkpoint only after the output has been renamed into place
+                checkpoint.write(json.dumps({'key': result['key'], 'output': result['output']}) + '\n')
+                checkpoint.flush()
+                n_done += 1
+                audio_s += result['audio_s']
+
+            elapsed = time.perf_counter() - start
+            print(f"[{n_done + n_failed}/{n_pending}] {n_done / elapsed:.2f} items/s, "
+                  f"{audio_s / elapsed:.2f}s audio per second")
+
+    elapsed = time.perf_counter() - start
+    print(f"Done: {n_done} synthesized, {n_failed} failed, {n_skipped} skipped in {elapsed:.1f}s")
+    if elapsed > 0 and n_done:
+        print(f"Throughput: {n_done / elapsed:.2f} items/s, {audio_s:.1f}s audio "
+              f"({audio_s / elapsed:.2f}x real time) across {num_workers} workers")
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Batch synthesis from a JSONL manifest of {voice, text, output} items")
+    parser.add_argument('manifest', type=str, help="JSONL manifest; voice is a voice name, voice_id or .wav path")
+    parser.add_argument('--backbone', type=str, default="neuphonic/neutts-air-q4-gguf", help="Backbone repo")
+    parser.add_argument('--backbone_device', type=str, default="auto", help="Backbone device")
+    parser.add_argument('--codec', type=str, default="neuphonic/neucodec", help="Codec repo")
+    parser.add_argument('--codec_device', type=str, default="auto", help="Codec device")
+    parser.add_argument('--num_workers', type=int, default=1, help="Worker processes, each with its own model")
+    parser.add_argument('--group_size', type=int, default=8, help="Items per task sharing one voice")
+    parser.add_argument('--checkpoint', type=str, default=None, help="Progress file (default: <manifest>.progress)")
+    args = parser.parse_args()
+
+    main(
+        manifest_path=args.manifest,
+        backbone_repo=args.backbone,
+        backbone_device=args.backbone_device,
+        codec_repo=args.codec,
+        codec_device=args.codec_device,
+        num_workers=args.num_workers,
+        group_size=args.group_size,
+        checkpoint_path=args.checkpoint,
+    )
@@ -1,48 +1,180 @@
 import sqlite3
 import os
+import json
+import threading
 from datetime import datetime
 import random
 import string
 
+VOICE_COLUMNS = "id, name, audio_path, text_path, voice_id, is_predefined, prompt_tokens, created_at"
+
+# Tables whose changes bump their cache_versions stamp, so every process can see them
+VERSIONED_TABLES = ('voices', 'voice_store', 'api_keys')
+
+class VersionedCache:
+    """Small read-through cache that empties itself when a table's version stamp changes
+    
+    Each lookup costs one single-row read of cache_versions; a hit then skips the
+    table query. Writes from any process or connection bump the stamp through
+    triggers, so stale entries are never served.
+    """
+    
+    def __init__(self, db, table, max_size=4096):
+        self.db = db
+        self.table = table
+        self.max_size = max_size
+        self._entries = {}
+        self._version = None
+        self._lock = threading.Lock()
+    
+    def get(self, key, load):
+        version = self.db.get_cache_version(self.table)
+        with self._lock:
+            if version != self._version:
+                self._entries = {}
+                self._version = version
+            if key in self._entries:
+                return self._entries[key]
+        
+        value = load(key)
+        with self._lock:
+            if version == self._version:
+                if len(self._entries) >= self.max_size:
+                    # Evict the oldest insertion; dicts keep insertion order
+                    self._entries.pop(next(iter(self._entries)))
+                self._entries[key] = value
+        return value
+
+class VoiceCatalog:
+    """Immutable in-process snapshot of the voices table
+    
+    Built once per catalog version and indexed by id, name and voice_id so
+    lookups on the synthesis path are dictionary hits. Whether each voice's
+    audio file exists is resolved when the snapshot is built.
+    """
+    
+    def __init__(self, voices, version):
+        self.version = version
+        self.voices = voices
+        self.by_id = {voice['id']: voice for voice in voices}
+        self.by_name = {voice['name']: voice for voice in voices}
+        self.by_voice_id = {voice['voice_id']: voice for voice in voices if voice['voice_id']}
+
 class VoiceDatabase:
     def __init__(self, db_path="voices.db"):
         self.db_path = db_path
+        self._local = threading.local()
+        self._catalog = None
+        self._catalog_lock = threading.Lock()
+        self._api_keys_cache = VersionedCache(self, 'api_keys')
+        self._voice_store_cache = VersionedCache(self, 'voice_store')
         self.init_database()
         self.migrate_database()
         self.setup_predefined_voices()
     
+    def _connect(self):
+        """Return this thread's persistent connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # WAL lets readers on the request path proceed while a writer commits;
+            # NORMAL sync is durable across app crashes and only fsyncs at checkpoints
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+    
+    def close(self):
+        """Close the calling thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
+    @staticmethod
+    def _row_to_voice(row):
+        if row is None:
+            return None
+        voice = dict(row)
+        voice['is_predefined'] = bool(voice['is_predefined'])
+        return voice
+    
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS voices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                audio_path TEXT NOT NULL,
-                text_path TEXT NOT NULL,
-                is_predefined BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS voices (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL,
+                    audio_path TEXT NOT NULL,
+                    text_path TEXT NOT NULL,
+                    is_predefined BOOLEAN DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
     
     def migrate_database(self):
         """Handle database migrations"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._connect()
         
         # Check if voice_id column exists
-        cursor.execute("PRAGMA table_info(voices)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'voice_id' not in columns:
-            cursor.execute('ALTER TABLE voices ADD COLUMN voice_id TEXT')
-            conn.commit()
+        columns = [column['name'] for column in conn.execute("PRAGMA table_info(voices)")]
         
-        conn.close()
+        with conn:
+            if 'voice_id' not in columns:
+                conn.execute('ALTER TABLE voices ADD COLUMN voice_id TEXT')
+            
+            # Prompt tokens the reference occupies, recorded when it is first encoded
+            if 'prompt_tokens' not in columns:
+                conn.execute('ALTER TABLE voices ADD COLUMN prompt_tokens INTEGER')
+            
+            # voice_id is looked up on every /api/tts request
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_voices_voice_id ON voices(voice_id)')
+            
+            # Version stamps let every worker process detect changes with a single-row read
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Voices and API keys issued through /create_voice_api
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS voice_store (
+                    voice_id TEXT PRIMARY KEY,
+                    audio_path TEXT NOT NULL,
+                    text_path TEXT NOT NULL,
+                    api_key_name TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS api_keys (
+                    api_key TEXT PRIMARY KEY,
+                    voice_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_api_keys_voice_id ON api_keys(voice_id)')
+            
+            # Share of inference slots a key gets under contention, relative to the default of 1
+            api_key_columns = [column['name'] for column in conn.execute("PRAGMA table_info(api_keys)")]
+            if 'weight' not in api_key_columns:
+                conn.execute('ALTER TABLE api_keys ADD COLUMN weight REAL NOT NULL DEFAULT 1.0')
+            
+            for table in VERSIONED_TABLES:
+                conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES (?, 0)", (table,))
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    conn.execute(f'''
+                        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                        AFTER {event} ON {table}
+                        BEGIN
+                            UPDATE cache_versions SET version = version + 1 WHERE name = '{table}';
+                        END
+                    ''')
     
     def generate_voice_id(self):
         """Generate a unique 12-character alphanumeric voice ID"""
@@ -55,143 +187,167 @@ class VoiceDatabase:
             {"name": "Christine", "audio_path": "samples/christine.wav", "text_path": "samples/christine.txt"}
         ]
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._connect()
         
-        for voice in predefined_voices:
-            # Check if voice already exists
-            cursor.execute('SELECT id, voice_id FROM voices WHERE name = ?', (voice["name"],))
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Voice exists, check if it has voice_id
-                if not existing[1]:  # No voice_id
+        with conn:
+            for voice in predefined_voices:
+                # Check if voice already exists
+                existing = conn.execute('SELECT id, voice_id FROM voices WHERE name = ?', (voice["name"],)).fetchone()
+                
+                if existing:
+                    # Voice exists, check if it has voice_id
+                    if not existing['voice_id']:
+                        voice_id = self.generate_voice_id()
+                        conn.execute('UPDATE voices SET voice_id = ? WHERE name = ?', (voice_id, voice["name"]))
+                else:
+                    # Voice doesn't exist, create it
                     voice_id = self.generate_voice_id()
-                    cursor.execute('UPDATE voices SET voice_id = ? WHERE name = ?', (voice_id, voice["name"]))
-            else:
-                # Voice doesn't exist, create it
-                voice_id = self.generate_voice_id()
-                cursor.execute('''
-                    INSERT INTO voices (name, audio_path, text_path, voice_id, is_predefined)
-                    VALUES (?, ?, ?, ?, 1)
-                ''', (voice["name"], voice["audio_path"], voice["text_path"], voice_id))
-        
-        conn.commit()
-        conn.close()
+                    conn.execute('''
+                        INSERT INTO voices (name, audio_path, text_path, voice_id, is_predefined)
+                        VALUES (?, ?, ?, ?, 1)
+                    ''', (voice["name"], voice["audio_path"], voice["text_path"], voice_id))
     
-    def get_all_voices(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, name, audio_path, text_path, voice_id, is_predefined, created_at
-            FROM voices ORDER BY is_predefined DESC, name
-        ''')
+    def get_cache_version(self, name):
+        row = self._connect().execute(
+            'SELECT version FROM cache_versions WHERE name = ?', (name,)
+        ).fetchone()
+        return row['version'] if row else 0
+    
+    def _build_catalog(self):
+        conn = self._connect()
+        # Read the stamp and the rows from one snapshot so they always agree
+        with conn:
+            conn.execute('BEGIN')
+            version = self.get_cache_version('voices')
+            rows = conn.execute(f'''
+                SELECT {VOICE_COLUMNS}
+                FROM voices ORDER BY is_predefined DESC, name
+            ''').fetchall()
         
         voices = []
-        for row in cursor.fetchall():
-            voices.append({
-                "id": row[0],
-                "name": row[1],
-                "audio_path": row[2],
-                "text_path": row[3],
-                "voice_id": row[4],
-                "is_predefined": bool(row[5]),
-                "created_at": row[6]
-            })
+        for row in rows:
+            voice = self._row_to_voice(row)
+            voice['audio_exists'] = os.path.exists(voice['audio_path'])
+            voices.append(voice)
+        return VoiceCatalog(voices, version)
+    
+    def get_catalog(self):
+        """Return the current voice catalog, rebuilding it if any process changed the table"""
+        version = self.get_cache_version('voices')
+        catalog = self._catalog
+        if catalog is not None and catalog.version == version:
+            return catalog
         
-        conn.close()
-        return voices
+        with self._catalog_lock:
+            catalog = self._catalog
+            if catalog is None or catalog.version != version:
+                catalog = self._build_catalog()
+                self._catalog = catalog
+            return catalog
+    
+    def invalidate_catalog(self):
+        """Drop the cached catalog, e.g. after voice files were added or removed on disk"""
+        self._catalog = None
+    
+    def get_all_voices(self):
+        return [dict(voice) for voice in self.get_catalog().voices]
     
     def get_voice_by_name(self, name):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, name, audio_path, text_path, voice_id, is_predefined, created_at
-            FROM voices WHERE name = ?
-        ''', (name,))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            return {
-                "id": row[0],
-                "name": row[1],
-                "audio_path": row[2],
-                "text_path": row[3],
-                "voice_id": row[4],
-                "is_predefined": bool(row[5]),
-                "created_at": row[6]
-            }
-        return None
-    
-    def add_voice(self, name, audio_path, text_path, is_predefined=False):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        voice = self.get_catalog().by_name.get(name)
+        return dict(voice) if voice else None
+    
+    def add_voice(self, name, audio_path, text_path, is_predefined=False, prompt_tokens=None):
+        conn = self._connect()
         voice_id = self.generate_voice_id()
-        cursor.execute('''
-            INSERT INTO voices (name, audio_path, text_path, voice_id, is_predefined)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (name, audio_path, text_path, voice_id, is_predefined))
-        
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('''
+                INSERT INTO voices (name, audio_path, text_path, voice_id, is_predefined, prompt_tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (name, audio_path, text_path, voice_id, is_predefined, prompt_tokens))
+        self.invalidate_catalog()
         return voice_id
     
+    def set_prompt_tokens(self, id, prompt_tokens):
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE voices SET prompt_tokens = ? WHERE id = ?', (prompt_tokens, id))
+        self.invalidate_catalog()
+    
     def get_voice_by_id(self, voice_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, name, audio_path, text_path, voice_id, is_predefined, created_at
-            FROM voices WHERE id = ?
-        ''', (voice_id,))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            return {
-                "id": row[0],
-                "name": row[1],
-                "audio_path": row[2],
-                "text_path": row[3],
-                "voice_id": row[4],
-                "is_predefined": bool(row[5]),
-                "created_at": row[6]
-            }
-        return None
+        voice = self.get_catalog().by_id.get(voice_id)
+        return dict(voice) if voice else None
     
     def delete_voice(self, voice_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM voices WHERE id = ?', (voice_id,))
-        conn.commit()
-        conn.close()
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM voices WHERE id = ?', (voice_id,))
+        self.invalidate_catalog()
     
     def get_voice_by_voice_id(self, voice_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        voice = self.get_catalog().by_voice_id.get(voice_id)
+        return dict(voice) if voice else None
+    
+    def add_api_voice(self, voice_id, audio_path, text_path, api_key_name):
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO voice_store (voice_id, audio_path, text_path, api_key_name)
+                VALUES (?, ?, ?, ?)
+            ''', (voice_id, audio_path, text_path, api_key_name))
+    
+    def get_api_voice(self, voice_id):
+        def load(voice_id):
+            row = self._connect().execute(
+                'SELECT voice_id, audio_path, text_path, api_key_name, created_at FROM voice_store WHERE voice_id = ?',
+                (voice_id,)
+            ).fetchone()
+            return dict(row) if row else None
         
-        cursor.execute('''
-            SELECT id, name, audio_path, text_path, voice_id, is_predefined, created_at
-            FROM voices WHERE voice_id = ?
-        ''', (voice_id,))
+        voice = self._voice_store_cache.get(voice_id, load)
+        return dict(voice) if voice else None
+    
+    def add_api_key(self, api_key, voice_id):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT INTO api_keys (api_key, voice_id) VALUES (?, ?)', (api_key, voice_id))
+    
+    def _get_api_key(self, api_key):
+        def load(api_key):
+            row = self._connect().execute(
+                'SELECT voice_id, weight FROM api_keys WHERE api_key = ?', (api_key,)
+            ).fetchone()
+            return dict(row) if row else None
         
-        row = cursor.fetchone()
-        conn.close()
+        return self._api_keys_cache.get(api_key, load)
+    
+    def get_api_key_voice_id(self, api_key):
+        """Return the voice_id an API key was issued for, or None for unknown keys"""
+        row = self._get_api_key(api_key)
+        return row['voice_id'] if row else None
+    
+    def get_api_key_weight(self, api_key):
+        """Return an API key's fair-queueing weight, or None for unknown keys"""
+        row = self._get_api_key(api_key)
+        return row['weight'] if row else None
+    
+    def set_api_key_weight(self, api_key, weight):
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE api_keys SET weight = ? WHERE api_key = ?', (weight, api_key))
+    
+    def import_voice_store_json(self, path):
+        """Import voices and keys from the legacy voice_store.json, keeping existing rows"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            stored_data = json.load(f)
         
-        if row:
-            return {
-                "id": row[0],
-                "name": row[1],
-                "audio_path": row[2],
-                "text_path": row[3],
-                "voice_id": row[4],
-                "is_predefined": bool(row[5]),
-                "created_at": row[6]
-            }
-        return None
\ No newline at end of file
+        conn = self._connect()
+        with conn:
+            for voice_id, voice in stored_data.get('voices', {}).items():
+                conn.execute('''
+                    INSERT OR IGNORE INTO voice_store (voice_id, audio_path, text_path, api_key_name, created_at)
+                    VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                ''', (voice_id, voice['audio_path'], voice['text_path'], voice.get('api_key_name'), voice.get('created_at')))
+            for api_key, voice_id in stored_data.get('api_keys', {}).items():
+                conn.execute('INSERT OR IGNORE INTO api_keys (api_key, voice_id) VALUES (?, ?)', (api_key, voice_id))
@@ -0,0 +1,276 @@
+# Benchmarks every backbone x codec combination on a fixed text corpus and the bundled
+# sample voices, and writes prefill time, tokens/sec, real-time factor, time to first
+# streamed chunk and peak RSS as JSON. Each combination runs in a fresh process so peak
+# RSS and load time are attributable to that combination alone.
+
+import json
+import os
+import platform
+import re
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+import torch
+from neuttsair.profiling import peak_rss_mb
+
+
+BACKBONES = [
+    "neuphonic/neutts-air",
+    "neuphonic/neutts-air-q4-gguf",
+    "neuphonic/neutts-air-q8-gguf",
+]
+CODECS = [
+    "neuphonic/neucodec",
+    "neuphonic/distill-neucodec",
+    "neuphonic/neucodec-onnx-decoder",
+]
+STANDIN_BACKBONES = ["standin/backbone", "standin/backbone-gguf"]
+STANDIN_CODECS = ["standin/codec", "standin/codec-onnx"]
+
+CORPUS = [
+    "Hello there, how are you today?",
+    "The quick brown fox jumps over the lazy dog, and then it runs away into the forest.",
+    "Please remember to bring your umbrella tomorrow, because the forecast says it will rain all afternoon.",
+    (
+        "In the early morning light, the harbour was quiet except for the gulls. "
+        "Fishermen checked their nets, and a single ferry waited by the pier for its first passengers of the day."
+    ),
+]
+
+_SPEECH_TOKEN_RE = re.compile(r"<\|speech_\d+\|>")
+
+
+def find_voices(samples_dir: str, names: list[str] | None = None) -> list[dict]:
+    voices = []
+    for audio_path in sorted(Path(samples_dir).glob("*.wav")):
+        text_path = audio_path.with_suffix(".txt")
+        if not text_path.exists() or (names and audio_path.stem not in names):
+            continue
+        codes_path = audio_path.with_suffix(".pt")
+        voices.append({
+            "name": audio_path.stem,
+            "audio_path": str(audio_path),
+            "ref_text": text_path.read_text().strip(),
+            "codes_path": str(codes_path) if codes_path.exists() else None,
+        })
+    return voices
+
+
+def _load_tts(backbone: str, codec: str, device: str):
+    if backbone.startswith("standin/"):
+        from examples.standin_models import StandInNeuTTSAir
+
+        return StandInNeuTTSAir(backbone, device, codec, device)
+
+    from neuttsair.neutts import NeuTTSAir
+
+    return NeuTTSAir(backbone, device, codec, device)
+
+
+def _reference_codes(tts, voice: dict):
+    # Onnx codecs only decode, so they need a pre-encoded reference
+    if tts._is_onnx_codec:
+        return torch.load(voice["codes_path"]) if voice["codes_path"] else None
+    return tts.encode_reference(voice["audio_path"])
+
+
+def _measure_prefill(tts, ref_codes, ref_text: str, text: str) -> float:
+    if tts._is_quantized_model:
+        # Time to the first generated token, i.e. prompt evaluation plus one decode step
+        prompt = tts._build_ggml_prompt(ref_codes, ref_text, text)
+        if hasattr(tts.backbone, "reset"):
+            tts.backbone.reset()
+        start = time.perf_counter()
+        tts.backbone(prompt, max_tokens=1, temperature=1.0, top_k=50)
+        return time.perf_counter() - start
+
+    prompt_ids = tts._apply_chat_template(ref_codes, ref_text, text)
+    prompt_tensor = torch.tensor(prompt_ids).unsqueeze(0).to(tts.backbone.device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        tts.backbone(prompt_tensor, use_cache=True)
+    return time.perf_counter() - start
+
+
+def _run_once(tts, ref_codes, ref_text: str, text: str) -> dict:
+    prefill_s = _measure_prefill(tts, ref_codes, ref_text, text)
+
+    # Mirrors NeuTTSAir.infer with the generation and decode stages timed separately
+    if hasattr(tts.backbone, "reset"):
+        tts.backbone.reset()
+    start = time.perf_counter()
+    if tts._is_quantized_model:
+        output_str = tts._infer_ggml(ref_codes, ref_text, text)
+    else:
+        output_str = tts._infer_torch(tts._apply_chat_template(ref_codes, ref_text, text))
+    generate_s = time.perf_counter() - start
+    wav = tts._decode(output_str)
+    wav = tts.watermarker.apply_watermark(wav, sample_rate=tts.sample_rate)
+    total_s = time.perf_counter() - start
+
+    n_tokens = len(_SPEECH_TOKEN_RE.findall(output_str))
+    audio_s = len(wav) / tts.sample_rate
+
+    first_chunk_s = None
+    if tts._is_quantized_model:
+        if hasattr(tts.backbone, "reset"):
+            tts.backbone.reset()
+        start = time.perf_counter()
+        stream = tts.infer_stream(text, ref_codes, ref_text)
+        next(stream, None)
+        first_chunk_s = time.perf_counter() - start
+        stream.close()
+
+    return {
+        "prefill_s": prefill_s,
+        "generated_tokens": n_tokens,
+        "tokens_per_s": n_tokens / max(generate_s - prefill_s, 1e-9),
+        "synthesis_s": total_s,
+        "audio_s": audio_s,
+        "rtf": total_s / audio_s if audio_s else None,
+        "first_chunk_s": first_chunk_s,
+    }
+
+
+def _median(values: list) -> float | None:
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def benchmark_combination(
+    backbone: str, codec: str, device: str, voices: list[dict], texts: list[str], repeats: int, warmup: int
+) -> dict:
+    result = {"backbone": backbone, "codec": codec, "device": device}
+    try:
+        start = time.perf_counter()
+        tts = _load_tts(backbone, codec, device)
+        result["load_s"] = time.perf_counter() - start
+
+        runs = []
+        for voice in voices:
+            ref_codes = _reference_codes(tts, voice)
+            if ref_codes is None:
+                print(f"Skipping {voice['name']}: no pre-encoded reference for {codec}")
+                continue
+
+            for _ in range(warmup):
+                _run_once(tts, ref_codes, voice["ref_text"], texts[0])
+
+            for text_id, text in enumerate(texts):
+                for repeat in range(repeats):
+                    run = _run_once(tts, ref_codes, voice["ref_text"], text)
+                    run.update({"voice": voice["name"], "text_id": text_id, "repeat": repeat})
+                    runs.append(run)
+                    print(
+                        f"[{backbone} | {codec}] {voice['name']} text={text_id} "
+                        f"rtf={run['rtf']:.3f} tok/s={run['tokens_per_s']:.1f}"
+                    )
+
+        result["summary"] = {
+            metric: _median([run[metric] for run in runs])
+            for metric in ("prefill_s", "tokens_per_s", "rtf", "first_chunk_s", "synthesis_s", "audio_s")
+        }
+        result["runs"] = runs
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        print(f"[{backbone} | {codec}] failed: {result['error']}")
+
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def main(
+    output_path="benchmark_results.json",
+    samples_dir="./samples",
+    voices=None,
+    backbones=None,
+    codecs=None,
+    device="cpu",
+    repeats=3,
+    warmup=1,
+    max_texts=None,
+    standin=False,
+):
+    backbones = backbones or (STANDIN_BACKBONES if standin else BACKBONES)
+    codecs = codecs or (STANDIN_CODECS if standin else CODECS)
+    texts = CORPUS[:max_texts] if max_texts else CORPUS
+    sample_voices = find_voices(samples_dir, voices)
+    if not sample_voices:
+        print(f"No voices with matching .wav/.txt found in {samples_dir}")
+        return None
+
+    results = []
+    for backbone in backbones:
+        for codec in codecs:
+            # Fresh spawned process per combination: clean peak RSS, no shared model state
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                results.append(
+                    executor.submit(
+                        benchmark_combination, backbone, codec, device, sample_voices, texts, repeats, warmup
+                    ).result()
+                )
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "host": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        },
+        "config": {
+            "device": device,
+            "repeats": repeats,
+            "warmup": warmup,
+            "standin": standin,
+            "voices": [voice["name"] for voice in sample_voices],
+            "corpus": texts,
+        },
+        "results": results,
+    }
+
+    print(f"Saving results to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="NeuTTSAir backbone x codec benchmark")
+    parser.add_argument(
+        "--output_path", type=str, default="benchmark_results.json", help="Path to write the JSON results"
+    )
+    parser.add_argument("--samples_dir", type=str, default="./samples", help="Directory of reference voices")
+    parser.add_argument("--voices", type=str, nargs="*", default=None, help="Voice names to use (default: all)")
+    parser.add_argument("--backbones", type=str, nargs="*", default=None, help="Backbone repos to benchmark")
+    parser.add_argument("--codecs", type=str, nargs="*", default=None, help="Codec repos to benchmark")
+    parser.add_argument("--device", type=str, default="cpu", help="Device for backbone and codec")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per voice and text")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per voice before timing")
+    parser.add_argument("--max_texts", type=int, default=None, help="Only use the first N corpus texts")
+    parser.add_argument(
+        "--standin",
+        action="store_true",
+        help="Use tiny randomly-initialized stand-in models (runs offline, timings are not representative)",
+    )
+    args = parser.parse_args()
+    main(
+        output_path=args.output_path,
+        samples_dir=args.samples_dir,
+        voices=args.voices,
+        backbones=args.backbones,
+        codecs=args.codecs,
+        device=args.device,
+        repeats=args.repeats,
+        warmup=args.warmup,
+        max_texts=args.max_texts,
+        standin=args.standin,
+    )
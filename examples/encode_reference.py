@@ -1,8 +1,18 @@
 # This file contains an example of how to use the NeuTTSAir class to generate codes
 
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
 import torch
-from librosa import load
 from neucodec import NeuCodec
+from neuttsair.audio import REFERENCE_SAMPLE_RATE, load_audio, load_reference, resample
+
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".mp3", ".ogg", ".m4a"}
+INDEX_FNAME = "index.jsonl"
 
 
 def main(ref_audio_path, output_path="output.pt"):
@@ -18,14 +28,155 @@ def main(ref_audio_path, output_path="output.pt"):
     codec.eval().to("cpu")
 
     # Load and encode reference audio
-    wav, _ = load(ref_audio_path, sr=16000, mono=True)  # load as 16kHz
-    wav_tensor = torch.from_numpy(wav).float().unsqueeze(0).unsqueeze(0)  # [1, 1, T]
+    wav = load_reference(ref_audio_path)  # 16kHz, memory-mapped from the cached .npy
+    wav_tensor = torch.from_numpy(wav).unsqueeze(0).unsqueeze(0)  # [1, 1, T]
     ref_codes = codec.encode_code(audio_or_path=wav_tensor).squeeze(0).squeeze(0)
 
     # Save the codes
     torch.save(ref_codes, output_path)
 
 
+def _load_16k(audio_path: str) -> np.ndarray | None:
+    try:
+        wav, sr = load_audio(audio_path)
+    except Exception as e:
+        print(f"Skipping {audio_path}: {e}")
+        return None
+    return resample(wav, sr, REFERENCE_SAMPLE_RATE)
+
+
+def list_audio_files(input_dir=None, manifest=None) -> list[str]:
+    if manifest:
+        # One path per line, or JSONL with an "audio_path" field
+        paths = []
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    paths.append(json.loads(line)["audio_path"] if line.startswith("{") else line)
+        return paths
+    return sorted(str(p) for p in Path(input_dir).rglob("*") if p.suffix.lower() in AUDIO_EXTENSIONS)
+
+
+def encode_batch(codec, wavs: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    Encode several 16 kHz waveforms, batching only those of exactly the same length.
+
+    NeuCodec's encoder takes no padding mask and its semantic features can depend on
+    the whole clip, so zero-padding clips to a common length could change their codes.
+    Same-length clips batch without padding and get the codes they get alone.
+    """
+    by_length = {}
+    for i, wav in enumerate(wavs):
+        by_length.setdefault(len(wav), []).append(i)
+
+    codes = [None] * len(wavs)
+    for indices in by_length.values():
+        batch = np.stack([wavs[i] for i in indices]).astype(np.float32, copy=False)[:, None, :]
+        with torch.no_grad():
+            batch_codes = codec.encode_code(audio_or_path=torch.from_numpy(batch).to(codec.device))
+        for i, clip_codes in zip(indices, batch_codes[:, 0, :].cpu().numpy()):
+            codes[i] = clip_codes.astype(np.uint16)
+    return codes
+
+
+class ShardWriter:
+    """
+    Appends uint16 code arrays to fixed-size shard files and records them in index.jsonl.
+
+    Each index line is {"audio_path", "shard", "offset", "length"}, with offset and length
+    in codes. A line is only written after its codes are flushed, so an interrupted run
+    leaves at most unindexed bytes at a shard's tail; every run starts a fresh shard.
+    """
+
+    def __init__(self, output_dir: str, shard_size_mb: float):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.max_shard_codes = int(shard_size_mb * 1024**2) // 2
+        self.index_path = self.output_dir / INDEX_FNAME
+        self.shard_id = len(list(self.output_dir.glob("codes_*.bin")))
+        self._shard = None
+        self._offset = 0
+        self._index = open(self.index_path, "a")
+
+    def encoded_paths(self) -> set[str]:
+        if not self.index_path.exists():
+            return set()
+        with open(self.index_path) as f:
+            return {json.loads(line)["audio_path"] for line in f if line.strip()}
+
+    def write(self, audio_path: str, codes: np.ndarray):
+        if self._shard is None or self._offset + len(codes) > self.max_shard_codes:
+            self._open_next_shard()
+        self._shard.write(codes.tobytes())
+        self._shard.flush()
+        entry = {"audio_path": audio_path, "shard": self._shard_name, "offset": self._offset, "length": len(codes)}
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+        self._offset += len(codes)
+
+    def _open_next_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_name = f"codes_{self.shard_id:05d}.bin"
+        self._shard = open(self.output_dir / self._shard_name, "ab")
+        self._offset = 0
+        self.shard_id += 1
+
+    def close(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._index.close()
+
+
+def load_encoded(output_dir: str):
+    """Yield (audio_path, codes) from a bulk-encoded directory, memory-mapping each shard."""
+    output_dir = Path(output_dir)
+    shards = {}
+    with open(output_dir / INDEX_FNAME) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry["shard"] not in shards:
+                shards[entry["shard"]] = np.memmap(output_dir / entry["shard"], dtype=np.uint16, mode="r")
+            yield entry["audio_path"], shards[entry["shard"]][entry["offset"] : entry["offset"] + entry["length"]]
+
+
+def bulk_main(
+    output_dir,
+    input_dir=None,
+    manifest=None,
+    batch_size=8,
+    num_workers=os.cpu_count(),
+    shard_size_mb=256,
+    device="cpu",
+):
+    writer = ShardWriter(output_dir, shard_size_mb)
+    done = writer.encoded_paths()
+    audio_paths = [path for path in list_audio_files(input_dir, manifest) if path not in done]
+    print(f"Encoding {len(audio_paths)} files ({len(done)} already encoded)")
+
+    codec = NeuCodec.from_pretrained("neuphonic/neucodec")
+    codec.eval().to(device)
+
+    # Load a bounded window of files at a time so decoding never runs far ahead of encoding
+    window = batch_size * max(num_workers, 1)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for start in range(0, len(audio_paths), window):
+            paths = audio_paths[start : start + window]
+            wavs = list(pool.map(_load_16k, paths))
+
+            # Sorted by length, so clips of equal length land in the same codec call
+            order = sorted((i for i in range(len(paths)) if wavs[i] is not None), key=lambda i: len(wavs[i]))
+            for batch_start in range(0, len(order), batch_size):
+                batch = order[batch_start : batch_start + batch_size]
+                for i, codes in zip(batch, encode_batch(codec, [wavs[i] for i in batch])):
+                    writer.write(paths[i], codes)
+
+            print(f"Encoded {min(start + window, len(audio_paths))}/{len(audio_paths)}")
+
+    writer.close()
+
+
 if __name__ == "__main__":
     # get arguments from command line
     import argparse
@@ -40,8 +191,35 @@ if __name__ == "__main__":
         default="encoded_reference.pt",
         help="Path to save the output codes",
     )
-    args = parser.parse_args()
-    main(
-        ref_audio_path=args.ref_audio,
-        output_path=args.output_path,
+    parser.add_argument(
+        "--input_dir", type=str, default=None, help="Bulk mode: directory of audio files to encode"
+    )
+    parser.add_argument(
+        "--manifest", type=str, default=None, help="Bulk mode: file listing audio paths, one per line or JSONL"
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default="encoded_references", help="Bulk mode: directory for shards and index"
     )
+    parser.add_argument("--batch_size", type=int, default=8, help="Bulk mode: most files per codec call; only same-length files share one")
+    parser.add_argument(
+        "--num_workers", type=int, default=os.cpu_count(), help="Bulk mode: audio loading processes"
+    )
+    parser.add_argument("--shard_size_mb", type=float, default=256, help="Bulk mode: maximum shard size")
+    parser.add_argument("--device", type=str, default="cpu", help="Bulk mode: codec device")
+    args = parser.parse_args()
+
+    if args.input_dir or args.manifest:
+        bulk_main(
+            output_dir=args.output_dir,
+            input_dir=args.input_dir,
+            manifest=args.manifest,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shard_size_mb=args.shard_size_mb,
+            device=args.device,
+        )
+    else:
+        main(
+            ref_audio_path=args.ref_audio,
+            output_path=args.output_path,
+        )
@@ -2,15 +2,18 @@ import warnings
 
 import re
 import os
+import glob
+import hashlib
+import itertools
 import torch
 import phonemizer
+import phonemizer.backend
 
 from fire import Fire
 from omegaconf import OmegaConf
-from functools import partial
-from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainingArguments, default_data_collator
+from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainerCallback, TrainingArguments, default_data_collator
 from loguru import logger as LOGGER
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 
 
 warnings.filterwarnings("ignore")
@@ -41,57 +44,307 @@ def data_filter(sample):
     return True
 
 
-def preprocess_sample(sample, tokenizer, max_len, g2p):
+# espeak handles can't be pickled into `dataset.map` workers, so each process builds its own
+_G2P = None
 
-    # get special tokens
-    speech_gen_start = tokenizer.convert_tokens_to_ids('<|SPEECH_GENERATION_START|>')
-    ignore_index = -100  # this is from LLaMA
 
-    # unpack sample
-    vq_codes = sample["codes"]
-    text = sample["text"]
+def get_g2p():
+    global _G2P
+    if _G2P is None:
+        _G2P = phonemizer.backend.EspeakBackend(
+            language='en-us',
+            preserve_punctuation=True,
+            with_stress=True,
+            words_mismatch="ignore",
+            language_switch="remove-flags"
+        )
+    return _G2P
+
+
+def speech_token_offset(tokenizer, codebook_size):
+    # <|speech_N|> tokens are contiguous in the vocab, so a code maps to an id by addition
+    offset = tokenizer.convert_tokens_to_ids('<|speech_0|>')
+    last = tokenizer.convert_tokens_to_ids(f'<|speech_{codebook_size - 1}|>')
+    if last != offset + codebook_size - 1:
+        raise ValueError("Speech tokens are not contiguous in the tokenizer vocabulary.")
+    return offset
+
+
+IGNORE_INDEX = -100  # this is from LLaMA
+
+# the chat template around the phones and codes
+PROMPT_PREFIX = "user: Convert the text to speech:<|TEXT_PROMPT_START|>"
+PROMPT_SUFFIX = "<|TEXT_PROMPT_END|>\nassistant:<|SPEECH_GENERATION_START|>"
+
+# bump whenever preprocess_batch's output changes, so cached datasets in the old format aren't reused
+PREPROCESS_FORMAT_VERSION = 2
+
+
+def preprocess_batch(batch, tokenizer, speech_offset):
+
+    # the chat template tokenizes identically on its own, since every piece is delimited by special tokens
+    prefix_ids = tokenizer.encode(PROMPT_PREFIX)
+    suffix_ids = tokenizer.encode(PROMPT_SUFFIX, add_special_tokens=False)
+    speech_gen_end = tokenizer.convert_tokens_to_ids('<|SPEECH_GENERATION_END|>')
+
+    # phonemize the whole batch in one call
+    phones_batch = get_g2p().phonemize(batch["text"])
+    phones_batch = [' '.join(phones.split()) for phones in phones_batch]
+    phone_ids_batch = tokenizer(phones_batch, add_special_tokens=False)["input_ids"]
+
+    outputs = {"input_ids": [], "labels": []}
+    for i, (phones, phone_ids, vq_codes) in enumerate(zip(phones_batch, phone_ids_batch, batch["codes"])):
+
+        # SAFE CHECK
+        if not phones:
+            key = batch['__key__'][i] if '__key__' in batch else i
+            LOGGER.warning(f"⚠️ Empty phonemization output for sample: {key} text={batch['text'][i]}")
+            continue
+
+        prompt_ids = prefix_ids + phone_ids + suffix_ids
+        ids = prompt_ids + [speech_offset + code for code in vq_codes] + [speech_gen_end]
+
+        # labels start at <|SPEECH_GENERATION_START|>, the last prompt token
+        labels = [IGNORE_INDEX] * (len(prompt_ids) - 1) + ids[len(prompt_ids) - 1:]
+
+        outputs["input_ids"].append(ids)
+        outputs["labels"].append(labels)
+
+    # unpadded; padding or packing to max_seq_len happens in layout_dataset
+    return outputs
+
+
+def pad_batch(batch, max_len, pad_token_id):
+    outputs = {"input_ids": [], "labels": [], "attention_mask": [], "num_tokens": []}
+    for ids, labels in zip(batch["input_ids"], batch["labels"]):
+        n_pad = max_len - len(ids)
+        outputs["input_ids"].append(ids + [pad_token_id] * n_pad)
+        outputs["labels"].append(labels + [IGNORE_INDEX] * n_pad)
+        outputs["attention_mask"].append([1] * len(ids) + [0] * n_pad)
+        outputs["num_tokens"].append(len(ids))
+    return outputs
+
+
+def pack_batch(batch, max_len, pad_token_id):
+    """Pack samples into max_len windows with first-fit decreasing
+
+    position_ids restart at 0 for every segment, and PackedCollator turns them into a
+    block-diagonal causal mask so segments never attend to each other. Labels stay
+    masked up to each segment's <|SPEECH_GENERATION_START|>; trailing padding is its
+    own fully-masked segment.
+    """
+    order = sorted(range(len(batch["input_ids"])), key=lambda i: -len(batch["input_ids"][i]))
+    windows = []  # [n_used, [sample indices]]
+    for i in order:
+        n = len(batch["input_ids"][i])
+        for window in windows:
+            if window[0] + n <= max_len:
+                window[0] += n
+                window[1].append(i)
+                break
+        else:
+            windows.append([n, [i]])
+
+    outputs = {"input_ids": [], "labels": [], "position_ids": [], "num_tokens": []}
+    for n_used, indices in windows:
+        ids, labels, position_ids = [], [], []
+        for i in indices:
+            ids += batch["input_ids"][i]
+            labels += batch["labels"][i]
+            position_ids += list(range(len(batch["input_ids"][i])))
+        n_pad = max_len - n_used
+        outputs["input_ids"].append(ids + [pad_token_id] * n_pad)
+        outputs["labels"].append(labels + [IGNORE_INDEX] * n_pad)
+        outputs["position_ids"].append(position_ids + list(range(n_pad)))
+        outputs["num_tokens"].append(n_used)
+    return outputs
+
+
+def packed_attention_mask(position_ids, dtype=torch.float32):
+    """Block-diagonal causal mask for packed rows, as a [B, 1, L, L] additive float mask
+
+    A new segment starts wherever position_ids is 0; each token attends to the tokens
+    before it in its own segment only.
+    """
+    segments = (position_ids == 0).cumsum(-1)
+    length = position_ids.shape[-1]
+    causal = torch.ones(length, length, dtype=torch.bool, device=position_ids.device).tril()
+    allowed = (segments[:, :, None] == segments[:, None, :]) & causal
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=position_ids.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+class PackedCollator:
+    """default_data_collator plus an explicit attention mask for packed rows
+
+    Without one, sdpa and eager attention build a plain causal mask over the whole row
+    and every segment attends to the segments packed before it. Padded rows, which
+    carry their own 2D attention_mask, pass through unchanged.
+    """
+
+    def __init__(self, dtype=torch.float32):
+        self.dtype = dtype
+
+    def __call__(self, features):
+        batch = default_data_collator(features)
+        if "position_ids" in batch:
+            batch["attention_mask"] = packed_attention_mask(batch["position_ids"], self.dtype)
+        return batch
+
+
+def layout_dataset(dataset, tokenizer, config):
+    """Drop samples longer than max_seq_len, then pad or pack to max_seq_len rows
+
+    Returns the dataset and the mean number of real (non-padding) tokens per row.
+    """
+    num_proc = config.get("num_proc", os.cpu_count())
+    max_len = config.max_seq_len
+
+    n_samples = len(dataset)
+    dataset = dataset.filter(lambda ids: len(ids) <= max_len, input_columns="input_ids", num_proc=num_proc)
+    if len(dataset) < n_samples:
+        LOGGER.warning(f"Dropped {n_samples - len(dataset)} samples longer than max_seq_len={max_len}")
+
+    n_samples = len(dataset)
+    packing = config.get("packing", True)
+    dataset = dataset.map(
+        pack_batch if packing else pad_batch,
+        fn_kwargs={"max_len": max_len, "pad_token_id": tokenizer.pad_token_id},
+        batched=True,
+        batch_size=config.get("packing_batch_size", 1000),
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+    )
 
-    # phonemize
-    phones = g2p.phonemize([text])
+    num_tokens = dataset["num_tokens"]
+    tokens_per_row = sum(num_tokens) / len(num_tokens)
+    LOGGER.info(
+        f"{'Packed' if packing else 'Padded'} {n_samples} samples into "
+        f"{len(dataset)} rows of {max_len}: {tokens_per_row / max_len:.1%} real tokens"
+    )
+    return dataset.remove_columns("num_tokens"), tokens_per_row
+
+
+def preprocess_dataset(dataset, tokenizer, config):
+    """Filter and tokenize `dataset`, reusing a previous run's output for the same inputs"""
+
+    num_proc = config.get("num_proc", os.cpu_count())
+    cache_root = config.get("preprocess_cache_dir", None)
+    # everything the cached rows depend on; max_seq_len and packing are applied after the cache, in layout_dataset
+    cache_key = hashlib.sha1("-".join(map(str, [
+        PREPROCESS_FORMAT_VERSION,
+        dataset._fingerprint,
+        tokenizer.name_or_path,
+        len(tokenizer),
+        config.codebook_size,
+        PROMPT_PREFIX,
+        PROMPT_SUFFIX,
+    ])).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_root, cache_key) if cache_root else None
+
+    if cache_path and os.path.exists(cache_path):
+        LOGGER.info(f"Loading preprocessed dataset from {cache_path}")
+        return load_from_disk(cache_path)
+
+    dataset = dataset.filter(data_filter, num_proc=num_proc)
+    dataset = dataset.map(
+        preprocess_batch,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "speech_offset": speech_token_offset(tokenizer, config.codebook_size),
+        },
+        batched=True,
+        batch_size=config.get("preprocess_batch_size", 256),
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+    )
 
-    # SAFE CHECK
-    if not phones or not phones[0]:
-        LOGGER.warning(f"⚠️ Empty phonemization output for sample: {sample['__key__']} text={text}")
-        return None
+    if cache_path:
+        LOGGER.info(f"Saving preprocessed dataset to {cache_path}")
+        dataset.save_to_disk(cache_path)
+    return dataset
+
+
+def load_source_dataset(config, streaming):
+    """Load the training split from the hub, or from parquet/arrow shards in `data_dir`"""
+
+    data_dir = config.get("data_dir", None)
+    split = config.get("dataset_split", "train[:2000]")
+    if streaming:
+        # streams are read front to back; slicing like train[:2000] isn't supported
+        split = split.split("[")[0]
+
+    if data_dir is None:
+        return load_dataset(config.get("dataset_name", "neuphonic/emilia-yodas-english-neucodec"), split=split, streaming=streaming)
+
+    for builder, pattern in (("parquet", "*.parquet"), ("arrow", "*.arrow")):
+        data_files = sorted(glob.glob(os.path.join(data_dir, "**", pattern), recursive=True))
+        if data_files:
+            return load_dataset(builder, data_files={"train": data_files}, split=split, streaming=streaming)
+    raise ValueError(f"No .parquet or .arrow shards found in {data_dir}")
+
+
+def stream_dataset(dataset, tokenizer, config):
+    """Filter, shuffle, tokenize and pack an IterableDataset lazily, as the trainer consumes it
+
+    Returns the stream and an estimate of real tokens per row from its first rows.
+    """
+    max_len = config.max_seq_len
+    packing = config.get("packing", True)
+    source_columns = dataset.column_names or list(next(iter(dataset)).keys())
+
+    dataset = dataset.filter(data_filter)
+    dataset = dataset.shuffle(seed=config.get("seed", 0), buffer_size=config.get("shuffle_buffer_size", 10000))
+    dataset = dataset.map(
+        preprocess_batch,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "speech_offset": speech_token_offset(tokenizer, config.codebook_size),
+        },
+        batched=True,
+        batch_size=config.get("preprocess_batch_size", 256),
+        remove_columns=source_columns,
+    )
+    dataset = dataset.filter(lambda ids: len(ids) <= max_len, input_columns="input_ids")
+    dataset = dataset.map(
+        pack_batch if packing else pad_batch,
+        fn_kwargs={"max_len": max_len, "pad_token_id": tokenizer.pad_token_id},
+        batched=True,
+        batch_size=config.get("packing_batch_size", 1000),
+        remove_columns=["input_ids", "labels"],
+    )
 
-    phones = phones[0].split()
-    phones = ' '.join(phones)
+    sample = [row["num_tokens"] for row in itertools.islice(dataset, 100)]
+    tokens_per_row = sum(sample) / max(len(sample), 1)
+    LOGGER.info(f"Streaming {'packed' if packing else 'padded'} rows: ~{tokens_per_row / max_len:.1%} real tokens")
+    return dataset.remove_columns("num_tokens"), tokens_per_row
 
-    codes_str = "".join([f"<|speech_{i}|>" for i in vq_codes])
 
-    # get chat format
-    chat = f"""user: Convert the text to speech:<|TEXT_PROMPT_START|>{phones}<|TEXT_PROMPT_END|>\nassistant:<|SPEECH_GENERATION_START|>{codes_str}<|SPEECH_GENERATION_END|>"""
-    ids = tokenizer.encode(chat)
+class StreamStateCallback(TrainerCallback):
+    """Checkpoints the streaming dataloader's position so resumed runs continue where they stopped
 
-    # pad to make seq len
-    if len(ids) < max_len:
-        ids = ids + [tokenizer.pad_token_id] * (max_len - len(ids))
-    else:
-        ids = ids[:max_len]
+    Requires the stateful dataloader (accelerator_config use_stateful_dataloader), which
+    tracks each worker's shard position and shuffle buffer.
+    """
 
-    # convert to tensor
-    input_ids = torch.tensor(ids, dtype=torch.long)
+    state_fname = "stream_state.pt"
 
-    labels = torch.full_like(input_ids, ignore_index)
-    speech_gen_start_idx = (input_ids == speech_gen_start).nonzero(as_tuple=True)[0]
-    if len(speech_gen_start_idx) > 0:
-        speech_gen_start_idx = speech_gen_start_idx[0]
-        labels[speech_gen_start_idx:] = input_ids[speech_gen_start_idx:]
+    def __init__(self, resume_from_checkpoint=None):
+        self.resume_from_checkpoint = resume_from_checkpoint
 
-    # create attention mask
-    attention_mask = (input_ids != tokenizer.pad_token_id).long()
+    def on_train_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        if not self.resume_from_checkpoint:
+            return
+        state_fpath = os.path.join(self.resume_from_checkpoint, self.state_fname)
+        if os.path.exists(state_fpath):
+            LOGGER.info(f"Restoring stream position from {state_fpath}")
+            train_dataloader.load_state_dict(torch.load(state_fpath, weights_only=False))
+        else:
+            LOGGER.warning(f"No stream position in {self.resume_from_checkpoint}; restarting the stream")
 
-    # return in hf format
-    return {
-        "input_ids": input_ids,
-        "labels": labels,
-        "attention_mask": attention_mask,
-    }
+    def on_save(self, args, state, control, train_dataloader=None, **kwargs):
+        checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+        torch.save(train_dataloader.state_dict(), os.path.join(checkpoint_dir, self.state_fname))
 
 
 def main(config_fpath: str):
@@ -107,27 +360,19 @@ def main(config_fpath: str):
     print(f"Loading checkpoint from {restore_from}")
     tokenizer = AutoTokenizer.from_pretrained(restore_from)
     model = AutoModelForCausalLM.from_pretrained(restore_from, torch_dtype="auto")
+    # no KV cache while training; it is only for generation
+    model.config.use_cache = False
+
+    streaming = config.get("streaming", False)
+    resume_from_checkpoint = config.get("resume_from_checkpoint", None)
+    emilia_dataset = load_source_dataset(config, streaming)
+    if streaming:
+        emilia_dataset, tokens_per_row = stream_dataset(emilia_dataset, tokenizer, config)
+    else:
+        emilia_dataset = preprocess_dataset(emilia_dataset, tokenizer, config)
+        emilia_dataset, tokens_per_row = layout_dataset(emilia_dataset, tokenizer, config)
 
-    g2p = phonemizer.backend.EspeakBackend(
-        language='en-us',
-        preserve_punctuation=True,
-        with_stress=True,
-        words_mismatch="ignore",
-        language_switch="remove-flags"
-    )
-    partial_preprocess = partial(
-        preprocess_sample,
-        tokenizer=tokenizer,
-        max_len=config.max_seq_len,
-        g2p=g2p,
-    )
-
-    emilia_dataset = load_dataset(
-        "neuphonic/emilia-yodas-english-neucodec",
-        split="train[:2000]",
-    )
-    emilia_dataset = emilia_dataset.filter(data_filter).map(partial_preprocess, remove_columns=["text", "codes"])
-
+    num_workers = config.get("dataloader_num_workers", 64)
     training_args = TrainingArguments(
         output_dir=checkpoints_dir,
         do_train=True,
@@ -143,7 +388,10 @@ def main(config_fpath: str):
         dataloader_drop_last=True,
         remove_unused_columns=False,
         torch_compile=True,
-        dataloader_num_workers=64,
+        dataloader_num_workers=num_workers,
+        # bounded prefetch: each worker keeps at most this many batches ready
+        dataloader_prefetch_factor=config.get("prefetch_factor", 4) if num_workers > 0 else None,
+        accelerator_config={"use_stateful_dataloader": streaming},
     )
 
     trainer = Trainer(
@@ -151,9 +399,16 @@ def main(config_fpath: str):
         tokenizer=tokenizer,
         args=training_args,
         train_dataset=emilia_dataset,
-        data_collator=default_data_collator,
+        data_collator=PackedCollator(model.dtype),
+        callbacks=[StreamStateCallback(resume_from_checkpoint)] if streaming else None,
+    )
+    train_metrics = trainer.train(resume_from_checkpoint=resume_from_checkpoint).metrics
+
+    # real tokens/s, comparable between packing and padding runs on the same hardware
+    LOGGER.info(
+        f"Throughput: {train_metrics['train_samples_per_second']:.2f} rows/s, "
+        f"{train_metrics['train_samples_per_second'] * tokens_per_row:.0f} real tokens/s"
     )
-    trainer.train()
     trainer.save_model(checkpoints_dir)
 
 
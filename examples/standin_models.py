@@ -0,0 +1,241 @@
+# Tiny randomly-initialized stand-ins for the NeuTTSAir components, so tooling such as
+# the benchmark can exercise the real inference code paths offline (no HF downloads,
+# no espeak, no llama-cpp). Outputs are noise; only shapes and timings are meaningful.
+
+import re
+import numpy as np
+import torch
+from torch import nn
+from transformers import LlamaConfig, LlamaForCausalLM
+from neuttsair.neutts import NeuTTSAir
+
+
+STANDIN_BACKBONE = "standin/backbone"
+STANDIN_GGUF_BACKBONE = "standin/backbone-gguf"
+STANDIN_CODEC = "standin/codec"
+STANDIN_ONNX_CODEC = "standin/codec-onnx"
+
+CODEBOOK_SIZE = 65536
+N_CHARS = 256
+SPECIAL_TOKENS = [
+    "<|pad|>",
+    "<|SPEECH_REPLACE|>",
+    "<|SPEECH_GENERATION_START|>",
+    "<|SPEECH_GENERATION_END|>",
+    "<|TEXT_REPLACE|>",
+    "<|TEXT_PROMPT_START|>",
+    "<|TEXT_PROMPT_END|>",
+]
+
+_TOKEN_RE = re.compile(r"<\|[^|]+\|>|.", re.DOTALL)
+_SPEECH_TOKEN_RE = re.compile(r"<\|speech_(\d+)\|>")
+
+
+class StandInTokenizer:
+    """Character-level tokenizer exposing the special and speech tokens NeuTTSAir uses."""
+
+    pad_token_id = 0
+
+    def __init__(self):
+        self._special = {token: i for i, token in enumerate(SPECIAL_TOKENS)}
+        self._char_offset = len(SPECIAL_TOKENS)
+        self.speech_offset = self._char_offset + N_CHARS
+        self.vocab_size = self.speech_offset + CODEBOOK_SIZE
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        if token in self._special:
+            return self._special[token]
+        match = _SPEECH_TOKEN_RE.fullmatch(token)
+        if match:
+            return self.speech_offset + int(match.group(1))
+        return self._char_offset + ord(token) % N_CHARS
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[int]:
+        return [self.convert_tokens_to_ids(token) for token in _TOKEN_RE.findall(text)]
+
+    def decode(self, ids: list[int], **kwargs) -> str:
+        tokens = []
+        for i in ids:
+            if i < self._char_offset:
+                tokens.append(SPECIAL_TOKENS[i])
+            elif i < self.speech_offset:
+                tokens.append(chr(i - self._char_offset))
+            else:
+                tokens.append(f"<|speech_{i - self.speech_offset}|>")
+        return "".join(tokens)
+
+
+def build_standin_backbone(tokenizer: StandInTokenizer, max_context: int) -> LlamaForCausalLM:
+    config = LlamaConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=max_context,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config).eval()
+
+    # A trained model only emits speech tokens and eventually stops; emulate that so
+    # generation lengths resemble real utterances rather than always hitting the cap.
+    speech_end_id = tokenizer.convert_tokens_to_ids("<|SPEECH_GENERATION_END|>")
+    model.generation_config.suppress_tokens = [
+        i for i in range(tokenizer.speech_offset) if i != speech_end_id
+    ]
+    model.generation_config.exponential_decay_length_penalty = (150, 1.05)
+    return model
+
+
+class StandInLlama:
+    """Mimics the slice of the `llama_cpp.Llama` completion API that NeuTTSAir calls."""
+
+    def __init__(self, model: LlamaForCausalLM, tokenizer: StandInTokenizer, n_ctx: int):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.n_ctx = n_ctx
+        self._speech_end_id = tokenizer.convert_tokens_to_ids("<|SPEECH_GENERATION_END|>")
+        start, factor = model.generation_config.exponential_decay_length_penalty
+        self._eos_penalty_start = start
+        self._eos_penalty_factor = factor
+
+    def reset(self):
+        pass
+
+    def tokenize(self, text: bytes, add_bos=True, special=False):
+        return self.tokenizer.encode(text.decode("utf-8"))
+
+    def __call__(self, prompt, max_tokens=16, temperature=1.0, top_k=50, stop=None, stream=False):
+        pieces = self._generate(prompt, max_tokens, temperature, top_k, stop or [])
+        if stream:
+            return ({"choices": [{"text": piece}]} for piece in pieces)
+        return {"choices": [{"text": "".join(pieces)}]}
+
+    def _generate(self, prompt, max_tokens, temperature, top_k, stop):
+        prompt_ids = self.tokenizer.encode(prompt)
+        budget = min(max_tokens, self.n_ctx - len(prompt_ids))
+        input_ids = torch.tensor([prompt_ids])
+        past_key_values = None
+
+        with torch.no_grad():
+            for step in range(budget):
+                out = self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+                past_key_values = out.past_key_values
+                logits = out.logits[0, -1] / temperature
+                logits[: self.tokenizer.speech_offset] = torch.where(
+                    torch.arange(self.tokenizer.speech_offset) == self._speech_end_id,
+                    logits[: self.tokenizer.speech_offset],
+                    float("-inf"),
+                )
+                if step >= self._eos_penalty_start:
+                    eos_logit = logits[self._speech_end_id]
+                    logits[self._speech_end_id] += eos_logit.abs() * (
+                        self._eos_penalty_factor ** (step - self._eos_penalty_start) - 1
+                    )
+
+                top = torch.topk(logits, top_k)
+                next_id = top.indices[torch.multinomial(torch.softmax(top.values, dim=-1), 1)]
+                piece = self.tokenizer.decode([next_id.item()])
+                if piece in stop:
+                    return
+                yield piece
+                input_ids = next_id.view(1, 1)
+
+
+class StandInCodec(nn.Module):
+    """Random codec matching NeuCodec's interface: 16 kHz in, 50 Hz codes, 24 kHz out."""
+
+    def __init__(self, codebook_size: int = CODEBOOK_SIZE, dim: int = 64):
+        super().__init__()
+        self.encoder = nn.Conv1d(1, dim, kernel_size=320, stride=320)
+        self.quantizer = nn.Linear(dim, codebook_size)
+        self.embed = nn.Embedding(codebook_size, dim)
+        self.decoder = nn.ConvTranspose1d(dim, 1, kernel_size=480, stride=480)
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.parameters()).device
+
+    def encode_code(self, audio_or_path: torch.Tensor) -> torch.Tensor:
+        features = self.encoder(audio_or_path.to(self.device))  # [B, D, F]
+        codes = self.quantizer(features.transpose(1, 2)).argmax(dim=-1)  # [B, F]
+        return codes.unsqueeze(1)  # [B, 1, F]
+
+    def decode_code(self, codes: torch.Tensor) -> torch.Tensor:
+        features = self.embed(codes[:, 0, :]).transpose(1, 2)  # [B, D, F]
+        return torch.tanh(self.decoder(features))  # [B, 1, F * 480]
+
+
+class StandInOnnxCodec:
+    """Numpy-in/numpy-out decoder standing in for `NeuCodecOnnxDecoder`."""
+
+    def __init__(self, codec: StandInCodec):
+        self._codec = codec
+
+    def decode_code(self, codes: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return self._codec.decode_code(torch.from_numpy(codes).long()).numpy()
+
+
+class StandInPhonemizer:
+    def phonemize(self, texts: list[str]) -> list[str]:
+        return [text.lower() for text in texts]
+
+
+class StandInWatermarker:
+    def apply_watermark(self, wav: np.ndarray, sample_rate: int) -> np.ndarray:
+        return wav
+
+
+class StandInNeuTTSAir(NeuTTSAir):
+    """NeuTTSAir wired to the stand-in components; inference runs through the real code."""
+
+    def __init__(
+        self,
+        backbone_repo=STANDIN_BACKBONE,
+        backbone_device="cpu",
+        codec_repo=STANDIN_CODEC,
+        codec_device="cpu",
+        seed=0,
+    ):
+        torch.manual_seed(seed)
+        super().__init__(backbone_repo, backbone_device, codec_repo, codec_device)
+
+    def _load_phonemizer(self):
+        self.phonemizer = StandInPhonemizer()
+
+    def _load_watermarker(self):
+        self.watermarker = StandInWatermarker()
+
+    def _load_backbone(self, backbone_repo, backbone_device):
+        print(f"Loading stand-in backbone: {backbone_repo} on {backbone_device} ...")
+        tokenizer = StandInTokenizer()
+        model = build_standin_backbone(tokenizer, self.max_context)
+
+        match backbone_repo:
+            case "standin/backbone":
+                self.tokenizer = tokenizer
+                self.backbone = model.to(torch.device(backbone_device))
+            case "standin/backbone-gguf":
+                self.backbone = StandInLlama(model, tokenizer, n_ctx=self.max_context)
+                self._is_quantized_model = True
+            case _:
+                raise ValueError(
+                    f"Invalid stand-in backbone! Must be one of: '{STANDIN_BACKBONE}', '{STANDIN_GGUF_BACKBONE}'."
+                )
+
+    def _load_codec(self, codec_repo, codec_device):
+        print(f"Loading stand-in codec: {codec_repo} on {codec_device} ...")
+        codec = StandInCodec().eval()
+
+        match codec_repo:
+            case "standin/codec":
+                self.codec = codec.to(codec_device)
+            case "standin/codec-onnx":
+                self.codec = StandInOnnxCodec(codec)
+                self._is_onnx_codec = True
+            case _:
+                raise ValueError(
+                    f"Invalid stand-in codec! Must be one of: '{STANDIN_CODEC}', '{STANDIN_ONNX_CODEC}'."
+                )
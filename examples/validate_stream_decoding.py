@@ -0,0 +1,71 @@
+import json
+import torch
+from neuttsair.streaming import StreamingSchedule
+
+
+def main(ref_codes_path, codec, backbone, lookbacks, context_frames=0, output_path=None, standin=False):
+    if standin:
+        from examples.standin_models import CODEBOOK_SIZE, StandInNeuTTSAir
+
+        tts = StandInNeuTTSAir(codec_repo=codec)
+        codes = torch.randint(0, CODEBOOK_SIZE, (500,))
+    else:
+        from neuttsair.neutts import NeuTTSAir
+
+        tts = NeuTTSAir(backbone_repo=backbone, backbone_device="cpu", codec_repo=codec, codec_device="cpu")
+        codes = torch.load(ref_codes_path).reshape(-1)
+    print(f"Decoding {len(codes)} codes")
+
+    # The first codes stand in for the reference prompt that precedes generated speech
+    context_codes, codes = codes[:context_frames], codes[context_frames:]
+
+    results = []
+    for lookback in lookbacks:
+        result = tts.validate_stream_decoding(
+            codes, schedule=StreamingSchedule(lookback=lookback), context_codes=context_codes
+        )
+        result["lookback"] = lookback
+        results.append(result)
+        print(
+            f"lookback={lookback:3d}  snr={result['snr_db']:7.2f} dB  max_abs_error={result['max_abs_error']:.2e}"
+            f"  codec frames/frame={result['codec_frames_per_frame']:.2f}"
+            f" (windowed: {result['reference_codec_frames_per_frame']:.2f})"
+        )
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {output_path}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compare streamed decoding with reduced lookback against the windowed baseline"
+    )
+    parser.add_argument("--ref_codes", type=str, default="./samples/dave.pt", help="Pre-encoded codes to decode")
+    parser.add_argument("--codec", type=str, default="neuphonic/neucodec-onnx-decoder", help="Codec repo")
+    parser.add_argument(
+        "--backbone", type=str, default="neuphonic/neutts-air-q4-gguf", help="Backbone repo (loaded but unused)"
+    )
+    parser.add_argument(
+        "--lookbacks", type=int, nargs="*", default=[0, 4, 8, 12, 16, 25, 50], help="Lookback frames to test"
+    )
+    parser.add_argument("--context_frames", type=int, default=0, help="Leading codes treated as the reference prompt")
+    parser.add_argument("--output_path", type=str, default=None, help="Path to write the JSON results")
+    parser.add_argument(
+        "--standin",
+        action="store_true",
+        help="Use tiny randomly-initialized stand-in models (runs offline, only checks the harness)",
+    )
+    args = parser.parse_args()
+    main(
+        ref_codes_path=args.ref_codes,
+        codec=args.codec if not args.standin else "standin/codec-onnx",
+        backbone=args.backbone,
+        lookbacks=args.lookbacks,
+        context_frames=args.context_frames,
+        output_path=args.output_path,
+        standin=args.standin,
+    )
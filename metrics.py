@@ -0,0 +1,130 @@
+import contextvars
+import logging
+import time
+import uuid
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from neuttsair.hooks import InferenceHook
+
+# Set for the duration of each HTTP request and attached to every log record
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+logger = logging.getLogger("humain")
+
+STAGE_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "neutts_stage_seconds",
+    "Time spent in each NeuTTSAir inference stage",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests handled",
+    ["endpoint", "method", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency",
+    ["endpoint"],
+    buckets=STAGE_BUCKETS,
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "admission_queue_depth",
+    "Synthesis requests waiting for an inference slot",
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "admission_wait_seconds",
+    "Time synthesis requests spent queued before inference",
+    buckets=STAGE_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total",
+    "Synthesis requests refused by admission control",
+    ["reason"],
+)
+
+SINGLEFLIGHT_SHARED = Counter(
+    "singleflight_shared_total",
+    "Synthesis requests served by joining an identical request already in flight",
+    ["kind"],
+)
+
+SYNTHESIS_CANCELLED = Counter(
+    "synthesis_cancelled_total",
+    "Synthesis requests stopped before completion, by deadline or client disconnect",
+    ["reason"],
+)
+CANCELLED_TOKENS = Counter(
+    "neutts_cancelled_tokens_total",
+    "Tokens generated for requests that were then cancelled",
+)
+
+MODEL_POOL_LOADED = Gauge(
+    "model_pool_loaded",
+    "TTS models currently loaded in the model pool",
+)
+MODEL_POOL_RESIDENT_MB = Gauge(
+    "model_pool_resident_mb",
+    "Measured memory of the TTS models loaded in the model pool",
+)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class PrometheusHook(InferenceHook):
+    """Feeds NeuTTSAir stage timings into Prometheus histograms and the request log"""
+
+    def on_stage(self, stage, duration_s, **info):
+        STAGE_SECONDS.labels(stage=stage).observe(duration_s)
+        if stage == "cancelled":
+            CANCELLED_TOKENS.inc(info.get("n_tokens", 0))
+        # Per-token steps would flood the log; they are only aggregated
+        if stage != "decode_step":
+            details = "".join(f" {key}={value}" for key, value in info.items())
+            logger.info(f"stage={stage} duration_ms={duration_s * 1000:.1f}{details}")
+
+
+def setup_logging(level=logging.INFO):
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def init_app(app):
+    """Attach request ids, request metrics and the /metrics endpoint to a Flask app"""
+
+    @app.before_request
+    def _start_request():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+        g.request_id_token = request_id_var.set(g.request_id)
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def _finish_request(response):
+        endpoint = request.endpoint or "unknown"
+        HTTP_REQUESTS.labels(endpoint=endpoint, method=request.method, status=response.status_code).inc()
+        HTTP_REQUEST_SECONDS.labels(endpoint=endpoint).observe(time.perf_counter() - g.request_start)
+        response.headers["X-Request-ID"] = g.request_id
+        return response
+
+    @app.teardown_request
+    def _reset_request_id(exc):
+        token = g.pop("request_id_token", None)
+        if token is not None:
+            request_id_var.reset(token)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
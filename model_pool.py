@@ -0,0 +1,148 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger("humain")
+
+def current_rss_mb():
+    """Resident memory of this process right now, in MB (0 where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+def default_memory_budget_mb():
+    """Three quarters of physical memory"""
+    return 0.75 * os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+class _Entry:
+    def __init__(self, size_mb):
+        self.model = None
+        self.size_mb = size_mb
+        self.users = 0
+        self.loading = True
+        self.last_used = time.monotonic()
+
+class ModelPool:
+    """Loads models on demand by key and keeps as many as fit a memory budget
+
+    Keys are (backbone_repo, codec_repo, device) tuples passed to loader. A model's
+    size is the growth in resident memory while it loaded; before its first load it
+    is assumed to be as large as the largest model seen so far. To make room for a
+    load, models nobody is using are unloaded least recently used first. If the rest
+    are all in use, the load waits for one to be released, up to load_timeout_s.
+    With idle_ttl_s, models unused for that long are unloaded on the next acquire.
+
+    A lone model larger than the whole budget is still loaded, as there is nothing
+    else to free.
+    """
+
+    def __init__(self, loader, memory_budget_mb=None, idle_ttl_s=None, load_timeout_s=600.0):
+        self.loader = loader
+        self.memory_budget_mb = memory_budget_mb if memory_budget_mb is not None else default_memory_budget_mb()
+        self.idle_ttl_s = idle_ttl_s
+        self.load_timeout_s = load_timeout_s
+        self._cond = threading.Condition()
+        # Loads run one at a time so each one's memory growth is its own
+        self._load_lock = threading.Lock()
+        # Least recently used first
+        self._entries = OrderedDict()
+        # Measured sizes, kept after unloading to size the next load
+        self._sizes = {}
+
+    @property
+    def loaded_keys(self):
+        with self._cond:
+            return [key for key, entry in self._entries.items() if not entry.loading]
+
+    @property
+    def resident_mb(self):
+        with self._cond:
+            return sum(entry.size_mb for entry in self._entries.values())
+
+    @contextmanager
+    def acquire(self, key):
+        """Yield the model for key, loading it if needed; it stays loaded until the block exits"""
+        key = tuple(key)
+        entry = self._checkout(key)
+        try:
+            yield entry.model
+        finally:
+            with self._cond:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+                self._cond.notify_all()
+
+    def _checkout(self, key):
+        deadline = time.monotonic() + self.load_timeout_s
+        with self._cond:
+            self._unload_expired()
+            while True:
+                entry = self._entries.get(key)
+                if entry is not None and not entry.loading:
+                    entry.users += 1
+                    self._entries.move_to_end(key)
+                    return entry
+                if entry is None:
+                    estimate_mb = self._sizes.get(key, max(self._sizes.values(), default=0.0))
+                    if self._make_room(estimate_mb):
+                        break
+                # Another request is loading this model, or everything that would have to go is in use
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Timed out waiting to load {key} within {self.memory_budget_mb:.0f} MB")
+                self._cond.wait(remaining)
+
+            entry = self._entries[key] = _Entry(estimate_mb)
+            entry.users = 1
+
+        try:
+            with self._load_lock:
+                logger.info(f"Loading model {key}")
+                start = time.perf_counter()
+                before = current_rss_mb()
+                model = self.loader(*key)
+                size_mb = max(current_rss_mb() - before, 0.0)
+        except BaseException:
+            with self._cond:
+                del self._entries[key]
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            entry.model = model
+            entry.size_mb = self._sizes[key] = size_mb
+            entry.loading = False
+            self._cond.notify_all()
+        logger.info(f"Loaded model {key} in {time.perf_counter() - start:.1f}s, {size_mb:.0f} MB")
+        return entry
+
+    def _make_room(self, needed_mb):
+        # Called with the condition held; unloads idle models until needed_mb fits
+        used_mb = sum(entry.size_mb for entry in self._entries.values())
+        while self._entries and used_mb + needed_mb > self.memory_budget_mb:
+            idle = next((key for key, entry in self._entries.items() if entry.users == 0 and not entry.loading), None)
+            if idle is None:
+                return False
+            used_mb -= self._entries[idle].size_mb
+            self._unload(idle, 'memory budget')
+        return True
+
+    def _unload_expired(self):
+        if self.idle_ttl_s is None:
+            return
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry.users == 0 and not entry.loading and now - entry.last_used > self.idle_ttl_s:
+                self._unload(key, 'idle')
+
+    def _unload(self, key, reason):
+        entry = self._entries.pop(key)
+        entry.model = None
+        gc.collect()
+        logger.info(f"Unloaded model {key} ({reason}), freeing ~{entry.size_mb:.0f} MB")
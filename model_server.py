@@ -0,0 +1,436 @@
+import builtins
+import logging
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from neuttsair.cancellation import Cancelled, CancellationToken
+
+logger = logging.getLogger("humain")
+
+DEFAULT_SOCKET = "/tmp/neutts_model_server.sock"
+
+class RemoteError(RuntimeError):
+    """An exception raised inside the model server with no matching builtin type"""
+
+def share_array(array):
+    """Copy array into a new shared-memory block and hand its ownership to the receiver
+
+    Returns the message describing the block. The receiver unlinks it after attaching.
+    """
+    array = np.ascontiguousarray(array)
+    # The receiver unlinks the block, so this process's tracker must not clean it up at exit
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1), track=False)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        # Before 3.13 the block is always tracked, under its POSIX name with the leading slash
+        resource_tracker.unregister(f"/{shm.name}", "shared_memory")
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shm.close()
+    return {"shm": shm.name, "shape": array.shape, "dtype": array.dtype.str}
+
+class _AttachedBlock:
+    """Base of the arrays attach_array returns; closes the block once they are all gone
+
+    numpy keeps this object alive through __array_interface__ for as long as any view
+    of the array exists. Its own view is dropped first, so close() finds no exports.
+    """
+
+    def __init__(self, shm, shape, dtype):
+        self._shm = shm
+        self._view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.__array_interface__ = self._view.__array_interface__
+
+    def __del__(self):
+        self._view = None
+        self._shm.close()
+
+def attach_array(message):
+    """Map a block sent with share_array as a numpy array, without copying
+
+    The block is unlinked straight away; the mapping is closed once the array and
+    every view of it have been garbage collected.
+    """
+    shm = shared_memory.SharedMemory(name=message["shm"])
+    shm.unlink()
+    try:
+        block = _AttachedBlock(shm, tuple(message["shape"]), np.dtype(message["dtype"]))
+    except BaseException:
+        shm.close()
+        raise
+    return np.asarray(block)
+
+def discard_array(message):
+    """Free a block from share_array that never reached its receiver"""
+    try:
+        shm = shared_memory.SharedMemory(name=message["shm"])
+    except FileNotFoundError:
+        # The receiver attached it after all
+        return
+    shm.close()
+    shm.unlink()
+
+def authkey_from_env():
+    """The MODEL_SERVER_AUTHKEY shared by the server and its clients, as bytes"""
+    authkey = os.environ.get("MODEL_SERVER_AUTHKEY")
+    if not authkey:
+        raise ValueError("MODEL_SERVER_AUTHKEY must be set to the same secret for the model server and its clients.")
+    return authkey.encode()
+
+def _to_numpy(codes):
+    return codes.cpu().numpy() if hasattr(codes, "cpu") else np.asarray(codes)
+
+class ModelServer:
+    """Owns the NeuTTSAir and Whisper models and serves them over a local socket
+
+    HTTP workers connect with ModelClient, so model memory is paid once per server
+    rather than once per worker. Requests are small pickled messages; waveforms in
+    either direction travel through shared-memory blocks (see share_array). The socket
+    is owner-only and connections must present authkey, as messages are pickles. Each
+    connection gets a thread. Calls into a TTS model run up to its max_concurrency
+    at a time (one per GGUF backbone replica); Whisper calls are serialized.
+
+    With a ModelPool, calls name the model they want by pool key, or get
+    default_model; different models run concurrently. Without one, every call
+    goes to tts.
+
+    Generation stops early when the client's deadline (timeout_s) passes or the client
+    hangs up mid-call, so abandoned requests don't hold the models.
+    """
+
+    # How often a running call checks whether its client hung up
+    POLL_S = 0.25
+
+    def __init__(self, tts=None, whisper_model=None, address=DEFAULT_SOCKET, authkey=None, pool=None, default_model=None):
+        if not authkey:
+            raise ValueError("ModelServer requires an authkey; any local user could otherwise send it pickles.")
+        self.tts = tts
+        self.whisper_model = whisper_model
+        self.address = address
+        self.authkey = authkey
+        self.pool = pool
+        self.default_model = tuple(default_model) if default_model is not None else None
+        self._model_lock = threading.Lock()
+        # Concurrent-call slots per TTS model, keyed by pool key (None for tts)
+        self._slots = {}
+        # Per connection thread: blocks sent that the client may not have attached yet
+        self._local = threading.local()
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        # Create the socket owner-only from the start; a chmod after bind leaves a window
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        with listener:
+            logger.info(f"Model server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logger.warning(f"Rejected model server connection: {str(e)}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn):
+        # Blocks sent since the client's last request; a client only sends another request once it
+        # has attached every block of the previous reply, so those left when it hangs up are orphans
+        self._local.shared = []
+        with conn:
+            try:
+                self._handle_requests(conn)
+            finally:
+                for message in self._local.shared:
+                    discard_array(message)
+
+    def _handle_requests(self, conn):
+        while True:
+            try:
+                method, kwargs = conn.recv()
+            except (EOFError, OSError):
+                return
+            self._local.shared.clear()
+            try:
+                if method == "infer_stream":
+                    with self._cancellation(conn, kwargs.pop("timeout_s", None)) as cancel:
+                        self._stream(conn, cancel=cancel, **kwargs)
+                elif method == "infer":
+                    with self._cancellation(conn, kwargs.pop("timeout_s", None)) as cancel:
+                        self._send(conn, "ok", self._rpc_infer(cancel=cancel, **kwargs))
+                else:
+                    self._send(conn, "ok", getattr(self, f"_rpc_{method}")(**kwargs))
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            except Cancelled as e:
+                logger.info(f"Model server {method} cancelled: {e.reason}")
+                try:
+                    conn.send(("cancelled", e.reason))
+                except OSError:
+                    return
+            except Exception as e:
+                logger.exception(f"Model server {method} failed: {str(e)}")
+                conn.send(("error", (type(e).__name__, str(e))))
+
+    @contextmanager
+    def _cancellation(self, conn, timeout_s):
+        # A client waits for its reply without sending, so the connection turning readable
+        # mid-call means it hung up
+        cancel = CancellationToken(timeout_s)
+        done = threading.Event()
+
+        def watch():
+            while not done.is_set():
+                try:
+                    if conn.poll(self.POLL_S):
+                        cancel.cancel("disconnected")
+                        return
+                except (OSError, ValueError):
+                    return
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            yield cancel
+        finally:
+            done.set()
+            watcher.join()
+
+    @contextmanager
+    def _model(self, model=None):
+        # Yields the TTS model a call asked for, holding one of its slots for the call
+        if self.pool is None:
+            if model is not None:
+                raise NotImplementedError("This model server serves a single model; start it with a model pool to select one.")
+            with self._slots_for(None, self.tts):
+                yield self.tts
+            return
+        key = tuple(model) if model is not None else self.default_model
+        with self.pool.acquire(key) as tts:
+            with self._slots_for(key, tts):
+                yield tts
+
+    def _slots_for(self, key, tts):
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots.setdefault(key, threading.BoundedSemaphore(getattr(tts, "max_concurrency", 1)))
+        return slots
+
+    def _send(self, conn, status, result):
+        shared = isinstance(result, dict) and "shm" in result
+        try:
+            conn.send((status, result))
+        except OSError:
+            if shared:
+                discard_array(result)
+            raise
+        if shared:
+            self._local.shared.append(result)
+
+    def _rpc_info(self, model=None):
+        with self._model(model) as tts:
+            return {"sample_rate": tts.sample_rate, "whisper": self.whisper_model is not None}
+
+    def _rpc_encode_reference(self, ref_audio, model=None):
+        if isinstance(ref_audio, dict):
+            ref_audio = attach_array(ref_audio)
+        with self._model(model) as tts:
+            return _to_numpy(tts.encode_reference(ref_audio))
+
+    def _rpc_count_prompt_tokens(self, ref_codes, ref_text, model=None):
+        with self._model(model) as tts:
+            return tts.count_prompt_tokens(ref_codes, ref_text)
+
+    def _rpc_infer(self, text, ref_codes, ref_text, model=None, cancel=None):
+        with self._model(model) as tts:
+            wav = tts.infer(text, ref_codes, ref_text, cancel=cancel)
+        return share_array(wav)
+
+    def _rpc_transcribe(self, audio, model=None):
+        if self.whisper_model is None:
+            raise NotImplementedError("This model server was started without Whisper.")
+        audio = attach_array(audio)
+        with self._model_lock:
+            return self.whisper_model.transcribe(audio)
+
+    def _stream(self, conn, text, ref_codes, ref_text, schedule=None, model=None, cancel=None):
+        with self._model(model) as tts:
+            stream = tts.infer_stream(text, ref_codes, ref_text, schedule=schedule, cancel=cancel)
+            try:
+                for chunk in stream:
+                    # A client that stopped reading has closed the socket; the send fails and generation stops
+                    self._send(conn, "chunk", share_array(chunk))
+            finally:
+                stream.close()
+        conn.send(("end", None))
+
+class ModelClient:
+    """Drop-in for the NeuTTSAir and Whisper methods the app uses, served by a ModelServer
+
+    Waveforms come back as numpy views of shared memory, with no pickling or copy.
+    Connections are per thread, as a connection carries one call at a time.
+    With model, a pool key, calls go to that model of a pooled server.
+    """
+
+    # How often a call waiting for its reply checks its CancellationToken
+    POLL_S = 0.25
+
+    def __init__(self, address=DEFAULT_SOCKET, authkey=None, model=None):
+        if not authkey:
+            raise ValueError("ModelClient requires the model server's authkey.")
+        self.address = address
+        self.authkey = authkey
+        self.model = tuple(model) if model is not None else None
+        self._local = threading.local()
+        self.sample_rate = self._call("info")["sample_rate"]
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _raise(error):
+        name, message = error
+        exc_type = getattr(builtins, name, None)
+        if isinstance(exc_type, type) and issubclass(exc_type, Exception):
+            raise exc_type(message)
+        raise RemoteError(f"{name}: {message}")
+
+    def _call(self, method, cancel=None, **kwargs):
+        conn = self._connection()
+        try:
+            conn.send((method, dict(kwargs, model=self.model)))
+            while cancel is not None and not conn.poll(self.POLL_S):
+                if cancel.cancelled:
+                    # Hanging up is how the server learns to stop; the reply would arrive on a dead call
+                    self._drop_connection()
+                    cancel.check()
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            # The server restarted; the next call reconnects
+            self._drop_connection()
+            raise
+        if status == "error":
+            self._raise(result)
+        if status == "cancelled":
+            raise Cancelled(result)
+        return result
+
+    def encode_reference(self, ref_audio):
+        if isinstance(ref_audio, np.ndarray):
+            ref_audio = share_array(ref_audio.astype(np.float32, copy=False))
+        else:
+            ref_audio = str(os.path.abspath(ref_audio))
+        return self._call("encode_reference", ref_audio=ref_audio)
+
+    def count_prompt_tokens(self, ref_codes, ref_text):
+        return self._call("count_prompt_tokens", ref_codes=_to_numpy(ref_codes), ref_text=ref_text)
+
+    def infer(self, text, ref_codes, ref_text, cancel=None):
+        timeout_s = cancel.remaining_s() if cancel is not None else None
+        return attach_array(self._call(
+            "infer", cancel=cancel, text=text, ref_codes=_to_numpy(ref_codes), ref_text=ref_text, timeout_s=timeout_s,
+        ))
+
+    def infer_stream(self, text, ref_codes, ref_text, schedule=None, cancel=None):
+        conn = self._connection()
+        conn.send(("infer_stream", {
+            "text": text, "ref_codes": _to_numpy(ref_codes), "ref_text": ref_text, "schedule": schedule,
+            "model": self.model, "timeout_s": cancel.remaining_s() if cancel is not None else None,
+        }))
+        finished = False
+        try:
+            while True:
+                status, result = conn.recv()
+                if status == "end":
+                    finished = True
+                    return
+                if status == "error":
+                    finished = True
+                    self._raise(result)
+                if status == "cancelled":
+                    finished = True
+                    raise Cancelled(result)
+                yield attach_array(result)
+                if cancel is not None and cancel.cancelled:
+                    # Leaves through the finally below, which hangs up and stops the server
+                    cancel.check()
+        finally:
+            if not finished:
+                # Abandoned mid-stream: the rest of the stream is still in flight, so this
+                # connection can't be reused; closing it also stops generation on the server
+                self._drop_connection()
+
+    def transcribe(self, audio, **kwargs):
+        return self._call("transcribe", audio=share_array(np.asarray(audio, dtype=np.float32)))
+
+if __name__ == "__main__":
+    import argparse
+    import whisper
+    from prometheus_client import start_http_server
+    from metrics import MODEL_POOL_LOADED, MODEL_POOL_RESIDENT_MB, PrometheusHook, setup_logging
+    from model_pool import ModelPool
+    from neuttsair.neutts import NeuTTSAir
+    from neuttsair.resources import ResourceConfig
+
+    parser = argparse.ArgumentParser(description="Serve NeuTTSAir and Whisper to HTTP workers over a local socket")
+    parser.add_argument("--socket", type=str, default=os.environ.get("MODEL_SERVER_SOCKET", DEFAULT_SOCKET), help="Unix socket path")
+    parser.add_argument("--backbone", type=str, default="neuphonic/neutts-air-q4-gguf", help="Backbone repo of the default model")
+    parser.add_argument("--codec", type=str, default="neuphonic/neucodec", help="Codec repo of the default model")
+    parser.add_argument("--memory_budget_mb", type=float, default=None, help="Memory for loaded TTS models (default: 75%% of RAM)")
+    parser.add_argument("--idle_ttl", type=float, default=None, help="Unload TTS models unused for this many seconds")
+    parser.add_argument("--whisper", type=str, default="base", help="Whisper model, or empty to disable transcription")
+    parser.add_argument("--metrics_port", type=int, default=0, help="Serve Prometheus metrics on this port")
+    args = parser.parse_args()
+
+    try:
+        authkey = authkey_from_env()
+    except ValueError as e:
+        parser.error(str(e))
+
+    setup_logging()
+    resources = ResourceConfig.from_env()
+    resources.apply()
+
+    def load_tts(backbone_repo, codec_repo, device):
+        return NeuTTSAir(
+            backbone_repo=backbone_repo,
+            backbone_device=device,
+            codec_repo=codec_repo,
+            codec_device=device,
+            hooks=[PrometheusHook()],
+            resources=resources,
+        )
+
+    # Clients pick a model by (backbone_repo, codec_repo, device); each loads on first use
+    pool = ModelPool(load_tts, memory_budget_mb=args.memory_budget_mb, idle_ttl_s=args.idle_ttl)
+    MODEL_POOL_LOADED.set_function(lambda: len(pool.loaded_keys))
+    MODEL_POOL_RESIDENT_MB.set_function(lambda: pool.resident_mb)
+    default_model = (args.backbone, args.codec, resources.device)
+    with pool.acquire(default_model):
+        pass
+
+    server = ModelServer(
+        whisper_model=whisper.load_model(args.whisper, device=resources.device) if args.whisper else None,
+        address=args.socket,
+        authkey=authkey,
+        pool=pool,
+        default_model=default_model,
+    )
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    server.serve_forever()
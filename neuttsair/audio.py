@@ -0,0 +1,226 @@
+import math
+import os
+from pathlib import Path
+from typing import Callable
+import numpy as np
+import soundfile as sf
+import soxr
+
+
+REFERENCE_SAMPLE_RATE = 16_000
+
+
+def load_audio(path: str | Path) -> tuple[np.ndarray, int]:
+    """
+    Decode an audio file to a mono float32 array at its native sample rate.
+
+    soundfile handles WAV/FLAC/OGG/MP3 directly; anything libsndfile can't read
+    (e.g. browser-recorded webm) falls back to librosa's audioread/ffmpeg loader.
+
+    Args:
+        path (str | Path): Audio file to decode.
+    Returns:
+        tuple[np.ndarray, int]: Mono waveform and its sample rate.
+    """
+    try:
+        wav, sr = sf.read(path, dtype="float32", always_2d=True)
+        wav = wav.mean(axis=1) if wav.shape[1] > 1 else wav[:, 0]
+    except sf.LibsndfileError:
+        import librosa
+
+        wav, sr = librosa.load(path, sr=None, mono=True)
+    return np.ascontiguousarray(wav, dtype=np.float32), sr
+
+
+def resample(wav: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    if orig_sr == target_sr:
+        return wav
+    return soxr.resample(wav, orig_sr, target_sr, quality="HQ").astype(np.float32, copy=False)
+
+
+def reference_array_path(audio_path: str | Path) -> Path:
+    return Path(audio_path).with_suffix(".npy")
+
+
+def _save_array(path: Path, array: np.ndarray):
+    # Write then rename so concurrent readers never map a partially written file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def _store_reference(wav: np.ndarray, sr: int, ref_wav: np.ndarray, wav_path: str | Path):
+    sf.write(wav_path, wav, sr)
+    _save_array(reference_array_path(wav_path), np.ascontiguousarray(ref_wav))
+
+
+def ingest_reference(src_path: str | Path, wav_path: str | Path) -> np.ndarray:
+    """
+    Decode an uploaded reference once and store everything later stages need.
+
+    Writes a mono WAV at the source sample rate to `wav_path` for playback, and the
+    16 kHz mono float32 waveform the codec encoder consumes to a `.npy` beside it.
+
+    Args:
+        src_path (str | Path): Uploaded audio in any supported format.
+        wav_path (str | Path): Destination WAV path.
+    Returns:
+        np.ndarray: The 16 kHz reference waveform.
+    """
+    wav, sr = load_audio(src_path)
+    ref_wav = resample(wav, sr, REFERENCE_SAMPLE_RATE)
+    _store_reference(wav, sr, ref_wav, wav_path)
+    return ref_wav
+
+
+def trim_silence(
+    wav: np.ndarray,
+    sr: int,
+    threshold_db: float = -40.0,
+    frame_ms: float = 30.0,
+    pad_ms: float = 150.0,
+) -> np.ndarray:
+    """
+    Cut leading and trailing silence with a frame-energy VAD.
+
+    A frame is voiced when its RMS is within `threshold_db` of the loudest frame;
+    everything before the first and after the last voiced frame, less `pad_ms`,
+    is dropped. Pauses inside the clip are kept.
+
+    Args:
+        wav (np.ndarray): Mono waveform.
+        sr (int): Sample rate of `wav`.
+        threshold_db (float): Voicing threshold relative to the loudest frame.
+        frame_ms (float): Analysis frame length.
+        pad_ms (float): Margin kept around the voiced region.
+    Returns:
+        np.ndarray: A view of `wav` covering the voiced region.
+    """
+    frame = max(int(sr * frame_ms / 1000), 1)
+    n_frames = len(wav) // frame
+    if n_frames == 0:
+        return wav
+
+    rms = np.sqrt(np.mean(wav[: n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    level_db = 20 * np.log10(np.maximum(rms, 1e-10) / max(rms.max(), 1e-10))
+    voiced = np.flatnonzero(level_db > threshold_db)
+    if len(voiced) == 0:
+        return wav
+
+    pad = int(sr * pad_ms / 1000)
+    start = max(voiced[0] * frame - pad, 0)
+    end = min((voiced[-1] + 1) * frame + pad, len(wav))
+    return wav[start:end]
+
+
+def _segment_score(segment: dict) -> float:
+    # Speech time weighted by Whisper's confidence that it is speech and transcribed right
+    duration = segment["end"] - segment["start"]
+    confidence = math.exp(segment.get("avg_logprob", 0.0)) * (1.0 - segment.get("no_speech_prob", 0.0))
+    return duration * confidence
+
+
+def select_reference_span(
+    segments: list[dict],
+    total_s: float,
+    max_duration_s: float,
+    pad_s: float = 0.1,
+) -> tuple[float, float, str]:
+    """
+    Pick the best contiguous run of transcript segments that fits in `max_duration_s`.
+
+    Runs are scored by confidence-weighted speech time, so a span that is mostly
+    clear speech beats a longer one padded with mumbling. The span is widened by
+    `pad_s` on each side, without reaching into the neighbouring segments, since
+    Whisper's boundaries tend to clip word onsets and tails.
+
+    Args:
+        segments (list[dict]): Whisper segments with `start`, `end` and `text`.
+        total_s (float): Duration of the transcribed audio.
+        max_duration_s (float): Longest span to keep.
+        pad_s (float): Margin added around the chosen segments.
+    Returns:
+        tuple[float, float, str]: Span start and end in seconds and its transcript.
+    """
+    if not segments:
+        return 0.0, min(total_s, max_duration_s), ""
+
+    best, best_score = None, -1.0
+    for i in range(len(segments)):
+        score = 0.0
+        for j in range(i, len(segments)):
+            if segments[j]["end"] - segments[i]["start"] > max_duration_s:
+                break
+            score += _segment_score(segments[j])
+            if score > best_score:
+                best, best_score = (i, j), score
+
+    if best is None:
+        # Every segment is longer than the cap; keep the best one whole so audio and text still match
+        i = j = max(range(len(segments)), key=lambda k: _segment_score(segments[k]))
+    else:
+        i, j = best
+
+    lower = segments[i - 1]["end"] if i > 0 else 0.0
+    upper = segments[j + 1]["start"] if j + 1 < len(segments) else total_s
+    start = max(segments[i]["start"] - pad_s, lower)
+    end = min(segments[j]["end"] + pad_s, upper)
+    text = " ".join(segment["text"].strip() for segment in segments[i : j + 1])
+    return start, end, text
+
+
+def compact_reference(
+    src_path: str | Path,
+    wav_path: str | Path,
+    transcribe: Callable[[np.ndarray], list[dict]],
+    max_duration_s: float = 12.0,
+) -> tuple[np.ndarray, str]:
+    """
+    Ingest an uploaded reference, trimmed to the span that makes the best prompt.
+
+    Every reference code lands in every prompt, so long uploads slow prefill and
+    eat into the context left for generation. Silence is cut from both ends, the
+    remainder transcribed, and the best run of segments up to `max_duration_s` kept
+    together with its slice of the transcript. Storage matches `ingest_reference`.
+
+    Args:
+        src_path (str | Path): Uploaded audio in any supported format.
+        wav_path (str | Path): Destination WAV path.
+        transcribe (Callable): Maps a 16 kHz waveform to Whisper-style segments.
+        max_duration_s (float): Longest reference to keep.
+    Returns:
+        tuple[np.ndarray, str]: The 16 kHz reference waveform and its transcript.
+    """
+    wav, sr = load_audio(src_path)
+    wav = trim_silence(wav, sr)
+    ref_wav = resample(wav, sr, REFERENCE_SAMPLE_RATE)
+
+    start, end, ref_text = select_reference_span(
+        transcribe(ref_wav), len(ref_wav) / REFERENCE_SAMPLE_RATE, max_duration_s
+    )
+    wav = wav[int(start * sr) : int(end * sr)]
+    ref_wav = ref_wav[int(start * REFERENCE_SAMPLE_RATE) : int(end * REFERENCE_SAMPLE_RATE)]
+
+    _store_reference(wav, sr, ref_wav, wav_path)
+    return np.ascontiguousarray(ref_wav), ref_text
+
+
+def load_reference(audio_path: str | Path) -> np.ndarray:
+    """
+    Load the 16 kHz reference waveform for `audio_path` as a memory-mapped array.
+
+    The `.npy` is built on first use for references that predate ingest (e.g. the
+    bundled samples) and rebuilt if the WAV has been replaced since.
+
+    Args:
+        audio_path (str | Path): Reference WAV path.
+    Returns:
+        np.ndarray: Copy-on-write memory map of the 16 kHz waveform.
+    """
+    npy_path = reference_array_path(audio_path)
+    if not npy_path.exists() or npy_path.stat().st_mtime < Path(audio_path).stat().st_mtime:
+        wav, sr = load_audio(audio_path)
+        _save_array(npy_path, resample(wav, sr, REFERENCE_SAMPLE_RATE))
+    # Copy-on-write keeps the map writable so torch.from_numpy can wrap it without copying
+    return np.load(npy_path, mmap_mode="c")
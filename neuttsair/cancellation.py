@@ -0,0 +1,72 @@
+import time
+from typing import Iterable
+
+
+class Cancelled(Exception):
+    """
+    Raised when inference stops because its `CancellationToken` fired.
+
+    Args:
+        reason (str): Why, e.g. "deadline" or "disconnected".
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Inference cancelled: {reason}")
+        self.reason = reason
+
+
+class CancellationToken:
+    """
+    Tells running inference to stop: when `cancel` is called, e.g. because the client
+    disconnected, or when its deadline passes. `NeuTTSAir` checks it after every
+    generated token and raises `Cancelled`.
+
+    A token can stand for several requests sharing one computation: with `linked`
+    tokens it also counts as cancelled once every linked token is, so the work
+    stops only when nobody is waiting for it.
+
+    Args:
+        timeout_s (float | None): Seconds from now to the deadline; None for no deadline.
+        linked (Iterable[CancellationToken]): Tokens of the requests this work serves.
+    """
+
+    def __init__(self, timeout_s: float | None = None, linked: Iterable["CancellationToken"] = ()):
+        self.deadline = time.monotonic() + timeout_s if timeout_s is not None else None
+        self._reason = None
+        self._linked = list(linked)
+
+    def cancel(self, reason: str = "cancelled"):
+        """Cancel the token; the first reason given is kept."""
+        if self._reason is None:
+            self._reason = reason
+
+    def link(self, token: "CancellationToken"):
+        """Add a request to those this token's work serves."""
+        self._linked.append(token)
+
+    @property
+    def reason(self) -> str | None:
+        """Why the token is cancelled, or None if it is not."""
+        if self._reason is not None:
+            return self._reason
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return "deadline"
+        if self._linked:
+            reasons = [token.reason for token in self._linked]
+            if all(reasons):
+                return reasons[-1]
+        return None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def remaining_s(self) -> float | None:
+        """Seconds left until the deadline, or None without one."""
+        return None if self.deadline is None else max(self.deadline - time.monotonic(), 0.0)
+
+    def check(self):
+        """Raise `Cancelled` if the token is cancelled."""
+        reason = self.reason
+        if reason is not None:
+            raise Cancelled(reason)
@@ -0,0 +1,21 @@
+class InferenceHook:
+    """
+    Receives per-stage timings from NeuTTSAir. Subclass and override `on_stage`.
+
+    Stages:
+        phonemize: espeak phonemization of one text.
+        prompt_build: prompt construction, including its phonemize calls.
+        prefill: prompt evaluation up to the first generated token.
+        decode_step: each generated token after the first.
+        codec_decode: codec decode of speech tokens to a waveform.
+        watermark: watermarking of a decoded waveform.
+        encode_reference: codec encoding of a reference.
+        backbone_wait: wait for a free GGUF backbone replica before generating.
+        cancelled: generation stopped by a CancellationToken; the duration is the time spent
+            generating, with `reason` and `n_tokens` generated in info.
+
+    Hooks run synchronously on the inference thread, so keep them cheap.
+    """
+
+    def on_stage(self, stage: str, duration_s: float, **info) -> None:
+        pass
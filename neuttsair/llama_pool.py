@@ -0,0 +1,86 @@
+import queue
+from contextlib import contextmanager
+from typing import Generator
+
+from .cancellation import CancellationToken
+
+
+def llama_context_bytes(llm) -> int:
+    """
+    Estimate the memory each further llama.cpp context over `llm`'s weights costs.
+
+    Weights loaded with `use_mmap` are file-backed pages every context shares, so a
+    replica adds mainly its KV cache (f16 keys and values for `n_ctx` positions in
+    every layer) and llama-cpp-python's `scores` buffer (`n_batch` rows of `n_vocab`
+    float32, large with the speech-token vocabulary). llama.cpp's compute buffers
+    come on top, so treat the result as a lower bound.
+
+    Args:
+        llm (llama_cpp.Llama): A loaded context.
+    Returns:
+        int: Bytes per additional context.
+    """
+    arch = llm.metadata.get("general.architecture", "")
+
+    def meta(key, default):
+        return int(llm.metadata.get(f"{arch}.{key}", default))
+
+    n_layer = meta("block_count", 0)
+    n_embd = meta("embedding_length", 0)
+    n_head = meta("attention.head_count", 1)
+    n_head_kv = meta("attention.head_count_kv", n_head)
+    kv_bytes = 2 * n_layer * llm.n_ctx() * (n_embd // n_head) * n_head_kv * 2
+    scores_bytes = llm.n_batch * llm.n_vocab() * 4
+    return kv_bytes + scores_bytes
+
+
+class LlamaReplicaPool:
+    """
+    llama.cpp contexts checked out by one request at a time.
+
+    A `Llama` holds a single KV cache and is not safe for concurrent calls, so each
+    running request takes its own replica and returns it when done. The replica
+    returned last is handed out first: llama-cpp-python reuses the KV cache for the
+    prompt prefix it shares with the context's previous prompt, and recent requests
+    are the likeliest to share a voice.
+
+    Args:
+        replicas (list[llama_cpp.Llama]): Contexts, normally over the same mmap'd weights.
+    """
+
+    # How often a request waiting for a replica checks its CancellationToken
+    POLL_S = 0.25
+
+    def __init__(self, replicas: list):
+        self.replicas = list(replicas)
+        self._idle = queue.LifoQueue()
+        for replica in self.replicas:
+            self._idle.put(replica)
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    @property
+    def n_idle(self) -> int:
+        return self._idle.qsize()
+
+    @contextmanager
+    def checkout(self, cancel: CancellationToken | None = None) -> Generator:
+        """
+        Wait for an idle replica and hold it for the block.
+
+        Args:
+            cancel (CancellationToken | None): Stops waiting, raising `Cancelled`.
+        Yields:
+            llama_cpp.Llama: The replica, exclusively this caller's until the block exits.
+        """
+        while True:
+            try:
+                replica = self._idle.get(timeout=self.POLL_S if cancel is not None else None)
+                break
+            except queue.Empty:
+                cancel.check()
+        try:
+            yield replica
+        finally:
+            self._idle.put(replica)
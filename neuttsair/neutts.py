@@ -1,41 +1,50 @@
-from typing import Generator
+from typing import Generator, Iterable
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-import librosa
+import time
 import numpy as np
 import torch
 import re
 import perth
 from neucodec import NeuCodec, DistillNeuCodec
 from phonemizer.backend import EspeakBackend
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
-from threading import Thread
+from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+from threading import Lock, Thread
+from .audio import load_reference
+from .cancellation import Cancelled, CancellationToken
+from .hooks import InferenceHook
+from .llama_pool import LlamaReplicaPool, llama_context_bytes
+from .onnx_codec import OnnxCodecDecoder
+from .profiling import InferenceProfiler
+from .resources import ResourceConfig, available_memory_bytes, resolve_device
+from .streaming import StreamDecoder, StreamingSchedule, compare_stream_decoding
 
 
-def _linear_overlap_add(frames: list[np.ndarray], stride: int) -> np.ndarray:
-    # original impl --> https://github.com/facebookresearch/encodec/blob/main/encodec/utils.py
-    assert len(frames)
-    dtype = frames[0].dtype
-    shape = frames[0].shape[:-1]
+_SPEECH_TOKEN_RE = re.compile(r"<\|speech_(\d+)\|>")
 
-    total_size = 0
-    for i, frame in enumerate(frames):
-        frame_end = stride * i + frame.shape[-1]
-        total_size = max(total_size, frame_end)
 
-    sum_weight = np.zeros(total_size, dtype=dtype)
-    out = np.zeros(*shape, total_size, dtype=dtype)
+class _StepTimer(StoppingCriteria):
+    # Called by `generate` after every sampled token; never stops generation itself
+    def __init__(self, tts: "NeuTTSAir"):
+        self.tts = tts
+        self.n_steps = 0
+        self.last = time.perf_counter()
 
-    offset: int = 0
-    for frame in frames:
-        frame_length = frame.shape[-1]
-        t = np.linspace(0, 1, frame_length + 2, dtype=dtype)[1:-1]
-        weight = np.abs(0.5 - (t - 0.5))
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        now = time.perf_counter()
+        self.tts._emit("prefill" if self.n_steps == 0 else "decode_step", now - self.last)
+        self.n_steps += 1
+        self.last = now
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
 
-        out[..., offset : offset + frame_length] += weight * frame
-        sum_weight[offset : offset + frame_length] += weight
-        offset += stride
-    assert sum_weight.min() > 0
-    return out / sum_weight
+
+class _CancelCriteria(StoppingCriteria):
+    # Stops `generate` after the token during which the request was cancelled
+    def __init__(self, cancel: CancellationToken):
+        self.cancel = cancel
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.cancel.cancelled, dtype=torch.bool, device=input_ids.device)
 
 
 class NeuTTSAir:
@@ -46,17 +55,32 @@ class NeuTTSAir:
         backbone_device="cpu",
         codec_repo="neuphonic/neucodec",
         codec_device="cpu",
+        hooks: list[InferenceHook] | None = None,
+        profiler: InferenceProfiler | None = None,
+        resources: ResourceConfig | None = None,
     ):
 
+        # Thread budget for llama.cpp and ONNX Runtime; torch's is process-wide, see ResourceConfig.apply
+        self.resources = resources or ResourceConfig()
+
+        # Per-stage timing observers
+        self.hooks: list[InferenceHook] = list(hooks or [])
+
+        # Optional on-demand profiling of infer / infer_stream
+        self.profiler = profiler
+        if profiler is not None:
+            self.hooks.append(profiler)
+
         # Consts
         self.sample_rate = 24_000
         self.max_context = 2048
         self.hop_length = 480
-        self.streaming_overlap_frames = 1
-        self.streaming_frames_per_chunk = 25
-        self.streaming_lookforward = 5
-        self.streaming_lookback = 50
-        self.streaming_stride_samples = self.streaming_frames_per_chunk * self.hop_length
+
+        # Default chunking for infer_stream; each call may pass its own schedule
+        self.streaming_schedule = StreamingSchedule()
+        # Codes per streaming decode, from the first small chunks to the steady state; the ONNX
+        # decoder preallocates each, so the time-to-first-audio decodes are bound too
+        self.streaming_window_frames = self.streaming_schedule.decode_windows
 
         # ggml & onnx flags
         self._is_quantized_model = False
@@ -65,20 +89,90 @@ class NeuTTSAir:
         # HF tokenizer
         self.tokenizer = None
 
+        # GGUF contexts for concurrent requests; `backbone` is the first of them
+        self.backbone_pool = None
+
+        # espeak keeps global state, so phonemization runs one call at a time
+        self._phonemizer_lock = Lock()
+
         # Load phonemizer + models
-        print("Loading phonemizer...")
-        self.phonemizer = EspeakBackend(
-            language="en-us", preserve_punctuation=True, with_stress=True
-        )
+        self._load_phonemizer()
 
         self._load_backbone(backbone_repo, backbone_device)
+        if self._is_quantized_model and self.backbone_pool is None:
+            self.backbone_pool = LlamaReplicaPool([self.backbone])
 
         self._load_codec(codec_repo, codec_device)
 
         # Load watermarker
+        self._load_watermarker()
+
+    @property
+    def max_concurrency(self) -> int:
+        """Requests that can run at once: one per GGUF replica, or one on the torch backend."""
+        return len(self.backbone_pool) if self.backbone_pool is not None else 1
+
+    def add_hook(self, hook: InferenceHook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: InferenceHook):
+        self.hooks.remove(hook)
+
+    def _emit(self, stage: str, duration_s: float, **info):
+        for hook in self.hooks:
+            hook.on_stage(stage, duration_s, **info)
+
+    @contextmanager
+    def _timed(self, stage: str, **info):
+        start = time.perf_counter()
+        yield
+        self._emit(stage, time.perf_counter() - start, **info)
+
+    def _cancellable(self, items: Iterable, cancel: CancellationToken | None) -> Generator:
+        # Stop pulling from a llama.cpp stream once cancel fires; closing the stream ends generation
+        if cancel is None:
+            yield from items
+            return
+        start = time.perf_counter()
+        n_tokens = 0
+        try:
+            for item in items:
+                if cancel.cancelled:
+                    self._emit("cancelled", time.perf_counter() - start, reason=cancel.reason, n_tokens=n_tokens)
+                    raise Cancelled(cancel.reason)
+                n_tokens += 1
+                yield item
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    @contextmanager
+    def _checkout_backbone(self, cancel: CancellationToken | None = None):
+        # Waiting for a free replica is timed as its own stage, as it is queueing rather than compute
+        start = time.perf_counter()
+        with self.backbone_pool.checkout(cancel) as backbone:
+            self._emit("backbone_wait", time.perf_counter() - start)
+            yield backbone
+
+    def _timed_tokens(self, items: Iterable) -> Generator:
+        # Time each item pulled from a llama.cpp stream, excluding the consumer's work between pulls
+        start = time.perf_counter()
+        for i, item in enumerate(items):
+            self._emit("prefill" if i == 0 else "decode_step", time.perf_counter() - start)
+            yield item
+            start = time.perf_counter()
+
+    def _load_phonemizer(self):
+        print("Loading phonemizer...")
+        self.phonemizer = EspeakBackend(
+            language="en-us", preserve_punctuation=True, with_stress=True
+        )
+
+    def _load_watermarker(self):
         self.watermarker = perth.PerthImplicitWatermarker()
 
     def _load_backbone(self, backbone_repo, backbone_device):
+        backbone_device = resolve_device(backbone_device)
         print(f"Loading backbone from: {backbone_repo} on {backbone_device} ...")
 
         # GGUF loading
@@ -93,15 +187,38 @@ class NeuTTSAir:
                     "    pip install llama-cpp-python"
                 ) from e
 
-            self.backbone = Llama.from_pretrained(
-                repo_id=backbone_repo,
-                filename="*.gguf",
+            on_gpu = backbone_device in ("gpu", "cuda")
+            llama_kwargs = dict(
                 verbose=False,
-                n_gpu_layers=-1 if backbone_device == "gpu" else 0,
+                n_gpu_layers=-1 if on_gpu else 0,
                 n_ctx=self.max_context,
+                use_mmap=True,
                 mlock=True,
-                flash_attn=True if backbone_device == "gpu" else False,
+                flash_attn=on_gpu,
             )
+            # Replicas map the same GGUF file, so the weights are in memory once and each
+            # replica adds only its own KV cache; as many load as also fit in half the free memory
+            n_replicas = self.resources.llama_replicas
+            self.backbone = Llama.from_pretrained(
+                repo_id=backbone_repo,
+                filename="*.gguf",
+                **llama_kwargs,
+                **self.resources.llama_kwargs(n_replicas),
+            )
+            if n_replicas > 1:
+                fits = 1 + available_memory_bytes() // 2 // max(llama_context_bytes(self.backbone), 1)
+                if fits < n_replicas:
+                    n_replicas = fits
+                    # Re-created with the larger per-replica thread share; the weights stay mapped
+                    self.backbone = Llama(
+                        model_path=self.backbone.model_path, **llama_kwargs, **self.resources.llama_kwargs(n_replicas)
+                    )
+            replicas = [self.backbone] + [
+                Llama(model_path=self.backbone.model_path, **llama_kwargs, **self.resources.llama_kwargs(n_replicas))
+                for _ in range(n_replicas - 1)
+            ]
+            self.backbone_pool = LlamaReplicaPool(replicas)
+            print(f"Loaded {n_replicas} backbone replica(s), {self.resources.llama_kwargs(n_replicas)['n_threads']} threads each")
             self._is_quantized_model = True
 
         else:
@@ -112,6 +229,8 @@ class NeuTTSAir:
 
     def _load_codec(self, codec_repo, codec_device):
 
+        if codec_device == "auto":
+            codec_device = "cpu" if codec_repo == "neuphonic/neucodec-onnx-decoder" else resolve_device(codec_device)
         print(f"Loading codec from: {codec_repo} on {codec_device} ...")
         match codec_repo:
             case "neuphonic/neucodec":
@@ -126,14 +245,19 @@ class NeuTTSAir:
                     raise ValueError("Onnx decoder only currently runs on CPU.")
 
                 try:
-                    from neucodec import NeuCodecOnnxDecoder
+                    import onnxruntime  # noqa: F401
+                    from huggingface_hub import hf_hub_download
                 except ImportError as e:
                     raise ImportError(
                         "Failed to import the onnx decoder."
                         " Ensure you have onnxruntime installed as well as neucodec >= 0.0.4."
                     ) from e
 
-                self.codec = NeuCodecOnnxDecoder.from_pretrained(codec_repo)
+                # Our own session rather than NeuCodecOnnxDecoder's, which re-optimizes the graph on every start
+                onnx_path = hf_hub_download(repo_id=codec_repo, filename="model.onnx")
+                self.codec = OnnxCodecDecoder.from_env(onnx_path, resources=self.resources)
+                for n_frames in self.streaming_window_frames:
+                    self.codec.preallocate(n_frames)
                 self._is_onnx_codec = True
 
             case _:
@@ -143,7 +267,13 @@ class NeuTTSAir:
                     " 'neuphonic/neucodec-onnx-decoder'."
                 )
 
-    def infer(self, text: str, ref_codes: np.ndarray | torch.Tensor, ref_text: str) -> np.ndarray:
+    def infer(
+        self,
+        text: str,
+        ref_codes: np.ndarray | torch.Tensor,
+        ref_text: str,
+        cancel: CancellationToken | None = None,
+    ) -> np.ndarray:
         """
         Perform inference to generate speech from text using the TTS model and reference audio.
 
@@ -151,24 +281,40 @@ class NeuTTSAir:
             text (str): Input text to be converted to speech.
             ref_codes (np.ndarray | torch.tensor): Encoded reference.
             ref_text (str): Reference text for reference audio. Defaults to None.
+            cancel (CancellationToken | None): Stops generation, checked after every token.
         Returns:
             np.ndarray: Generated speech waveform.
+        Raises:
+            Cancelled: If `cancel` fired before the audio was decoded.
         """
 
-        # Generate tokens
-        if self._is_quantized_model:
-            output_str = self._infer_ggml(ref_codes, ref_text, text)
-        else:
-            prompt_ids = self._apply_chat_template(ref_codes, ref_text, text)
-            output_str = self._infer_torch(prompt_ids)
+        with self.profiler.session("infer") if self.profiler else nullcontext():
 
-        # Decode
-        wav = self._decode(output_str)
-        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=24_000)
+            if cancel is not None:
+                cancel.check()
+
+            # Generate tokens
+            if self._is_quantized_model:
+                output_str = self._infer_ggml(ref_codes, ref_text, text, cancel)
+            else:
+                prompt_ids = self._apply_chat_template(ref_codes, ref_text, text)
+                output_str = self._infer_torch(prompt_ids, cancel)
+
+            # Decode
+            wav = self._decode(output_str)
+            with self._timed("watermark"):
+                watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=24_000)
 
         return watermarked_wav
     
-    def infer_stream(self, text: str, ref_codes: np.ndarray | torch.Tensor, ref_text: str) -> Generator[np.ndarray, None, None]:
+    def infer_stream(
+        self,
+        text: str,
+        ref_codes: np.ndarray | torch.Tensor,
+        ref_text: str,
+        schedule: StreamingSchedule | None = None,
+        cancel: CancellationToken | None = None,
+    ) -> Generator[np.ndarray, None, None]:
         """
         Perform streaming inference to generate speech from text using the TTS model and reference audio.
 
@@ -176,49 +322,118 @@ class NeuTTSAir:
             text (str): Input text to be converted to speech.
             ref_codes (np.ndarray | torch.tensor): Encoded reference.
             ref_text (str): Reference text for reference audio. Defaults to None.
+            schedule (StreamingSchedule | None): Chunk sizes; defaults to `self.streaming_schedule`,
+                which starts small and grows. `StreamingSchedule.fixed()` gives constant chunks.
+            cancel (CancellationToken | None): Stops generation, checked after every token;
+                the stream then raises `Cancelled`. Closing the generator also stops it.
         Yields:
             np.ndarray: Generated speech waveform.
         """ 
 
         if self._is_quantized_model:
-            return self._infer_stream_ggml(ref_codes, ref_text, text)
+            stream = self._infer_stream_ggml(ref_codes, ref_text, text, schedule or self.streaming_schedule, cancel)
+            return self.profiler.profile_stream("infer_stream", stream) if self.profiler else stream
 
         else:
             raise NotImplementedError("Streaming is not implemented for the torch backend!")
 
-    def encode_reference(self, ref_audio_path: str | Path):
-        wav, _ = librosa.load(ref_audio_path, sr=16000, mono=True)
-        wav_tensor = torch.from_numpy(wav).float().unsqueeze(0).unsqueeze(0)  # [1, 1, T]
-        with torch.no_grad():
+    def encode_reference(self, ref_audio: str | Path | np.ndarray):
+        """
+        Encode a reference into codec codes.
+
+        Args:
+            ref_audio (str | Path | np.ndarray): Reference WAV path, whose 16 kHz array is
+                memory-mapped from the `.npy` beside it, or a 16 kHz mono float32 waveform.
+        Returns:
+            torch.Tensor: Reference codes.
+        """
+        wav = ref_audio if isinstance(ref_audio, np.ndarray) else load_reference(ref_audio)
+        wav_tensor = torch.from_numpy(wav).unsqueeze(0).unsqueeze(0)  # [1, 1, T], no copy
+        with self._timed("encode_reference"), torch.no_grad():
             ref_codes = self.codec.encode_code(audio_or_path=wav_tensor).squeeze(0).squeeze(0)
         return ref_codes
 
+    def count_prompt_tokens(self, ref_codes: np.ndarray | torch.Tensor, ref_text: str) -> int:
+        """
+        Count the prompt tokens a reference occupies before any input text is added.
+
+        Generation gets whatever is left of `max_context`, so this is what a voice
+        costs on every request.
+
+        Args:
+            ref_codes (np.ndarray | torch.tensor): Encoded reference.
+            ref_text (str): Reference text for reference audio.
+        Returns:
+            int: Prompt length in backbone tokens.
+        """
+        if self._is_quantized_model:
+            prompt = self._format_ggml_prompt(ref_codes, ref_text, "")
+            return len(self.backbone.tokenize(prompt.encode("utf-8"), add_bos=False, special=True))
+        return len(self._build_chat_ids(ref_codes, ref_text, ""))
+
+    def validate_stream_decoding(
+        self,
+        codes: np.ndarray | torch.Tensor,
+        schedule: StreamingSchedule | None = None,
+        reference: StreamingSchedule | None = None,
+        context_codes: np.ndarray | torch.Tensor = (),
+    ) -> dict:
+        """
+        Check a streaming schedule's decode context against the windowed baseline.
+
+        Both schedules stream-decode `codes` through this model's codec, without the
+        watermark, and the audio is compared; see `compare_stream_decoding`.
+
+        Args:
+            codes (np.ndarray | torch.tensor): Speech codes, e.g. an encoded reference.
+            schedule (StreamingSchedule | None): Schedule under test; defaults to `self.streaming_schedule`.
+            reference (StreamingSchedule | None): Baseline; defaults to `StreamingSchedule.fixed()`.
+            context_codes (np.ndarray | torch.tensor): Codes preceding the stream.
+        Returns:
+            dict: Error and codec frames decoded per emitted frame for each schedule.
+        """
+        return compare_stream_decoding(
+            self._decode_codes,
+            np.asarray(codes, dtype=np.int32),
+            self.hop_length,
+            schedule or self.streaming_schedule,
+            reference,
+            context_codes=np.asarray(context_codes, dtype=np.int32).reshape(-1),
+        )
+
     def _decode(self, codes: str):
 
         # Extract speech token IDs using regex
-        speech_ids = [int(num) for num in re.findall(r"<\|speech_(\d+)\|>", codes)]
+        speech_ids = [int(num) for num in _SPEECH_TOKEN_RE.findall(codes)]
 
         if len(speech_ids) > 0:
+            return self._decode_codes(np.array(speech_ids, dtype=np.int32))
+        else:
+            raise ValueError("No valid speech tokens found in the output.")
 
-            # Onnx decode
-            if self._is_onnx_codec:
-                codes = np.array(speech_ids, dtype=np.int32)[np.newaxis, np.newaxis, :]
-                recon = self.codec.decode_code(codes)
+    def _decode_codes(self, speech_ids: np.ndarray) -> np.ndarray:
 
-            # Torch decode
-            else:
-                with torch.no_grad():
-                    codes = torch.tensor(speech_ids, dtype=torch.long)[None, None, :].to(
-                        self.codec.device
-                    )
-                    recon = self.codec.decode_code(codes).cpu().numpy()
+        # Onnx decode
+        if self._is_onnx_codec:
+            with self._timed("codec_decode", n_frames=len(speech_ids)):
+                recon = self.codec.decode_code(speech_ids[np.newaxis, np.newaxis, :])
 
-            return recon[0, 0, :]
+        # Torch decode
         else:
-            raise ValueError("No valid speech tokens found in the output.")
+            with self._timed("codec_decode", n_frames=len(speech_ids)), torch.no_grad():
+                codes = torch.from_numpy(speech_ids).long()[None, None, :].to(self.codec.device)
+                recon = self.codec.decode_code(codes).cpu().numpy()
+
+        return recon[0, 0, :]
+
+    def _decode_stream_window(self, speech_ids: np.ndarray) -> np.ndarray:
+        recon = self._decode_codes(speech_ids)
+        with self._timed("watermark"):
+            return self.watermarker.apply_watermark(recon, sample_rate=24_000)
 
     def _to_phones(self, text: str) -> str:
-        phones = self.phonemizer.phonemize([text])
+        with self._timed("phonemize"), self._phonemizer_lock:
+            phones = self.phonemizer.phonemize([text])
         phones = phones[0].split()
         phones = " ".join(phones)
         return phones
@@ -226,6 +441,12 @@ class NeuTTSAir:
     def _apply_chat_template(
         self, ref_codes: list[int], ref_text: str, input_text: str
     ) -> list[int]:
+        with self._timed("prompt_build"):
+            return self._build_chat_ids(ref_codes, ref_text, input_text)
+
+    def _build_chat_ids(
+        self, ref_codes: list[int], ref_text: str, input_text: str
+    ) -> list[int]:
 
         input_text = self._to_phones(ref_text) + " " + self._to_phones(input_text)
         speech_replace = self.tokenizer.convert_tokens_to_ids("<|SPEECH_REPLACE|>")
@@ -254,9 +475,13 @@ class NeuTTSAir:
 
         return ids
 
-    def _infer_torch(self, prompt_ids: list[int]) -> str:
+    def _infer_torch(self, prompt_ids: list[int], cancel: CancellationToken | None = None) -> str:
         prompt_tensor = torch.tensor(prompt_ids).unsqueeze(0).to(self.backbone.device)
         speech_end_id = self.tokenizer.convert_tokens_to_ids("<|SPEECH_GENERATION_END|>")
+        stopping_criteria = [_StepTimer(self)] if self.hooks else []
+        if cancel is not None:
+            stopping_criteria.append(_CancelCriteria(cancel))
+        start = time.perf_counter()
         with torch.no_grad():
             output_tokens = self.backbone.generate(
                 prompt_tensor,
@@ -267,33 +492,23 @@ class NeuTTSAir:
                 top_k=50,
                 use_cache=True,
                 min_new_tokens=50,
+                stopping_criteria=StoppingCriteriaList(stopping_criteria) if stopping_criteria else None,
             )
         input_length = prompt_tensor.shape[-1]
+        if cancel is not None and cancel.cancelled:
+            n_tokens = output_tokens.shape[-1] - input_length
+            self._emit("cancelled", time.perf_counter() - start, reason=cancel.reason, n_tokens=n_tokens)
+            raise Cancelled(cancel.reason)
         output_str = self.tokenizer.decode(
             output_tokens[0, input_length:].cpu().numpy().tolist(), add_special_tokens=False
         )
         return output_str
     
-    def _infer_ggml(self, ref_codes: list[int], ref_text: str, input_text: str) -> str:
-        ref_text = self._to_phones(ref_text)
-        input_text = self._to_phones(input_text)
+    def _build_ggml_prompt(self, ref_codes: list[int], ref_text: str, input_text: str) -> str:
+        with self._timed("prompt_build"):
+            return self._format_ggml_prompt(ref_codes, ref_text, input_text)
 
-        codes_str = "".join([f"<|speech_{idx}|>" for idx in ref_codes])
-        prompt = (
-            f"user: Convert the text to speech:<|TEXT_PROMPT_START|>{ref_text} {input_text}"
-            f"<|TEXT_PROMPT_END|>\nassistant:<|SPEECH_GENERATION_START|>{codes_str}"
-        )
-        output = self.backbone(
-            prompt,
-            max_tokens=self.max_context,
-            temperature=1.0,
-            top_k=50,
-            stop=["<|SPEECH_GENERATION_END|>"],
-        )
-        output_str = output["choices"][0]["text"]
-        return output_str
-
-    def _infer_stream_ggml(self, ref_codes: torch.Tensor, ref_text: str, input_text: str) -> Generator[np.ndarray, None, None]:
+    def _format_ggml_prompt(self, ref_codes: list[int], ref_text: str, input_text: str) -> str:
         ref_text = self._to_phones(ref_text)
         input_text = self._to_phones(input_text)
 
@@ -302,83 +517,56 @@ class NeuTTSAir:
             f"user: Convert the text to speech:<|TEXT_PROMPT_START|>{ref_text} {input_text}"
             f"<|TEXT_PROMPT_END|>\nassistant:<|SPEECH_GENERATION_START|>{codes_str}"
         )
+        return prompt
+
+    def _infer_ggml(
+        self, ref_codes: list[int], ref_text: str, input_text: str, cancel: CancellationToken | None = None
+    ) -> str:
+        prompt = self._build_ggml_prompt(ref_codes, ref_text, input_text)
+        with self._checkout_backbone(cancel) as backbone:
+            # Streamed and joined so prefill and per-token decode can be timed
+            output = backbone(
+                prompt,
+                max_tokens=self.max_context,
+                temperature=1.0,
+                top_k=50,
+                stop=["<|SPEECH_GENERATION_END|>"],
+                stream=True,
+            )
+            output_str = "".join(
+                item["choices"][0]["text"] for item in self._timed_tokens(self._cancellable(output, cancel))
+            )
+        return output_str
 
-        audio_cache: list[np.ndarray] = []
-        token_cache: list[str] = [f"<|speech_{idx}|>" for idx in ref_codes]
-        n_decoded_samples: int = 0
-        n_decoded_tokens: int = len(ref_codes)
-
-        for item in self.backbone(
-            prompt,
-            max_tokens=self.max_context,
-            temperature=1.0,
-            top_k=50,
-            stop=["<|SPEECH_GENERATION_END|>"],
-            stream=True
-        ):
-            output_str = item["choices"][0]["text"]
-            token_cache.append(output_str)
-
-            if len(token_cache[n_decoded_tokens:]) >= self.streaming_frames_per_chunk + self.streaming_lookforward:
-
-                # decode chunk
-                tokens_start = max(
-                    n_decoded_tokens
-                    - self.streaming_lookback
-                    - self.streaming_overlap_frames,
-                    0
-                )
-                tokens_end = (
-                    n_decoded_tokens
-                    + self.streaming_frames_per_chunk
-                    + self.streaming_lookforward
-                    + self.streaming_overlap_frames
-                )
-                sample_start = (
-                    n_decoded_tokens - tokens_start
-                ) * self.hop_length
-                sample_end = (
-                    sample_start
-                    + (self.streaming_frames_per_chunk + 2 * self.streaming_overlap_frames) * self.hop_length
-                )
-                curr_codes = token_cache[tokens_start:tokens_end]
-                recon = self._decode("".join(curr_codes))
-                recon = self.watermarker.apply_watermark(recon, sample_rate=24_000)
-                recon = recon[sample_start:sample_end]
-                audio_cache.append(recon)
-
-                # postprocess
-                processed_recon = _linear_overlap_add(
-                    audio_cache, stride=self.streaming_stride_samples
-                )
-                new_samples_end = len(audio_cache) * self.streaming_stride_samples
-                processed_recon = processed_recon[
-                    n_decoded_samples:new_samples_end
-                ]
-                n_decoded_samples = new_samples_end
-                n_decoded_tokens += self.streaming_frames_per_chunk
-                yield processed_recon
+    def _infer_stream_ggml(
+        self,
+        ref_codes: torch.Tensor,
+        ref_text: str,
+        input_text: str,
+        schedule: StreamingSchedule,
+        cancel: CancellationToken | None = None,
+    ) -> Generator[np.ndarray, None, None]:
+        if cancel is not None:
+            cancel.check()
+        prompt = self._build_ggml_prompt(ref_codes, ref_text, input_text)
+        decoder = StreamDecoder(self._decode_stream_window, self.hop_length, schedule, context_codes=ref_codes)
+
+        # The replica stays checked out until the stream ends or is closed
+        with self._checkout_backbone(cancel) as backbone:
+            for item in self._timed_tokens(self._cancellable(backbone(
+                prompt,
+                max_tokens=self.max_context,
+                temperature=1.0,
+                top_k=50,
+                stop=["<|SPEECH_GENERATION_END|>"],
+                stream=True
+            ), cancel)):
+                output_str = item["choices"][0]["text"]
+                processed_recon = decoder.push(int(num) for num in _SPEECH_TOKEN_RE.findall(output_str))
+                if processed_recon is not None:
+                    yield processed_recon
 
         # final decoding handled seperately as non-constant chunk size
-        remaining_tokens = len(token_cache) - n_decoded_tokens
-        if len(token_cache) > n_decoded_tokens:
-            tokens_start = max(
-                len(token_cache)
-                - (self.streaming_lookback + self.streaming_overlap_frames + remaining_tokens), 
-                0
-            )
-            sample_start = (
-                len(token_cache) 
-                - tokens_start 
-                - remaining_tokens 
-                - self.streaming_overlap_frames
-            ) * self.hop_length
-            curr_codes = token_cache[tokens_start:]
-            recon = self._decode("".join(curr_codes))
-            recon = self.watermarker.apply_watermark(recon, sample_rate=24_000)
-            recon = recon[sample_start:]
-            audio_cache.append(recon)
-
-            processed_recon = _linear_overlap_add(audio_cache, stride=self.streaming_stride_samples)
-            processed_recon = processed_recon[n_decoded_samples:]
-            yield processed_recon
\ No newline at end of file
+        processed_recon = decoder.flush()
+        if processed_recon is not None:
+            yield processed_recon
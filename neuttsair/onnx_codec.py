@@ -0,0 +1,188 @@
+import hashlib
+import os
+import platform
+import threading
+from pathlib import Path
+import numpy as np
+from .resources import ResourceConfig
+
+
+OPTIMIZATION_LEVELS = ("disable", "basic", "extended", "all")
+
+_OUTPUT_DTYPES = {"tensor(float)": np.float32, "tensor(float16)": np.float16}
+
+
+class OnnxCodecDecoder:
+    """
+    NeuCodec ONNX decoder on a tuned ONNX Runtime session.
+
+    A drop-in for `neucodec.NeuCodecOnnxDecoder.decode_code` that:
+
+    - Caches the optimized graph under `cache_dir`, keyed by model file, ORT version,
+      optimization level and CPU architecture, so later starts load it with graph
+      optimization disabled instead of re-running it.
+    - Runs decodes for shapes registered with `preallocate` (the streaming windows,
+      one per chunk size) through IO binding into a per-thread output buffer per
+      shape that is reused across calls. Other shapes run normally and, with `shrink_arena`, hand their
+      arena growth back afterwards so one long decode doesn't pin its peak memory.
+
+    Args:
+        onnx_path (str | Path): Decoder model file.
+        resources (ResourceConfig | None): Thread budget for the session.
+        optimization_level (str): One of "disable", "basic", "extended", "all".
+        cache_dir (str | Path | None): Where optimized graphs are kept; None disables the cache.
+        enable_cpu_mem_arena (bool): Serve allocations from ORT's CPU arena.
+        enable_mem_pattern (bool): Pre-plan allocations for repeated input shapes.
+        shrink_arena (bool): Release arena growth after decodes of unregistered shapes.
+    """
+
+    def __init__(
+        self,
+        onnx_path: str | Path,
+        resources: ResourceConfig | None = None,
+        optimization_level: str = "all",
+        cache_dir: str | Path | None = None,
+        enable_cpu_mem_arena: bool = True,
+        enable_mem_pattern: bool = True,
+        shrink_arena: bool = True,
+    ):
+        import onnxruntime
+
+        if optimization_level not in OPTIMIZATION_LEVELS:
+            raise ValueError(f"Invalid optimization level! Must be one of: {', '.join(OPTIMIZATION_LEVELS)}.")
+
+        self.onnx_path = Path(onnx_path)
+        self.resources = resources or ResourceConfig(device="cpu")
+        self.optimization_level = optimization_level
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.enable_cpu_mem_arena = enable_cpu_mem_arena
+        self.enable_mem_pattern = enable_mem_pattern
+        self.sample_rate = 24_000
+
+        self.session = self._create_session()
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        self._output_dtype = _OUTPUT_DTYPES.get(self.session.get_outputs()[0].type)
+
+        self._shrink_options = None
+        if shrink_arena and enable_cpu_mem_arena:
+            self._shrink_options = onnxruntime.RunOptions()
+            self._shrink_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu:0")
+
+        # Output shapes for preallocated input shapes; buffers and bindings are per thread
+        self._bound_shapes: dict[tuple, tuple] = {}
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls, onnx_path: str | Path, resources: ResourceConfig | None = None) -> "OnnxCodecDecoder":
+        """Configure from NEUTTS_ONNX_{OPT_LEVEL,CACHE_DIR}; an empty cache dir disables the cache."""
+        return cls(
+            onnx_path,
+            resources=resources,
+            optimization_level=os.environ.get("NEUTTS_ONNX_OPT_LEVEL", "all"),
+            cache_dir=os.environ.get(
+                "NEUTTS_ONNX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "neutts", "onnx")
+            ),
+        )
+
+    def _cached_model_path(self) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        import onnxruntime
+
+        stat = self.onnx_path.stat()
+        key = "|".join([
+            str(self.onnx_path.resolve()),
+            str(stat.st_size),
+            str(stat.st_mtime_ns),
+            onnxruntime.__version__,
+            self.optimization_level,
+            platform.machine(),
+        ])
+        return self.cache_dir / f"{self.onnx_path.stem}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.onnx"
+
+    def _create_session(self):
+        import onnxruntime
+
+        levels = {
+            "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }
+        options = self.resources.onnx_session_options()
+        options.enable_cpu_mem_arena = self.enable_cpu_mem_arena
+        options.enable_mem_pattern = self.enable_mem_pattern
+        providers = ["CPUExecutionProvider"]
+
+        cached_path = self._cached_model_path()
+        if cached_path is not None and cached_path.exists():
+            # Already optimized for this ORT build and CPU; optimizing again would only cost start-up time
+            options.graph_optimization_level = levels["disable"]
+            return onnxruntime.InferenceSession(str(cached_path), sess_options=options, providers=providers)
+
+        options.graph_optimization_level = levels[self.optimization_level]
+        if cached_path is None or self.optimization_level == "disable":
+            return onnxruntime.InferenceSession(str(self.onnx_path), sess_options=options, providers=providers)
+
+        # ORT writes the optimized graph while creating the session; rename it into place once complete
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached_path.with_name(f"{cached_path.stem}.{os.getpid()}.tmp.onnx")
+        options.optimized_model_filepath = str(tmp_path)
+        session = onnxruntime.InferenceSession(str(self.onnx_path), sess_options=options, providers=providers)
+        if tmp_path.exists():
+            os.replace(tmp_path, cached_path)
+        return session
+
+    def preallocate(self, n_frames: int, batch_size: int = 1):
+        """
+        Register a fixed decode shape for IO binding and warm the session on it.
+
+        Args:
+            n_frames (int): Codes per decode, e.g. the streaming window.
+            batch_size (int): Decodes per call.
+        """
+        if self._output_dtype is None:
+            return
+        input_shape = (batch_size, 1, n_frames)
+        if input_shape not in self._bound_shapes:
+            recon = self.session.run([self.output_name], {self.input_name: np.zeros(input_shape, dtype=np.int32)})[0]
+            self._bound_shapes[input_shape] = recon.shape
+
+    def _binding(self, input_shape: tuple):
+        bindings = getattr(self._local, "bindings", None)
+        if bindings is None:
+            bindings = self._local.bindings = {}
+        if input_shape not in bindings:
+            output = np.empty(self._bound_shapes[input_shape], dtype=self._output_dtype)
+            binding = self.session.io_binding()
+            binding.bind_output(
+                self.output_name, "cpu", 0, self._output_dtype, output.shape, output.ctypes.data
+            )
+            bindings[input_shape] = (binding, output)
+        return bindings[input_shape]
+
+    def decode_code(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Decode FSQ codes to audio.
+
+        Args:
+            codes (np.ndarray): [B, 1, F] int32 50 Hz codes.
+        Returns:
+            np.ndarray: [B, 1, T] float32 24 kHz audio. For preallocated shapes this is the
+                calling thread's reused buffer, valid until its next decode of that shape.
+        """
+        if not isinstance(codes, np.ndarray):
+            raise ValueError("`Codes` should be an np.array.")
+        if not len(codes.shape) == 3 or codes.shape[1] != 1:
+            raise ValueError("`Codes` should be of shape [B, 1, F].")
+
+        codes = np.ascontiguousarray(codes, dtype=np.int32)
+        if codes.shape in self._bound_shapes:
+            binding, output = self._binding(codes.shape)
+            binding.bind_cpu_input(self.input_name, codes)
+            self.session.run_with_iobinding(binding)
+            return output if output.dtype == np.float32 else output.astype(np.float32)
+
+        recon = self.session.run([self.output_name], {self.input_name: codes}, run_options=self._shrink_options)[0]
+        return recon.astype(np.float32, copy=False)
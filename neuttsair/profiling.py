@@ -0,0 +1,206 @@
+import contextvars
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Generator
+from .hooks import InferenceHook
+
+
+# Per-request profiling context, e.g. {"force": True, "label": "<request id>"}, set by the caller
+profile_context = contextvars.ContextVar("profile_context", default=None)
+
+# The session recording on the current thread, if any
+_active_session = contextvars.ContextVar("active_profile_session", default=None)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+class _StackSampler:
+    """Samples one thread's Python stack at a fixed interval and aggregates folded stacks."""
+
+    def __init__(self, thread_id: int, interval_s: float):
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path: Path):
+        # Brendan Gregg's folded format, readable by flamegraph.pl and speedscope
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class _ProfileSession:
+    def __init__(self, path: Path):
+        self.path = path
+        self.stages = defaultdict(list)
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                "count": len(durations),
+                "total_s": sum(durations),
+                "mean_s": sum(durations) / len(durations),
+                "max_s": max(durations),
+            }
+            for stage, durations in self.stages.items()
+        }
+
+
+class InferenceProfiler(InferenceHook):
+    """
+    Opt-in profiler for NeuTTSAir.infer / infer_stream.
+
+    A call is profiled when `profile_context` requests it (`force`) or, with probability
+    `sample_rate`, on its own. Either way sessions start at most once per `min_interval_s`
+    and never overlap, so it can stay enabled in production. Each session writes a
+    directory under `profile_dir` holding a trace (folded Python stacks for mode
+    "sample", a Chrome trace and op table for mode "torch") and `summary.json` with
+    per-stage timings; only the newest `max_profiles` directories are kept.
+    """
+
+    def __init__(
+        self,
+        profile_dir: str | Path = "profiles",
+        mode: str = "sample",
+        sample_rate: float = 0.0,
+        min_interval_s: float = 30.0,
+        max_profiles: int = 20,
+        sampling_interval_s: float = 0.005,
+    ):
+        if mode not in ("sample", "torch"):
+            raise ValueError("Invalid profiling mode! Must be one of: 'sample', 'torch'.")
+        self.profile_dir = Path(profile_dir)
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.min_interval_s = min_interval_s
+        self.max_profiles = max_profiles
+        self.sampling_interval_s = sampling_interval_s
+        self._lock = threading.Lock()
+        self._busy = False
+        self._last_start = float("-inf")
+
+    @classmethod
+    def from_env(cls) -> "InferenceProfiler":
+        """Configure from NEUTTS_PROFILE_{DIR,MODE,SAMPLE_RATE,MIN_INTERVAL,MAX}."""
+        return cls(
+            profile_dir=os.environ.get("NEUTTS_PROFILE_DIR", "profiles"),
+            mode=os.environ.get("NEUTTS_PROFILE_MODE", "sample"),
+            sample_rate=float(os.environ.get("NEUTTS_PROFILE_SAMPLE_RATE", 0.0)),
+            min_interval_s=float(os.environ.get("NEUTTS_PROFILE_MIN_INTERVAL", 30.0)),
+            max_profiles=int(os.environ.get("NEUTTS_PROFILE_MAX", 20)),
+        )
+
+    def on_stage(self, stage: str, duration_s: float, **info) -> None:
+        session = _active_session.get()
+        if session is not None:
+            session.stages[stage].append(duration_s)
+
+    def _acquire(self, force: bool) -> bool:
+        if not force and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self._busy or now - self._last_start < self.min_interval_s:
+                return False
+            self._busy = True
+            self._last_start = now
+            return True
+
+    def _release(self):
+        with self._lock:
+            self._busy = False
+
+    @contextmanager
+    def session(self, name: str):
+        """Profile the enclosed block if requested/sampled and not rate-limited."""
+        context = profile_context.get() or {}
+        if _active_session.get() is not None or not self._acquire(context.get("force", False)):
+            yield None
+            return
+
+        label = context.get("label")
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        session = _ProfileSession(self.profile_dir / "_".join(filter(None, [stamp, label, name])))
+        session.path.mkdir(parents=True, exist_ok=True)
+        token = _active_session.set(session)
+        start = time.perf_counter()
+
+        try:
+            if self.mode == "torch":
+                import torch
+
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                with torch.profiler.profile(activities=activities) as prof:
+                    yield session
+                prof.export_chrome_trace(str(session.path / "trace.json"))
+                (session.path / "ops.txt").write_text(
+                    prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=50)
+                )
+            else:
+                sampler = _StackSampler(threading.get_ident(), self.sampling_interval_s)
+                sampler.start()
+                try:
+                    yield session
+                finally:
+                    sampler.stop()
+                    sampler.write_folded(session.path / "stacks.folded")
+        finally:
+            _active_session.reset(token)
+            with open(session.path / "summary.json", "w") as f:
+                json.dump({
+                    "name": name,
+                    "label": label,
+                    "mode": self.mode,
+                    "wall_s": time.perf_counter() - start,
+                    "stages": session.summary(),
+                }, f, indent=2)
+            self._prune()
+            self._release()
+            print(f"Profile written to {session.path}")
+
+    def profile_stream(self, name: str, stream: Generator) -> Generator:
+        """Profile a generator across all of its iterations."""
+        with self.session(name):
+            yield from stream
+
+    def _prune(self):
+        profiles = sorted(p for p in self.profile_dir.iterdir() if p.is_dir())
+        for old in profiles[: max(len(profiles) - self.max_profiles, 0)]:
+            shutil.rmtree(old, ignore_errors=True)
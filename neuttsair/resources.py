@@ -0,0 +1,230 @@
+import os
+
+
+# Default decode threads per llama.cpp replica; a small backbone stops speeding up well before this per request
+LLAMA_THREADS_PER_REPLICA = 4
+
+
+def _available_cpus() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _physical_cores(cpus: list[int]) -> int:
+    # SMT siblings share a core's execution units, so compute-bound pools gain little past one thread per core
+    try:
+        cores = set()
+        cpu = package = None
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "processor":
+                    cpu = int(value)
+                    package = None
+                elif key == "physical id":
+                    package = value.strip()
+                elif key == "core id" and cpu in cpus:
+                    cores.add((package, value.strip()))
+        return len(cores) or len(cpus)
+    except (OSError, ValueError):
+        return len(cpus)
+
+
+def available_memory_bytes() -> int:
+    """Memory the kernel could hand out without swapping: MemAvailable, or free pages where it is missing."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def parse_cpu_list(spec: str) -> list[int]:
+    """Parse a taskset-style CPU list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def resolve_device(device: str) -> str:
+    """Map "auto" to "cuda" when a GPU is visible and "cpu" otherwise."""
+    if device != "auto":
+        return device
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class ResourceConfig:
+    """
+    One CPU budget shared by every compute library NeuTTSAir and the app load.
+
+    torch (backbone, codec and Whisper), llama.cpp and ONNX Runtime each size their own
+    thread pools from the machine by default, so in one process they oversubscribe the
+    cores and latency jitters under load. Here every component's pool is derived from
+    `num_threads`, which defaults to the physical cores in the process's affinity mask.
+    The stages of a request run one after another, so each may use the full budget;
+    inter-op pools default to a single thread. The espeak phonemizer is single-threaded.
+
+    On GPU the CPU side only feeds the device, so the default budget drops to four.
+
+    A GGUF backbone runs up to `llama_replicas` requests at once, each on its own
+    llama.cpp context with an equal share of the llama.cpp threads. On CPU the default
+    is one replica per `LLAMA_THREADS_PER_REPLICA` threads; elsewhere each replica
+    holds its own copy of the weights on the device, so it is one.
+
+    Args:
+        device (str): "auto", "cpu", "cuda" or another torch device.
+        num_threads (int | None): Total CPU threads for model compute.
+        torch_threads (int | None): torch intra-op threads; defaults to `num_threads`.
+        torch_interop_threads (int): torch inter-op threads.
+        llama_threads (int | None): llama.cpp decode threads; defaults to `num_threads`.
+        llama_batch_threads (int | None): llama.cpp prompt threads; defaults to `num_threads`.
+        llama_replicas (int | None): Most llama.cpp contexts to run concurrently; NeuTTSAir
+            may load fewer if their KV caches would not fit in memory.
+        onnx_threads (int | None): ONNX Runtime intra-op threads; defaults to `num_threads`.
+        onnx_interop_threads (int): ONNX Runtime inter-op threads.
+        cpu_affinity (list[int] | None): CPUs to pin the process to when applied.
+    """
+
+    def __init__(
+        self,
+        device: str = "auto",
+        num_threads: int | None = None,
+        torch_threads: int | None = None,
+        torch_interop_threads: int = 1,
+        llama_threads: int | None = None,
+        llama_batch_threads: int | None = None,
+        llama_replicas: int | None = None,
+        onnx_threads: int | None = None,
+        onnx_interop_threads: int = 1,
+        cpu_affinity: list[int] | None = None,
+    ):
+        self.device = resolve_device(device)
+        self.cpu_affinity = cpu_affinity
+        cpus = cpu_affinity or _available_cpus()
+        if num_threads is None:
+            num_threads = _physical_cores(cpus)
+            if self.device != "cpu":
+                num_threads = min(num_threads, 4)
+        self.num_threads = max(num_threads, 1)
+        self.torch_threads = torch_threads or self.num_threads
+        self.torch_interop_threads = torch_interop_threads
+        self.llama_threads = llama_threads or self.num_threads
+        self.llama_batch_threads = llama_batch_threads or self.num_threads
+        if llama_replicas is None:
+            llama_replicas = self.llama_threads // LLAMA_THREADS_PER_REPLICA if self.device == "cpu" else 1
+        self.llama_replicas = max(llama_replicas, 1)
+        self.onnx_threads = onnx_threads or self.num_threads
+        self.onnx_interop_threads = onnx_interop_threads
+
+    @classmethod
+    def from_env(cls) -> "ResourceConfig":
+        """Configure from NEUTTS_{DEVICE,THREADS,TORCH_THREADS,LLAMA_THREADS,LLAMA_BATCH_THREADS,LLAMA_REPLICAS,ONNX_THREADS,CPU_AFFINITY}."""
+
+        def int_env(name):
+            value = os.environ.get(name)
+            return int(value) if value else None
+
+        affinity = os.environ.get("NEUTTS_CPU_AFFINITY")
+        return cls(
+            device=os.environ.get("NEUTTS_DEVICE", "auto"),
+            num_threads=int_env("NEUTTS_THREADS"),
+            torch_threads=int_env("NEUTTS_TORCH_THREADS"),
+            llama_threads=int_env("NEUTTS_LLAMA_THREADS"),
+            llama_batch_threads=int_env("NEUTTS_LLAMA_BATCH_THREADS"),
+            llama_replicas=int_env("NEUTTS_LLAMA_REPLICAS"),
+            onnx_threads=int_env("NEUTTS_ONNX_THREADS"),
+            cpu_affinity=parse_cpu_list(affinity) if affinity else None,
+        )
+
+    def split(self, n_parts: int) -> list["ResourceConfig"]:
+        """
+        Divide the budget between `n_parts` worker processes pinned to disjoint CPUs.
+
+        Each worker runs one request at a time, so it gets a single llama.cpp replica.
+
+        Args:
+            n_parts (int): Number of workers.
+        Returns:
+            list[ResourceConfig]: One config per worker.
+        """
+        cpus = self.cpu_affinity or _available_cpus()
+        per_part = max(len(cpus) // n_parts, 1)
+        threads = max(self.num_threads // n_parts, 1)
+        parts = []
+        for i in range(n_parts):
+            part_cpus = cpus[i * per_part : (i + 1) * per_part] if len(cpus) >= n_parts else None
+            parts.append(
+                ResourceConfig(
+                    device=self.device,
+                    num_threads=threads,
+                    torch_interop_threads=self.torch_interop_threads,
+                    llama_replicas=1,
+                    onnx_interop_threads=self.onnx_interop_threads,
+                    cpu_affinity=part_cpus,
+                )
+            )
+        return parts
+
+    def apply(self):
+        """
+        Apply the process-wide settings: CPU pinning and torch's thread pools.
+
+        Call once at startup, before loading models, so every thread pool created
+        afterwards inherits the affinity mask.
+        """
+        if self.cpu_affinity and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cpu_affinity)
+
+        # For OpenMP/MKL runtimes that are initialised after this point
+        os.environ.setdefault("OMP_NUM_THREADS", str(self.torch_threads))
+        os.environ.setdefault("MKL_NUM_THREADS", str(self.torch_threads))
+
+        import torch
+
+        torch.set_num_threads(self.torch_threads)
+        try:
+            torch.set_num_interop_threads(self.torch_interop_threads)
+        except RuntimeError:
+            # Only settable before the first inter-op parallel work in the process
+            pass
+
+    def llama_kwargs(self, n_replicas: int = 1) -> dict:
+        """
+        Thread settings for one llama.cpp context out of `n_replicas` running side by side.
+
+        Args:
+            n_replicas (int): Contexts sharing the llama.cpp thread budget.
+        Returns:
+            dict: `Llama` keyword arguments.
+        """
+        return {
+            "n_threads": max(self.llama_threads // n_replicas, 1),
+            "n_threads_batch": max(self.llama_batch_threads // n_replicas, 1),
+        }
+
+    def onnx_session_options(self):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = self.onnx_threads
+        options.inter_op_num_threads = self.onnx_interop_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        return options
+
+    def __repr__(self):
+        return (
+            f"ResourceConfig(device={self.device!r}, num_threads={self.num_threads}, "
+            f"torch={self.torch_threads}/{self.torch_interop_threads}, "
+            f"llama={self.llama_threads}/{self.llama_batch_threads}x{self.llama_replicas}, "
+            f"onnx={self.onnx_threads}/{self.onnx_interop_threads}, cpu_affinity={self.cpu_affinity})"
+        )
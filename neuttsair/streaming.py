@@ -0,0 +1,331 @@
+import time
+from typing import Callable, Iterable
+import numpy as np
+
+
+FRAME_RATE = 50  # Codec frames per second
+
+
+def _fade_weights(length: int, dtype=np.float32) -> np.ndarray:
+    # Triangular weights peaking mid-chunk (as in encodec's linear overlap-add); see OverlapAdd
+    t = np.linspace(0, 1, length + 2, dtype=dtype)[1:-1]
+    return np.abs(0.5 - (t - 0.5))
+
+
+class StreamingSchedule:
+    """
+    How `NeuTTSAir.infer_stream` splits generated speech tokens into decoded chunks.
+
+    The first chunk is `first_chunk_frames` long, so audio starts as soon as that many
+    frames plus the lookforward have been generated; each later chunk is `growth` times
+    the previous one, up to `max_chunk_frames`. Small chunks cut time to first audio
+    while larger ones amortise the lookback that every decode re-reads.
+
+    With `adaptive`, growth is also capped by the audio the listener already has
+    buffered: a chunk is only as long as can be generated, at the measured token rate,
+    before playback of what was emitted so far runs out (with `safety` as margin).
+
+    Args:
+        first_chunk_frames (int): Frames in the first chunk (50 frames per second).
+        growth (float): Factor between consecutive chunk sizes.
+        max_chunk_frames (int): Largest chunk.
+        lookforward (int): Frames generated past a chunk before it is decoded; at least
+            `2 * overlap_frames`, which the decode keeps past the chunk.
+        lookback (int): Earlier frames re-decoded as codec context.
+        overlap_frames (int): Frames cross-faded on each side of a chunk boundary.
+        adaptive (bool): Limit chunk growth by buffered audio versus generation speed.
+        safety (float): Generation-time margin for `adaptive`.
+    """
+
+    def __init__(
+        self,
+        first_chunk_frames: int = 8,
+        growth: float = 2.0,
+        max_chunk_frames: int = 25,
+        lookforward: int = 5,
+        lookback: int = 50,
+        overlap_frames: int = 1,
+        adaptive: bool = False,
+        safety: float = 1.5,
+    ):
+        # A chunk must cover both cross-fades, with its previous and its next chunk
+        self.min_chunk_frames = max(2 * overlap_frames, 1)
+        if first_chunk_frames < self.min_chunk_frames or max_chunk_frames < first_chunk_frames:
+            raise ValueError(
+                f"Chunk sizes must satisfy {self.min_chunk_frames} <= first_chunk_frames <= max_chunk_frames."
+            )
+        if growth < 1.0:
+            raise ValueError("growth must be at least 1.")
+        if lookback < 0:
+            raise ValueError("lookback must not be negative.")
+        # A decode keeps its chunk plus both cross-fades, so the frames after the chunk must already exist
+        if lookforward < 2 * overlap_frames:
+            raise ValueError(f"lookforward must be at least 2 * overlap_frames ({2 * overlap_frames}).")
+        self.first_chunk_frames = first_chunk_frames
+        self.growth = growth
+        self.max_chunk_frames = max_chunk_frames
+        self.lookforward = lookforward
+        self.lookback = lookback
+        self.overlap_frames = overlap_frames
+        self.adaptive = adaptive
+        self.safety = safety
+
+    @classmethod
+    def fixed(cls, chunk_frames: int = 25, **kwargs) -> "StreamingSchedule":
+        """Constant-size chunks, the schedule infer_stream used before chunks could grow."""
+        return cls(first_chunk_frames=chunk_frames, growth=1.0, max_chunk_frames=chunk_frames, **kwargs)
+
+    @property
+    def window_frames(self) -> int:
+        """Codes in a steady-state decode: lookback and leading overlap, the largest chunk and its lookforward."""
+        return self.lookback + self.overlap_frames + self.max_chunk_frames + self.lookforward
+
+    @property
+    def decode_windows(self) -> list[int]:
+        """Codes per decode for each chunk size a non-adaptive stream steps through, with a full lookback."""
+        windows, chunk_frames = [], None
+        while True:
+            chunk_frames = self.next_chunk_frames(chunk_frames)
+            window = self.lookback + self.overlap_frames + chunk_frames + self.lookforward
+            if window in windows:
+                return windows
+            windows.append(window)
+
+    def next_chunk_frames(
+        self,
+        prev_chunk_frames: int | None,
+        tokens_per_s: float | None = None,
+        buffered_s: float | None = None,
+    ) -> int:
+        """
+        Size the next chunk.
+
+        Args:
+            prev_chunk_frames (int | None): Size of the previous chunk, None for the first.
+            tokens_per_s (float | None): Measured generation speed, for `adaptive`.
+            buffered_s (float | None): Emitted audio not yet played, for `adaptive`.
+        Returns:
+            int: Frames in the next chunk.
+        """
+        if prev_chunk_frames is None:
+            return self.first_chunk_frames
+
+        frames = min(int(prev_chunk_frames * self.growth), self.max_chunk_frames)
+        if self.adaptive and tokens_per_s and buffered_s is not None:
+            # Generating the chunk and its lookforward must finish before the buffer drains
+            affordable = int(buffered_s * tokens_per_s / self.safety) - self.lookforward
+            frames = min(frames, max(affordable, self.first_chunk_frames))
+        return max(frames, self.min_chunk_frames)
+
+
+class OverlapAdd:
+    """
+    Joins decoded chunks whose ends overlap by `overlap_samples`, one chunk at a time.
+
+    Each chunk's head is blended with the held-back tail of the previous chunk, and its
+    own tail is held back for the next one, so only the overlap is kept between calls.
+    For uniform chunks this is the linear overlap-add from encodec's utils, applied to
+    the whole stream.
+    """
+
+    def __init__(self, overlap_samples: int):
+        self.overlap_samples = overlap_samples
+        self._tail = None
+        self._tail_weights = None
+
+    def push(self, frame: np.ndarray, final: bool = False) -> np.ndarray:
+        """
+        Add a chunk and return the audio that is now complete.
+
+        Args:
+            frame (np.ndarray): Decoded chunk, starting where the previous chunk's tail starts.
+            final (bool): Whether this is the last chunk, whose tail is returned too.
+        Returns:
+            np.ndarray: Finished samples.
+        """
+        weights = _fade_weights(len(frame), frame.dtype)
+        out = frame.copy()
+        if self._tail is not None:
+            n = min(len(self._tail), len(frame))
+            out[:n] = (self._tail_weights[:n] * self._tail[:n] + weights[:n] * frame[:n]) / (
+                self._tail_weights[:n] + weights[:n]
+            )
+            if len(self._tail) > n:
+                # The last chunk ended inside the previous chunk's tail
+                out = np.concatenate([out, self._tail[n:]])
+
+        if final or self.overlap_samples == 0:
+            self._tail = None
+            return out
+        self._tail = frame[-self.overlap_samples :].copy()
+        self._tail_weights = weights[-self.overlap_samples :]
+        return out[: -self.overlap_samples]
+
+
+class StreamDecoder:
+    """
+    Turns speech codes into audio chunks as they are generated, for `infer_stream`.
+
+    Codes are kept as integers in a rolling buffer that holds only what later decodes
+    still read: the `lookback` frames before the next chunk plus its leading overlap.
+    Each decode runs the codec on the new chunk with that context and the
+    `lookforward` frames after it, and the chunks are joined with `OverlapAdd`.
+
+    NeuCodec's decoder attends over its whole input window in both directions, so no
+    activation from one decode is valid in the next; `lookback` is the knob that trades
+    redundant compute for agreement with a full decode. `compare_stream_decoding`
+    measures that agreement.
+
+    Args:
+        decode_frames (Callable[[np.ndarray], np.ndarray]): Decodes [F] int32 codes to
+            F * hop_length samples.
+        hop_length (int): Samples per code frame.
+        schedule (StreamingSchedule): Chunk sizes and decode context.
+        context_codes (Iterable[int]): Codes preceding the stream, e.g. the reference,
+            used as lookback for the first chunks.
+    """
+
+    def __init__(
+        self,
+        decode_frames: Callable[[np.ndarray], np.ndarray],
+        hop_length: int,
+        schedule: StreamingSchedule,
+        context_codes: Iterable[int] = (),
+    ):
+        self.decode_frames = decode_frames
+        self.hop_length = hop_length
+        self.schedule = schedule
+        self.chunk_frames = schedule.next_chunk_frames(None)
+        self.n_decoded_frames = 0  # Frames put through the codec, context included
+
+        self._keep = schedule.lookback + schedule.overlap_frames
+        context_codes = [int(code) for code in context_codes]
+        self._codes: list[int] = context_codes[-self._keep :] if self._keep else []
+        self._next = len(self._codes)  # Buffer index of the first frame not yet emitted
+        self._overlap_add = OverlapAdd(2 * schedule.overlap_frames * hop_length)
+
+        # Generation speed and emitted audio, for adaptive schedules
+        self._n_generated = 0
+        self._first_code_time = None
+        self._first_emit_time = None
+        self._n_emitted_samples = 0
+
+    @property
+    def pending_frames(self) -> int:
+        """Generated frames not yet emitted."""
+        return len(self._codes) - self._next
+
+    def push(self, codes: Iterable[int]) -> np.ndarray | None:
+        """
+        Add generated codes and decode a chunk once enough are buffered.
+
+        Args:
+            codes (Iterable[int]): Newly generated codes.
+        Returns:
+            np.ndarray | None: The next chunk of audio, or None while it is still being generated.
+        """
+        codes = [int(code) for code in codes]
+        if codes and self._first_code_time is None:
+            self._first_code_time = time.perf_counter()
+        self._codes.extend(codes)
+        self._n_generated += len(codes)
+
+        if self.pending_frames < self.chunk_frames + self.schedule.lookforward:
+            return None
+        audio = self._decode(self.chunk_frames, final=False)
+
+        now = time.perf_counter()
+        if self._first_emit_time is None:
+            self._first_emit_time = now
+        self._n_emitted_samples += len(audio)
+        self.chunk_frames = self.schedule.next_chunk_frames(
+            self.chunk_frames,
+            tokens_per_s=self._n_generated / max(now - self._first_code_time, 1e-6),
+            buffered_s=self._n_emitted_samples / (self.hop_length * FRAME_RATE) - (now - self._first_emit_time),
+        )
+        return audio
+
+    def flush(self) -> np.ndarray | None:
+        """
+        Decode whatever is left once generation has finished.
+
+        Returns:
+            np.ndarray | None: The last chunk of audio, or None if nothing was pending.
+        """
+        if self.pending_frames == 0:
+            return None
+        return self._decode(self.pending_frames, final=True)
+
+    def _decode(self, n_frames: int, final: bool) -> np.ndarray:
+        # Decode n_frames new frames with lookback context, keeping the samples from the first new
+        # frame through the trailing overlap; the last chunk (fewer frames than scheduled) runs to the end
+        schedule = self.schedule
+        start = max(self._next - schedule.lookback - schedule.overlap_frames, 0)
+        end = self._next + n_frames + schedule.lookforward + schedule.overlap_frames
+        sample_start = (self._next - start) * self.hop_length
+        sample_end = sample_start + (n_frames + 2 * schedule.overlap_frames) * self.hop_length
+
+        window = np.array(self._codes[start:end], dtype=np.int32)
+        recon = self.decode_frames(window)
+        self.n_decoded_frames += len(window)
+
+        self._next += n_frames
+        # Drop codes that no later window reads
+        drop = max(self._next - self._keep, 0)
+        del self._codes[:drop]
+        self._next -= drop
+        return self._overlap_add.push(recon[sample_start:sample_end], final=final)
+
+
+def compare_stream_decoding(
+    decode_frames: Callable[[np.ndarray], np.ndarray],
+    codes: np.ndarray,
+    hop_length: int,
+    schedule: StreamingSchedule,
+    reference: StreamingSchedule | None = None,
+    context_codes: Iterable[int] = (),
+) -> dict:
+    """
+    Stream-decode the same codes with two schedules and measure how far the audio differs.
+
+    Use it to check that a schedule with less decode context (a smaller `lookback`)
+    still reproduces the windowed decoding `infer_stream` has always used.
+
+    Args:
+        decode_frames (Callable[[np.ndarray], np.ndarray]): As for `StreamDecoder`; pass the
+            codec without watermarking so only decoding differs.
+        codes (np.ndarray): Speech codes to decode, as if generated one at a time.
+        hop_length (int): Samples per code frame.
+        schedule (StreamingSchedule): Schedule under test.
+        reference (StreamingSchedule | None): Baseline; defaults to `StreamingSchedule.fixed()`,
+            25-frame chunks with 50 frames of lookback.
+        context_codes (Iterable[int]): Codes preceding the stream, e.g. a reference.
+    Returns:
+        dict: `max_abs_error`, `snr_db` of the tested audio against the baseline, and
+            `codec_frames_per_frame` / `reference_codec_frames_per_frame`, the frames
+            decoded per emitted frame by each.
+    """
+    codes = np.asarray(codes).reshape(-1)
+    context_codes = list(context_codes)
+
+    def run(stream_schedule):
+        decoder = StreamDecoder(decode_frames, hop_length, stream_schedule, context_codes)
+        chunks = [decoder.push([code]) for code in codes]
+        chunks.append(decoder.flush())
+        audio = np.concatenate([chunk for chunk in chunks if chunk is not None])
+        return audio, decoder.n_decoded_frames / max(len(codes), 1)
+
+    audio, cost = run(schedule)
+    baseline, baseline_cost = run(reference or StreamingSchedule.fixed())
+    if len(audio) != len(baseline):
+        raise ValueError(f"Streamed lengths differ: {len(audio)} vs {len(baseline)} samples.")
+
+    error = audio.astype(np.float64) - baseline
+    noise = float(np.sum(error**2))
+    signal = float(np.sum(baseline.astype(np.float64) ** 2))
+    return {
+        "max_abs_error": float(np.max(np.abs(error))) if len(error) else 0.0,
+        "snr_db": 10 * np.log10(signal / noise) if noise > 0 else float("inf"),
+        "codec_frames_per_frame": cost,
+        "reference_codec_frames_per_frame": baseline_cost,
+    }
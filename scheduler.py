@@ -0,0 +1,171 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+class AdmissionRejected(Exception):
+    """Raised when a request is refused instead of queued; retry_after_s is when trying again makes sense"""
+
+    def __init__(self, reason, retry_after_s):
+        super().__init__(f"Request rejected: {reason}")
+        self.reason = reason
+        self.retry_after_s = max(1, math.ceil(retry_after_s))
+
+class TokenBucket:
+    """Refills at rate units per second up to burst; a request takes its cost up front"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_take(self, cost, now):
+        """Take cost and return 0, or return the seconds until cost would be available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request bigger than the burst may go once the bucket is full, so it can't be locked out forever
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+class _Waiter:
+    def __init__(self, key, cost, start_tag, finish_tag):
+        self.key = key
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.admitted = False
+
+class FairScheduler:
+    """Admission control and weighted fair queueing in front of inference
+
+    Every request carries a key (the API key, or the client address without one)
+    and a cost in estimated audio seconds. Admission happens in three steps:
+
+    1. The key's token bucket (rate audio seconds per second, up to burst) must
+       cover the cost, otherwise the request is rejected with the time until it would.
+    2. The global queue must have room (max_queue waiting requests), otherwise it is
+       rejected with an estimate of how long the queue takes to drain.
+    3. Requests then wait for one of `concurrency` slots, served in order of virtual
+       finish time: a request's tag is its key's previous finish tag (or the current
+       virtual time if the key was idle) plus cost / weight. A key submitting many
+       long texts therefore queues behind its own backlog while other keys keep their
+       share of the slots. Requests still waiting after queue_timeout_s give up.
+    """
+
+    MAX_TRACKED_KEYS = 10000
+
+    def __init__(self, concurrency=1, max_queue=32, rate=1.0, burst=120.0, queue_timeout_s=60.0):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.rate = rate
+        self.burst = burst
+        self.queue_timeout_s = queue_timeout_s
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._last_finish = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._virtual_time = 0.0
+        self._queued_cost = 0.0
+        # Wall seconds of service per estimated audio second, smoothed; used for Retry-After
+        self._seconds_per_cost = 1.0
+
+    @property
+    def queue_depth(self):
+        return len(self._heap)
+
+    def _drain_estimate_s(self):
+        return self._queued_cost * self._seconds_per_cost / self.concurrency
+
+    def _dispatch(self):
+        # Hand free slots to the lowest finish tags; called with the condition held
+        while self._heap and self._running < self.concurrency:
+            _, _, waiter = heapq.heappop(self._heap)
+            waiter.admitted = True
+            self._queued_cost -= waiter.cost
+            self._virtual_time = max(self._virtual_time, waiter.start_tag)
+            self._running += 1
+        self._cond.notify_all()
+
+    def _prune(self, now):
+        # Forget keys whose bucket has refilled and whose finish tag is in the past; they behave as new keys
+        for key, bucket in list(self._buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                del self._buckets[key]
+        for key, finish_tag in list(self._last_finish.items()):
+            if finish_tag <= self._virtual_time:
+                del self._last_finish[key]
+
+    def _admit(self, key, cost, weight):
+        with self._cond:
+            if len(self._buckets) > self.MAX_TRACKED_KEYS:
+                self._prune(time.monotonic())
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            wait_s = bucket.try_take(cost, time.monotonic())
+            if wait_s > 0:
+                raise AdmissionRejected('rate_limited', wait_s)
+
+            if len(self._heap) >= self.max_queue:
+                # The bucket was charged for a request that never runs; give it back
+                bucket.tokens = min(bucket.burst, bucket.tokens + min(cost, bucket.burst))
+                raise AdmissionRejected('queue_full', self._drain_estimate_s())
+
+            previous_finish = self._last_finish.get(key)
+            start_tag = max(self._virtual_time, previous_finish or 0.0)
+            finish_tag = start_tag + cost / weight
+            self._last_finish[key] = finish_tag
+            waiter = _Waiter(key, cost, start_tag, finish_tag)
+            heapq.heappush(self._heap, (finish_tag, next(self._seq), waiter))
+            self._queued_cost += cost
+            self._dispatch()
+
+            deadline = time.monotonic() + self.queue_timeout_s
+            while not waiter.admitted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._heap = [entry for entry in self._heap if entry[2] is not waiter]
+                    heapq.heapify(self._heap)
+                    self._queued_cost -= cost
+                    # The key should not queue behind service it never got
+                    if self._last_finish.get(key) == finish_tag:
+                        if previous_finish is None:
+                            del self._last_finish[key]
+                        else:
+                            self._last_finish[key] = previous_finish
+                    elif key in self._last_finish:
+                        # Later requests from the key were tagged after this one; take its share back out
+                        self._last_finish[key] -= cost / weight
+                    bucket.tokens = min(bucket.burst, bucket.tokens + min(cost, bucket.burst))
+                    raise AdmissionRejected('queue_timeout', self._drain_estimate_s())
+                self._cond.wait(remaining)
+
+    def _release(self, cost, service_s):
+        with self._cond:
+            self._running -= 1
+            if cost > 0:
+                self._seconds_per_cost = 0.8 * self._seconds_per_cost + 0.2 * (service_s / cost)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, key, cost, weight=1.0):
+        """Hold an inference slot for the enclosed block, or raise AdmissionRejected
+
+        Yields the seconds spent queueing.
+        """
+        cost = max(cost, 0.0)
+        start = time.monotonic()
+        self._admit(key, cost, weight)
+        admitted = time.monotonic()
+        try:
+            yield admitted - start
+        finally:
+            self._release(cost, time.monotonic() - admitted)
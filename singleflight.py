@@ -0,0 +1,155 @@
+import contextvars
+import threading
+from neuttsair.cancellation import CancellationToken
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Cancelled once every caller waiting for the result has been
+        self.cancel = CancellationToken()
+
+class _Stream:
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        # Cancelled once every subscriber has left or been cancelled
+        self.cancel = CancellationToken()
+
+class SingleFlight:
+    """Collapses identical concurrent work into one computation shared by every caller
+
+    The first caller for a key runs the work; callers with the same key that arrive
+    while it is running wait for it and get the same result or exception. Once it
+    completes the key is forgotten, so later callers run it afresh; this is
+    deduplication of in-flight work, not a cache.
+
+    Streams work the same way, except that the work runs on its own thread and every
+    subscriber, the first one included, reads the chunks it has produced so far: a
+    subscriber that joins mid-stream is replayed the earlier chunks before following
+    live.
+
+    Each caller may pass its own CancellationToken. A caller whose token fires stops
+    waiting with Cancelled, and the work is handed a token linked to every caller's,
+    so it is cancelled only once nobody is left waiting for it. Leaving a stream
+    (closing its iterator) cancels that subscriber's token.
+    """
+
+    # How often waiting callers check their own token
+    POLL_S = 0.25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # Guards stream state; one condition for all streams, as chunks arrive at audio rate
+        self._cond = threading.Condition()
+        self._streams = {}
+
+    @property
+    def in_flight(self):
+        return len(self._calls) + len(self._streams)
+
+    def do(self, key, fn, cancel=None):
+        """Return (fn(token), shared), where shared is whether another caller's run was joined
+
+        token is the shared work's CancellationToken, linked to every caller's cancel.
+        """
+        cancel = cancel or CancellationToken()
+        with self._lock:
+            call = self._calls.get(key)
+            # Work every caller has given up on is being cancelled, so it is not joined
+            leader = call is None or call.cancel.cancelled
+            if leader:
+                call = self._calls[key] = _Call()
+            call.cancel.link(cancel)
+
+        if not leader:
+            while not call.done.wait(self.POLL_S):
+                cancel.check()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(call.cancel)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stream(self, key, start, cancel=None):
+        """Return (chunks, shared): an iterator over the chunks of start(token), run once per key
+
+        start is called on a background thread with the stream's CancellationToken and must
+        return an iterable; exceptions it raises reach every subscriber after the chunks
+        before them. It runs in a copy of the first subscriber's contextvars context.
+        """
+        cancel = cancel or CancellationToken()
+        with self._cond:
+            stream = self._streams.get(key)
+            shared = stream is not None and not stream.cancel.cancelled
+            if not shared:
+                stream = self._streams[key] = _Stream()
+            stream.cancel.link(cancel)
+            if not shared:
+                # Threads start with an empty context; carry the first subscriber's over, so the
+                # work keeps its request_id and profiling like work run by do() in the caller's thread
+                context = contextvars.copy_context()
+                threading.Thread(
+                    target=context.run, args=(self._produce, key, stream, start), daemon=True,
+                ).start()
+        return self._subscribe(stream, cancel), shared
+
+    def _produce(self, key, stream, start):
+        try:
+            chunks = iter(start(stream.cancel))
+            try:
+                for chunk in chunks:
+                    with self._cond:
+                        if stream.cancel.cancelled:
+                            # Nobody is listening; stop generating, and forget the key at once so
+                            # a request arriving now starts over rather than joining a cut-off stream.
+                            # That request may already have replaced the entry with its own stream
+                            if self._streams.get(key) is stream:
+                                del self._streams[key]
+                            break
+                        stream.chunks.append(chunk)
+                        self._cond.notify_all()
+            finally:
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    close()
+        except Exception as e:
+            stream.error = e
+        finally:
+            with self._cond:
+                if self._streams.get(key) is stream:
+                    del self._streams[key]
+                stream.finished = True
+                self._cond.notify_all()
+
+    def _subscribe(self, stream, cancel):
+        position = 0
+        try:
+            while True:
+                with self._cond:
+                    while position >= len(stream.chunks) and not stream.finished:
+                        cancel.check()
+                        self._cond.wait(self.POLL_S)
+                    pending = stream.chunks[position:]
+                    finished = stream.finished
+                position += len(pending)
+                yield from pending
+                if finished:
+                    if stream.error is not None:
+                        raise stream.error
+                    return
+        finally:
+            cancel.cancel('disconnected')
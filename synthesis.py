@@ -0,0 +1,125 @@
+import logging
+import os
+import re
+import struct
+import subprocess
+import numpy as np
+import soundfile as sf
+from pydub.utils import get_encoder_name
+from neuttsair.cancellation import Cancelled
+from neuttsair.profiling import peak_rss_mb
+
+logger = logging.getLogger("humain")
+
+# Conservative speaking rate used for duration estimates
+WORDS_PER_SECOND = 2.2
+
+def estimate_audio_seconds(text):
+    """Estimate how many seconds of speech text will produce"""
+    return len(text.split()) / WORDS_PER_SECOND
+
+def chunk_text_by_duration(text, target_duration_seconds=15):
+    """Split text into chunks targeting specific duration (default 15 seconds)
+    
+    This function estimates speech duration and creates chunks that will generate
+    approximately the target duration when converted to speech. It tries to
+    respect sentence boundaries when possible for more natural speech.
+    """
+    target_words_per_chunk = int(target_duration_seconds * WORDS_PER_SECOND)
+    
+    # Split into sentences first
+    sentences = re.split(r'[.!?]+', text)
+    sentences = [s.strip() for s in sentences if s.strip()]
+    
+    chunks = []
+    current_chunk = ""
+    current_word_count = 0
+    
+    for sentence in sentences:
+        sentence_words = len(sentence.split())
+        
+        # If adding this sentence would exceed target, start new chunk
+        if current_word_count + sentence_words > target_words_per_chunk and current_chunk:
+            chunks.append(current_chunk.strip())
+            current_chunk = sentence
+            current_word_count = sentence_words
+        else:
+            # Add sentence to current chunk
+            if current_chunk:
+                current_chunk += ". " + sentence
+            else:
+                current_chunk = sentence
+            current_word_count += sentence_words
+    
+    # Add remaining chunk
+    if current_chunk.strip():
+        chunks.append(current_chunk.strip())
+    
+    # If no sentence boundaries found or chunks are too large, fall back to word-based splitting
+    if not chunks or any(len(chunk.split()) > target_words_per_chunk * 1.5 for chunk in chunks):
+        words = text.split()
+        chunks = []
+        for i in range(0, len(words), target_words_per_chunk):
+            chunk = ' '.join(words[i:i + target_words_per_chunk])
+            chunks.append(chunk)
+    
+    return chunks
+
+# Pause inserted between long-form chunks, allocated once
+CHUNK_SILENCE = np.zeros(int(0.3 * 24000), dtype=np.float32)
+
+def synthesize_to_wav(tts_instance, input_text, ref_codes, ref_text, wav_path, cancel=None):
+    """Synthesize input_text into a WAV file, chunking long texts into ~15 second segments
+    
+    Each finished chunk is written straight to the open file, so memory stays bounded
+    by a single chunk however long the text is. Returns the audio duration in seconds.
+    If cancel fires, generation stops, the partial file is removed and Cancelled is raised.
+    """
+    # Check if text needs chunking (split for 15-second segments)
+    estimated_duration = estimate_audio_seconds(input_text)
+    
+    if estimated_duration > 15:
+        chunks = chunk_text_by_duration(input_text, target_duration_seconds=15)
+        logger.info(f"Word count: {len(input_text.split())}, Estimated duration: {estimated_duration:.1f}s, Split into {len(chunks)} chunks")
+    else:
+        chunks = [input_text]
+    
+    n_samples = 0
+    try:
+        with sf.SoundFile(wav_path, 'w', samplerate=24000, channels=1, subtype='PCM_16') as f:
+            for i, chunk in enumerate(chunks):
+                wav_chunk = tts_instance.infer(chunk, ref_codes, ref_text, cancel=cancel)
+                f.write(wav_chunk)
+                n_samples += len(wav_chunk)
+                logger.info(f"Chunk {i+1}/{len(chunks)} audio length: {len(wav_chunk)/24000:.2f} seconds")
+                
+                if i < len(chunks) - 1:
+                    f.write(CHUNK_SILENCE)
+                    n_samples += len(CHUNK_SILENCE)
+    except Cancelled as e:
+        logger.info(f"Synthesis cancelled ({e.reason}) after {n_samples / 24000:.2f} seconds of audio")
+        os.remove(wav_path)
+        raise
+    
+    duration = n_samples / 24000
+    logger.info(f"Final audio length: {duration:.2f} seconds, peak RSS: {peak_rss_mb():.0f} MB")
+    return duration
+
+def convert_wav_to_mp3(wav_path, mp3_path, bitrate="192k"):
+    """Encode a WAV file to MP3 with ffmpeg, streaming from disk rather than loading it"""
+    subprocess.run(
+        [get_encoder_name(), '-y', '-loglevel', 'error', '-i', wav_path, '-b:a', bitrate, mp3_path],
+        check=True,
+    )
+
+def wav_stream_header(sample_rate=24000):
+    """WAV header for 16-bit mono audio of unknown length, sent ahead of streamed chunks"""
+    # Sizes are left at the maximum, which players read as "until the stream ends"
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16, b'data', 0xFFFFFFFF,
+    )
+
+def pcm16_bytes(wav):
+    """Float audio in [-1, 1] as little-endian 16-bit PCM"""
+    return (np.clip(wav, -1.0, 1.0) * 32767).astype('<i2').tobytes()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The examples and the root modules are imported the way the scripts run them, from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("neucodec")
+
+from examples.encode_reference import encode_batch  # noqa: E402
+
+
+class PaddingSensitiveCodec(torch.nn.Module):
+    """50 Hz codes that depend on the whole clip, as attention-based features can"""
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.encoder = torch.nn.Conv1d(1, 16, kernel_size=320, stride=320)
+        self.quantizer = torch.nn.Linear(16, 1024)
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def encode_code(self, audio_or_path):
+        features = self.encoder(audio_or_path)
+        features = features - features.mean(dim=-1, keepdim=True)
+        return self.quantizer(features.transpose(1, 2)).argmax(dim=-1).unsqueeze(1)
+
+
+def mixed_length_clips():
+    rng = np.random.default_rng(0)
+    lengths = [16000, 24000, 16000, 9600, 24000, 31680]
+    return [rng.uniform(-0.5, 0.5, n).astype(np.float32) for n in lengths]
+
+
+def encode_alone(codec, wav):
+    with torch.no_grad():
+        codes = codec.encode_code(audio_or_path=torch.from_numpy(wav)[None, None].to(codec.device))
+    return codes[0, 0].cpu().numpy().astype(np.uint16)
+
+
+def assert_batched_matches_alone(codec, wavs):
+    batched = encode_batch(codec, wavs)
+    assert len(batched) == len(wavs)
+    for wav, codes in zip(wavs, batched):
+        np.testing.assert_array_equal(codes, encode_alone(codec, wav))
+
+
+def test_batched_codes_match_single_file_codes():
+    assert_batched_matches_alone(PaddingSensitiveCodec().eval(), mixed_length_clips())
+
+
+def test_batched_codes_match_single_file_codes_with_neucodec():
+    from neucodec import NeuCodec
+
+    try:
+        codec = NeuCodec.from_pretrained("neuphonic/neucodec").eval()
+    except Exception as e:
+        pytest.skip(f"NeuCodec weights unavailable: {e}")
+    assert_batched_matches_alone(codec, mixed_length_clips())
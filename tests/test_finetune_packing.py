@@ -0,0 +1,89 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+for module in ("fire", "omegaconf", "loguru", "datasets", "phonemizer"):
+    pytest.importorskip(module)
+
+from examples.finetune import IGNORE_INDEX, PackedCollator, pack_batch  # noqa: E402
+
+MAX_LEN = 32
+PAD_ID = 0
+
+
+def tiny_model(attn_implementation):
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=MAX_LEN,
+        use_cache=False,
+    )
+    config._attn_implementation = attn_implementation
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+def samples():
+    generator = torch.Generator().manual_seed(1)
+    batch = {"input_ids": [], "labels": []}
+    for length, n_prompt in ((9, 3), (7, 2), (12, 4)):
+        ids = torch.randint(1, 64, (length,), generator=generator).tolist()
+        batch["input_ids"].append(ids)
+        batch["labels"].append([IGNORE_INDEX] * n_prompt + ids[n_prompt:])
+    return batch
+
+
+def token_losses(logits, labels):
+    # Per-token next-token losses, as the trainer computes them, keyed by target position
+    losses = torch.nn.functional.cross_entropy(
+        logits[:-1].float(), torch.tensor(labels[1:]), ignore_index=IGNORE_INDEX, reduction="none"
+    )
+    return losses[torch.tensor(labels[1:]) != IGNORE_INDEX]
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_packed_rows_match_unpacked_samples(attn_implementation):
+    model = tiny_model(attn_implementation)
+    batch = samples()
+    packed = pack_batch(batch, MAX_LEN, PAD_ID)
+    assert len(packed["input_ids"]) == 1
+
+    collated = PackedCollator()([{key: packed[key][0] for key in ("input_ids", "labels", "position_ids")}])
+    with torch.no_grad():
+        packed_logits = model(
+            input_ids=collated["input_ids"],
+            attention_mask=collated["attention_mask"],
+            position_ids=collated["position_ids"],
+        ).logits[0]
+
+    # pack_batch lays samples out longest first
+    offset = 0
+    for i in sorted(range(len(batch["input_ids"])), key=lambda i: -len(batch["input_ids"][i])):
+        ids, labels = batch["input_ids"][i], batch["labels"][i]
+        with torch.no_grad():
+            logits = model(input_ids=torch.tensor([ids])).logits[0]
+        segment = packed_logits[offset : offset + len(ids)]
+        torch.testing.assert_close(segment, logits, atol=1e-5, rtol=1e-4)
+        torch.testing.assert_close(token_losses(segment, labels), token_losses(logits, labels), atol=1e-5, rtol=1e-4)
+        offset += len(ids)
+
+
+def test_plain_causal_mask_leaks_between_segments():
+    # What the collator's mask prevents: without it, later segments see earlier ones
+    model = tiny_model("eager")
+    batch = samples()
+    packed = pack_batch(batch, MAX_LEN, PAD_ID)
+    first = max(batch["input_ids"], key=len)
+    with torch.no_grad():
+        leaky = model(
+            input_ids=torch.tensor(packed["input_ids"]),
+            position_ids=torch.tensor(packed["position_ids"]),
+        ).logits[0]
+        second_start = len(first)
+        second = sorted(batch["input_ids"], key=len, reverse=True)[1]
+        alone = model(input_ids=torch.tensor([second])).logits[0]
+    assert not torch.allclose(leaky[second_start : second_start + len(second)], alone, atol=1e-4)
@@ -0,0 +1,61 @@
+import gc
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from model_server import ModelClient, ModelServer, attach_array, share_array
+
+pytestmark = pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs POSIX shared memory in /dev/shm")
+
+
+class StreamingTTS:
+    sample_rate = 24000
+
+    def infer_stream(self, text, ref_codes, ref_text, schedule=None, cancel=None):
+        for i in range(50):
+            yield np.full(1000, i, dtype=np.float32)
+
+
+def shared_blocks():
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+
+@pytest.fixture
+def client(tmp_path):
+    server = ModelServer(tts=StreamingTTS(), address=str(tmp_path / "model.sock"), authkey=b"test")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(server.address):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return ModelClient(server.address, authkey=b"test")
+
+
+def test_attach_array_is_a_view_that_outlives_its_block():
+    before = shared_blocks()
+    array = attach_array(share_array(np.arange(6.0).reshape(2, 3)))
+    row = array[1]
+    assert not array.flags.owndata
+    assert shared_blocks() == before
+
+    del array
+    gc.collect()
+    np.testing.assert_array_equal(row, [3.0, 4.0, 5.0])
+
+
+def test_abandoned_stream_leaves_no_shared_memory(client):
+    before = shared_blocks()
+    stream = client.infer_stream("text", np.zeros(2, dtype=np.int32), "ref")
+    next(stream)
+    # Let the server run ahead, so chunks sit unread in the socket
+    time.sleep(0.3)
+    assert shared_blocks() - before
+
+    stream.close()
+    deadline = time.monotonic() + 5
+    while shared_blocks() - before and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not shared_blocks() - before
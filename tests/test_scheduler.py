@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import AdmissionRejected, FairScheduler
+
+
+def hold_slot(scheduler, key):
+    """Occupy the scheduler's only slot until the returned event is set"""
+    admitted, release = threading.Event(), threading.Event()
+
+    def run():
+        with scheduler.slot(key, 1.0):
+            admitted.set()
+            release.wait()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert admitted.wait(1)
+    return release, thread
+
+
+def test_weight_orders_waiters_by_cost_over_weight():
+    scheduler = FairScheduler(concurrency=1, rate=100, burst=100)
+    release, thread = hold_slot(scheduler, "busy")
+    order = []
+
+    def request(key, weight):
+        with scheduler.slot(key, 4.0, weight):
+            order.append(key)
+
+    waiters = [
+        threading.Thread(target=request, args=("light", 1.0)),
+        threading.Thread(target=request, args=("heavy", 4.0)),
+    ]
+    for waiter in waiters:
+        waiter.start()
+        time.sleep(0.05)
+    release.set()
+    for waiter in [thread, *waiters]:
+        waiter.join(1)
+
+    assert order == ["heavy", "light"]
+
+
+def test_queue_timeout_rolls_back_finish_tag_and_tokens():
+    scheduler = FairScheduler(concurrency=1, rate=100, burst=100, queue_timeout_s=0.1)
+    release, thread = hold_slot(scheduler, "busy")
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        with scheduler.slot("late", 5.0, weight=2.0):
+            pass
+    release.set()
+    thread.join(1)
+
+    assert rejected.value.reason == "queue_timeout"
+    assert "late" not in scheduler._last_finish
+    assert scheduler._buckets["late"].tokens == pytest.approx(100)
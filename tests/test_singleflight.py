@@ -0,0 +1,92 @@
+import contextvars
+import threading
+import time
+
+from singleflight import SingleFlight
+
+request_id = contextvars.ContextVar("request_id", default="-")
+
+
+def test_stream_producer_runs_in_leader_context():
+    flight = SingleFlight()
+    seen = []
+
+    def start(cancel):
+        seen.append(request_id.get())
+
+        def chunks():
+            for i in range(3):
+                seen.append(request_id.get())
+                yield i
+
+        return chunks()
+
+    token = request_id.set("leader")
+    try:
+        chunks, shared = flight.stream("key", start)
+        assert list(chunks) == [0, 1, 2]
+    finally:
+        request_id.reset(token)
+
+    assert not shared
+    assert seen == ["leader"] * 4
+
+
+def test_do_runs_in_caller_context_on_producer_thread():
+    flight = SingleFlight()
+
+    def start(cancel):
+        result, _ = flight.do("inner", lambda token: request_id.get())
+        return [result]
+
+    token = request_id.set("leader")
+    try:
+        chunks, _ = flight.stream("outer", start)
+        assert list(chunks) == ["leader"]
+    finally:
+        request_id.reset(token)
+
+
+def test_cancelled_producer_leaves_replacement_stream_joinable():
+    flight = SingleFlight()
+    produced, resume = threading.Event(), threading.Event()
+    starts = []
+
+    def first(cancel):
+        def chunks():
+            yield 0
+            produced.set()
+            resume.wait(1)
+            # Reaching the next chunk is when the cancelled producer notices and cleans up
+            yield 1
+
+        return chunks()
+
+    def second(cancel):
+        starts.append("second")
+
+        def chunks():
+            while not cancel.cancelled:
+                yield "live"
+                time.sleep(0.01)
+
+        return chunks()
+
+    chunks, _ = flight.stream("key", first)
+    assert next(chunks) == 0
+    assert produced.wait(1)
+    chunks.close()
+
+    replacement, shared = flight.stream("key", second)
+    assert not shared
+    resume.set()
+    time.sleep(0.1)
+
+    joined, shared = flight.stream("key", lambda cancel: starts.append("third") or [])
+    assert shared
+    assert next(joined) == "live"
+    assert starts == ["second"]
+    # Start the subscribers so closing them cancels the producer
+    next(replacement)
+    joined.close()
+    replacement.close()
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from neuttsair.streaming import StreamDecoder, StreamingSchedule, compare_stream_decoding
+
+HOP_LENGTH = 4
+# Frames of earlier context ContextDecoder mixes into each frame
+CONTEXT_FRAMES = 12
+
+
+class ContextDecoder:
+    """Decodes each frame from itself and the CONTEXT_FRAMES before it in the window
+
+    Like a codec with a limited receptive field, a decode only matches a full one once
+    its window reaches that far back. Records how many frames every call decoded.
+    """
+
+    def __init__(self):
+        self.window_frames = []
+
+    def __call__(self, codes):
+        self.window_frames.append(len(codes))
+        sums = np.cumsum(np.concatenate([[0], codes.astype(np.float64)]))
+        starts = np.maximum(np.arange(len(codes)) - CONTEXT_FRAMES, 0)
+        frames = (sums[1:] - sums[starts]) / (CONTEXT_FRAMES + 1)
+        return np.repeat(frames.astype(np.float32), HOP_LENGTH)
+
+
+def random_codes(n, seed=0):
+    return np.random.default_rng(seed).integers(0, 1000, n)
+
+
+def stream(schedule, codes, context_codes=()):
+    decode = ContextDecoder()
+    decoder = StreamDecoder(decode, HOP_LENGTH, schedule, context_codes)
+    chunk_frames = []
+    for code in codes:
+        scheduled = decoder.chunk_frames
+        if decoder.push([code]) is not None:
+            chunk_frames.append(scheduled)
+    decoder.flush()
+    return decode.window_frames, chunk_frames
+
+
+def test_each_decode_reads_only_its_chunk_and_context():
+    schedule = StreamingSchedule(lookback=CONTEXT_FRAMES)
+    window_frames, chunk_frames = stream(schedule, random_codes(300), context_codes=random_codes(100, seed=1))
+
+    context = schedule.lookback + schedule.overlap_frames + schedule.lookforward
+    assert [decoded - chunk for decoded, chunk in zip(window_frames, chunk_frames)] == [context] * len(chunk_frames)
+    assert max(window_frames) == schedule.window_frames
+
+
+@pytest.mark.parametrize("lookback", [0, 8, 50])
+def test_lookback_sets_decoded_frames_per_chunk(lookback):
+    schedule = StreamingSchedule.fixed(lookback=lookback)
+    window_frames, _ = stream(schedule, random_codes(200), context_codes=random_codes(100, seed=1))
+    assert window_frames[0] == 25 + lookback + schedule.overlap_frames + schedule.lookforward
+
+
+def test_default_schedule_matches_windowed_decode():
+    result = compare_stream_decoding(ContextDecoder(), random_codes(300), HOP_LENGTH, StreamingSchedule())
+    assert result["max_abs_error"] < 1e-3
+
+
+def test_lookback_covering_context_matches_with_fewer_decoded_frames():
+    result = compare_stream_decoding(
+        ContextDecoder(), random_codes(300), HOP_LENGTH, StreamingSchedule.fixed(lookback=CONTEXT_FRAMES)
+    )
+    assert result["max_abs_error"] < 1e-3
+    assert result["codec_frames_per_frame"] < 0.6 * result["reference_codec_frames_per_frame"]
+
+
+def test_lookback_short_of_context_is_detected():
+    result = compare_stream_decoding(
+        ContextDecoder(), random_codes(300), HOP_LENGTH, StreamingSchedule.fixed(lookback=CONTEXT_FRAMES // 2)
+    )
+    assert result["max_abs_error"] > 1.0
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"lookforward": 0}, {"lookforward": 5, "overlap_frames": 3, "first_chunk_frames": 6}, {"lookback": -1}],
+)
+def test_schedule_rejects_context_the_decode_cannot_have(kwargs):
+    with pytest.raises(ValueError):
+        StreamingSchedule(**kwargs)
+
+
+@pytest.mark.parametrize("lookforward", [2, 5])
+def test_smallest_lookforward_keeps_every_sample(lookforward):
+    codes = random_codes(200)
+    decoder = StreamDecoder(ContextDecoder(), HOP_LENGTH, StreamingSchedule(lookforward=lookforward))
+    chunks = [decoder.push([code]) for code in codes] + [decoder.flush()]
+    assert sum(len(chunk) for chunk in chunks if chunk is not None) == len(codes) * HOP_LENGTH
+
+
+@pytest.mark.parametrize(
+    "schedule",
+    [StreamingSchedule(), StreamingSchedule.fixed(), StreamingSchedule(first_chunk_frames=4, growth=1.5, lookback=12)],
+)
+def test_decode_windows_cover_every_steady_decode(schedule):
+    window_frames, chunk_frames = stream(schedule, random_codes(300), context_codes=random_codes(100, seed=1))
+    # Every decode but the final flush uses one of the advertised window sizes
+    assert set(window_frames[: len(chunk_frames)]) == set(schedule.decode_windows)